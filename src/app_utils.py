@@ -1,3 +1,4 @@
+from constants import PULSAR_TYPES, SLURM_ENDED_STATES
 from gen_utils import split_and_strip
 from db_orms import *
 
@@ -29,3 +30,16 @@ class AppUtils(object):
 
 		return query
 
+
+	@staticmethod
+	def get_pulsars_to_process(db_manager, max_attempts=None):
+		"""
+		The pulsar observations process_data works on: those not processed with a chunk stage that can
+		run, or with all their stages done and so only to be consolidated (see DBManager.with_stages_to_run).
+		Those in a slurm job that has not ended are left out, as the stages of a job only reach the DB
+		when the slurm checker merges its spool.
+		"""
+		query = db_manager.get_session().query(Observation).join(SlurmJob, Observation.slurm_id == SlurmJob.id, isouter=True)
+		query = query.filter(Observation.obs_type.in_(PULSAR_TYPES), Observation.processed == False)
+		query = query.filter((Observation.slurm_id == None) | SlurmJob.state.in_(SLURM_ENDED_STATES) | SlurmJob.state.like("CANCELLED%"))
+		return db_manager.with_stages_to_run(query, max_attempts)
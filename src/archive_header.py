@@ -0,0 +1,381 @@
+import gzip
+import hashlib
+
+import numpy as np
+
+from log import Logger
+
+FITS_BLOCK_SIZE = 2880
+FITS_CARD_SIZE = 80
+
+# bytes of the DATA column hashed from each sampled SUBINT row for the content fingerprint
+FINGERPRINT_SAMPLE_SIZE = 65536
+
+# bytes per element for each FITS binary table TFORM type code
+TFORM_SIZES = {'L': 1, 'B': 1, 'I': 2, 'J': 4, 'K': 8, 'A': 1, 'E': 4, 'D': 8, 'C': 8, 'M': 16, 'P': 8, 'Q': 16}
+TFORM_DTYPES = {'B': '>u1', 'I': '>i2', 'J': '>i4', 'K': '>i8', 'E': '>f4', 'D': '>f8'}
+
+# OBS_MODE values, mapped to what psrchive returns for Archive.get_type()
+OBS_MODE_TYPES = {'PSR': 'Pulsar', 'LEVPSR': 'Pulsar', 'CAL': 'PolnCal', 'LEVCAL': 'PolnCal',
+				  'FON': 'FluxCal-On', 'FOF': 'FluxCal-Off', 'PCM': 'Calibrator'}
+
+# the header summary kept for each chunk, in the order of get_header_summary (see db_orms.ChunkHeader)
+HEADER_FIELDS = ('dm', 'rm', 'period', 'tsubint', 'receiver', 'basis', 'state', 'chan_freq', 'chan_bw', 'chan_freqs')
+
+
+class HeaderFormatException(Exception):
+	""" Raised when a file cannot be read as PSRFITS without psrchive, so the caller can fall back """
+	pass
+
+
+class MJD(object):
+	""" Mimics the subset of the psrchive MJD interface used by the pipeline """
+
+	def __init__(self, days):
+		self._days = days
+
+	def in_days(self):
+		return self._days
+
+
+def _parse_card_value(raw):
+
+	raw = raw.strip()
+
+	if raw.startswith("'"):
+		# strings are quoted, with '' as an escaped quote, and may be followed by a comment
+		value, i = "", 1
+		while i < len(raw):
+			if raw[i] == "'":
+				if i + 1 < len(raw) and raw[i + 1] == "'":
+					value += "'"
+					i += 2
+					continue
+				break
+			value += raw[i]
+			i += 1
+		return value.rstrip()
+
+	raw = raw.split('/')[0].strip()
+
+	if raw == 'T':
+		return True
+	if raw == 'F':
+		return False
+	if raw == '':
+		return None
+
+	try:
+		return int(raw)
+	except ValueError:
+		pass
+
+	try:
+		return float(raw.replace('D', 'E'))
+	except ValueError:
+		return raw
+
+
+def _column_width(tform):
+	repeat = tform.rstrip('ABCDEIJKLMPQX ')
+	code = tform[len(repeat):].strip()[0]
+	repeat = int(repeat) if repeat else 1
+	if code == 'X':
+		return (repeat + 7) // 8, code, repeat
+	return repeat * TFORM_SIZES[code], code, repeat
+
+
+def _open_fits(file_name):
+	with open(file_name, 'rb') as f:
+		magic = f.read(2)
+
+	if magic == b'\x1f\x8b':
+		return gzip.open(file_name, 'rb')
+	return open(file_name, 'rb')
+
+
+def _fingerprint_rows(nsubint):
+	return sorted(set((0, nsubint // 2, nsubint - 1)))
+
+
+class ArchiveHeader(object):
+	"""
+	Header-only reader for PSRFITS archives. Reads the primary and SUBINT headers, the few
+	per-row scalars needed for the start and end times and the channel frequencies of the
+	first row, without reading the data arrays.
+	Exposes the psrchive Archive getters used by FileInfo and ObservationChunk so it can be
+	passed in place of a loaded archive.
+
+	With fingerprint=True it also hashes the identifying header values and the start of the
+	DATA column of the first, middle and last rows, so that copies of the same data (e.g. a .rf
+	and its gzipped .zrf) can be recognised without reading them in full.
+	"""
+
+	def __init__(self, file_name, fingerprint=False):
+		self._file_name = file_name
+		self._primary = {}
+		self._subint = {}
+		self._columns = {}
+		self._subint_data_offset = None
+		self._first_row = {}
+		self._last_row = {}
+		self._fingerprint = hashlib.blake2b(digest_size=16) if fingerprint else None
+
+		with _open_fits(self._file_name) as f:
+			self._read(f)
+
+	@staticmethod
+	def _read_header(f):
+
+		header = {}
+		nblocks = 0
+
+		while True:
+			block = f.read(FITS_BLOCK_SIZE)
+			if len(block) != FITS_BLOCK_SIZE:
+				raise HeaderFormatException("Truncated FITS header")
+			nblocks += 1
+
+			for i in range(0, FITS_BLOCK_SIZE, FITS_CARD_SIZE):
+				card = block[i:i + FITS_CARD_SIZE].decode('ascii', errors='replace')
+				key = card[:8].strip()
+
+				if key == 'END':
+					return header, nblocks * FITS_BLOCK_SIZE
+
+				if card[8:10] == '= ' and key not in header:
+					header[key] = _parse_card_value(card[10:])
+
+	@staticmethod
+	def _data_size(header):
+		naxis = header.get('NAXIS', 0)
+		if naxis == 0:
+			return 0
+
+		size = 1
+		for i in range(1, naxis + 1):
+			size *= header['NAXIS{}'.format(i)]
+
+		size = abs(header.get('BITPIX', 8)) // 8 * header.get('GCOUNT', 1) * (header.get('PCOUNT', 0) + size)
+
+		return (size + FITS_BLOCK_SIZE - 1) // FITS_BLOCK_SIZE * FITS_BLOCK_SIZE
+
+	def _read(self, f):
+
+		if f.read(9) != b'SIMPLE  =':
+			raise HeaderFormatException("{} is not a FITS file".format(self._file_name))
+		f.seek(0)
+
+		self._primary, offset = self._read_header(f)
+
+		if self._primary.get('FITS_TYP') != 'PSRFITS':
+			raise HeaderFormatException("{} is not a PSRFITS file".format(self._file_name))
+
+		offset += self._data_size(self._primary)
+		f.seek(offset)
+
+		while True:
+			header, header_size = self._read_header(f)
+			offset += header_size
+
+			if header.get('EXTNAME') == 'SUBINT':
+				self._subint = header
+				self._subint_data_offset = offset
+				break
+
+			offset += self._data_size(header)
+			f.seek(offset)
+
+		column_offset = 0
+		for i in range(1, self._subint.get('TFIELDS', 0) + 1):
+			width, code, repeat = _column_width(self._subint['TFORM{}'.format(i)])
+			self._columns[self._subint['TTYPE{}'.format(i)]] = (column_offset, code, repeat, width)
+			column_offset += width
+
+		nsubint = self.get_nsubint()
+		if nsubint == 0:
+			raise HeaderFormatException("{} has no sub-integrations".format(self._file_name))
+
+		# rows are read in file order, as seeking back in a gzipped file starts again from the top
+		sample_rows = _fingerprint_rows(nsubint) if self._fingerprint is not None else []
+
+		self._first_row = self._read_row_values(f, 0, ('TSUBINT', 'OFFS_SUB'), ('PERIOD', 'DAT_FREQ'))
+		for row in sample_rows[:-1]:
+			self._fingerprint.update(self._read_data_sample(f, row))
+
+		self._last_row = self._read_row_values(f, nsubint - 1, ('TSUBINT', 'OFFS_SUB')) if nsubint > 1 else self._first_row
+		for row in sample_rows[-1:]:
+			self._fingerprint.update(self._read_data_sample(f, row))
+
+		if self._fingerprint is not None:
+			self._fingerprint.update(repr(self._identity()).encode())
+
+	def _identity(self):
+		return (self._primary.get('SRC_NAME'), self._primary.get('TELESCOP'), self._primary.get('BACKEND'),
+				self._primary.get('OBSFREQ'), self._primary.get('OBSBW'), self._primary.get('STT_IMJD'),
+				self._primary.get('STT_SMJD'), self._primary.get('STT_OFFS'), self._subint.get('NAXIS1'),
+				self._subint.get('NAXIS2'), self._subint.get('NCHAN'), self._subint.get('NBIN'),
+				self._subint.get('NPOL'), self._first_row['OFFS_SUB'], self._last_row['OFFS_SUB'])
+
+	def _read_row_values(self, f, row, names, optional_names=()):
+		""" Reads columns of one row: scalars as floats, vectors as float arrays. Optional columns the table lacks are left out. """
+
+		values = {}
+		row_start = self._subint_data_offset + row * self._subint['NAXIS1']
+
+		for name in names:
+			if name not in self._columns:
+				raise HeaderFormatException("SUBINT table has no {} column".format(name))
+
+		names = list(names) + [name for name in optional_names if name in self._columns]
+
+		# in file order, as seeking back in a gzipped file starts again from the top
+		for name in sorted(names, key=lambda name: self._columns[name][0]):
+			column_offset, code, repeat, width = self._columns[name]
+			dtype = np.dtype(TFORM_DTYPES[code])
+			f.seek(row_start + column_offset)
+			value = np.frombuffer(f.read(dtype.itemsize * repeat), dtype=dtype)
+			values[name] = float(value[0]) if repeat == 1 else value.astype(float)
+
+		return values
+
+	def _read_data_sample(self, f, row):
+
+		if 'DATA' not in self._columns:
+			raise HeaderFormatException("SUBINT table has no DATA column")
+
+		column_offset, code, repeat, width = self._columns['DATA']
+		f.seek(self._subint_data_offset + row * self._subint['NAXIS1'] + column_offset)
+		return f.read(min(width, FINGERPRINT_SAMPLE_SIZE))
+
+	def _reference_seconds(self):
+		return self._primary['STT_SMJD'] + self._primary['STT_OFFS']
+
+	def get_filename(self):
+		return self._file_name
+
+	def get_nchan(self):
+		return self._subint['NCHAN']
+
+	def get_nsubint(self):
+		return self._subint['NAXIS2']
+
+	def get_nbin(self):
+		return self._subint['NBIN']
+
+	def get_npol(self):
+		return self._subint['NPOL']
+
+	def get_centre_frequency(self):
+		return float(self._primary['OBSFREQ'])
+
+	def get_bandwidth(self):
+		return float(self._primary['OBSBW'])
+
+	def get_source(self):
+		return self._primary['SRC_NAME']
+
+	def get_backend_name(self):
+		return self._primary['BACKEND']
+
+	def get_telescope(self):
+		return self._primary['TELESCOP']
+
+	def get_type(self):
+		return OBS_MODE_TYPES.get(self._primary.get('OBS_MODE'), 'Unknown')
+
+	def get_dispersion_measure(self):
+		return self._subint.get('DM')
+
+	def get_rotation_measure(self):
+		return self._subint.get('RM')
+
+	def get_receiver_name(self):
+		return self._primary.get('FRONTEND')
+
+	def get_basis(self):
+		""" FD_POLN, e.g. LIN or CIRC (psrchive returns a Signal::Basis instead) """
+		return self._primary.get('FD_POLN')
+
+	def get_state(self):
+		""" POL_TYPE, e.g. AABBCRCI or INTEN (psrchive returns a Signal::State instead) """
+		return self._subint.get('POL_TYPE')
+
+	def get_folding_period(self):
+		""" Folding period of the first sub-integration, if the table has a PERIOD column """
+		return self._first_row.get('PERIOD')
+
+	def get_subint_duration(self):
+		return self._first_row['TSUBINT']
+
+	def get_frequencies(self):
+		""" Channel centre frequencies of the first sub-integration, if the table has a DAT_FREQ column """
+		freqs = self._first_row.get('DAT_FREQ')
+		return np.atleast_1d(freqs) if freqs is not None else None
+
+	def get_fingerprint(self):
+		""" Hex digest identifying the content of the file, or None if it was not asked for """
+		return self._fingerprint.hexdigest() if self._fingerprint is not None else None
+
+	def start_time(self):
+		seconds = self._reference_seconds() + self._first_row['OFFS_SUB'] - self._first_row['TSUBINT'] / 2.0
+		return MJD(self._primary['STT_IMJD'] + seconds / 86400.0)
+
+	def end_time(self):
+		seconds = self._reference_seconds() + self._last_row['OFFS_SUB'] + self._last_row['TSUBINT'] / 2.0
+		return MJD(self._primary['STT_IMJD'] + seconds / 86400.0)
+
+
+def compact_frequencies(freqs):
+	"""
+	Returns (first frequency, channel width, None) for channels spaced evenly, as they nearly
+	always are, else (None, None, the frequencies as little-endian float64 bytes).
+	"""
+	if freqs is None or len(freqs) == 0:
+		return None, None, None
+
+	freqs = np.asarray(freqs, dtype=float)
+	widths = np.diff(freqs)
+	if len(freqs) == 1 or np.allclose(widths, widths[0], rtol=0, atol=1e-6):
+		return float(freqs[0]), float(widths[0]) if len(widths) > 0 else None, None
+	return None, None, freqs.astype('<f8').tobytes()
+
+
+def get_header_summary(archive):
+	""" The HEADER_FIELDS values of an ArchiveHeader, or of an archive loaded with psrchive """
+	if isinstance(archive, ArchiveHeader):
+		period, tsubint = archive.get_folding_period(), archive.get_subint_duration()
+		basis, state = archive.get_basis(), archive.get_state()
+	else:
+		integration = archive.get_Integration(0)
+		period, tsubint = integration.get_folding_period(), integration.get_duration()
+		basis, state = str(archive.get_basis()), str(archive.get_state())
+
+	return (archive.get_dispersion_measure(), archive.get_rotation_measure(), period, tsubint,
+			archive.get_receiver_name(), basis, state) + compact_frequencies(archive.get_frequencies())
+
+
+def read_primary_header(file_name):
+	""" Returns the primary header of any FITS file (e.g. a .pcm calibrator solution, which has no SUBINT table) as a dict """
+	with _open_fits(file_name) as f:
+		if f.read(9) != b'SIMPLE  =':
+			raise HeaderFormatException("{} is not a FITS file".format(file_name))
+		f.seek(0)
+		header, header_size = ArchiveHeader._read_header(f)
+
+	return header
+
+
+def load_archive_header(file_name, fingerprint=False):
+	"""
+	Returns an ArchiveHeader for PSRFITS files, falling back to loading the full archive
+	with psrchive for anything the header reader cannot parse. Archives loaded with psrchive
+	have no get_fingerprint().
+	"""
+	try:
+		return ArchiveHeader(file_name, fingerprint)
+	except (HeaderFormatException, KeyError, ValueError, OSError, EOFError) as e:
+		Logger.get_instance().debug("Falling back to psrchive for {}: {}".format(file_name, e))
+
+	import psrchive as ps
+	return ps.Archive_load(file_name)
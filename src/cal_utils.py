@@ -1,8 +1,75 @@
+import hashlib
+import os
+
 import numpy as np
 from gen_utils import run_process
 from pathlib import Path
 from constants import *
 from log import Logger
+from exceptions import IncorrectFileHeaderException
+
+# MHz within which a number in a calibrator DB entry is taken to be the centre frequency
+CFREQ_TOLERANCE = 0.001
+
+# (path, size, mtime, cfreq) -> digest, as every chunk at a centre frequency reads the same entries
+_entry_digests = {}
+
+
+def _is_cfreq(token, cfreq):
+	try:
+		return abs(float(token) - cfreq) < CFREQ_TOLERANCE
+	except ValueError:
+		return False
+
+
+def get_cal_db_entries(db_file, cfreq):
+	""" The entries of a calibrator DB, without its header lines, of the calibrators at centre frequency cfreq """
+	entries = []
+	with open(db_file) as f:
+		for line in f:
+			line = line.strip()
+			if line == "" or line.startswith("#") or "Pulsar::Database" in line:
+				continue
+			if any(_is_cfreq(token, cfreq) for token in line.split()):
+				entries.append(line)
+	return entries
+
+
+def cal_db_digest(db_file, cfreq):
+	"""
+	The SHA-256 of the entries of a calibrator DB at centre frequency cfreq, or None if there is no
+	such file. Unlike the digest of the whole file, it does not change when calibrators at other
+	centre frequencies are added, which pac would not use for a chunk at cfreq.
+	"""
+	if db_file is None or not os.path.exists(db_file):
+		return None
+
+	stat_result = os.stat(db_file)
+	key = (os.path.abspath(db_file), stat_result.st_size, stat_result.st_mtime_ns, cfreq)
+	if key not in _entry_digests:
+		content = "\n".join(sorted(get_cal_db_entries(db_file, cfreq)))
+		_entry_digests[key] = hashlib.sha256(content.encode()).hexdigest()
+
+	return _entry_digests[key]
+
+
+def group_cal_chunks(observations):
+	""" The chunks of calibrator observations, grouped by the kind (FLUXCAL or POLNCAL) and centre frequency of their calibrator DB """
+	groups = {}
+	for observation in observations:
+		if observation.is_flux_cal():
+			cal_type = FLUXCAL
+		elif observation.is_poln_cal():
+			cal_type = POLNCAL
+		else:
+			raise IncorrectFileHeaderException("Unknown observation type {} in header of {}".format(observation.obs_type, observation.obs_source_utc))
+
+		for observation_chunk in observation.observation_chunks:
+			groups.setdefault((cal_type, observation_chunk.cfreq), []).append(observation_chunk)
+
+	return groups
+
+
 class CalUtils(object):
 
 	def __init__(self, config):
@@ -48,6 +115,18 @@ class CalUtils(object):
 	def add_to_polncal_db(self, local_db_file):
 		self.add_to_db(self.global_polncal_db, local_db_file)
 
+	def make_cal_db(self, cleaned_files, cal_type, cfreq, timestamp):
+		""" Makes the local DB of the cleaned calibrator files of one kind (FLUXCAL or POLNCAL) and centre frequency, and the fluxcal solutions of flux calibrators """
+		list_file_name = "{}_{}_{}_list.txt".format(timestamp, cfreq, cal_type)
+		local_db = self.create_cal_db(cleaned_files, list_file_name)
+		if cal_type == FLUXCAL:
+			self.get_fluxcal_solutions(local_db, cfreq)
+		return local_db
+
+	def add_cal_db(self, local_db, cal_type):
+		""" Adds a local DB made by make_cal_db to the global DB of its kind """
+		self.add_to_db(self.global_fluxcal_db if cal_type == FLUXCAL else self.global_polncal_db, local_db)
+
 	def get_fluxcal_solutions(self, local_db_file, cfreq):
 		out_dir_path = self.config.root_dir_path.joinpath(FLUXCAL_SOLUTIONS_DIR).joinpath(str(cfreq))
 		out_dir_path.mkdir(exist_ok=True, parents=True)
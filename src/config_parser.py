@@ -4,7 +4,7 @@ from  gen_utils import ensure_file_exists, strip_quotes_and_spaces, guess_and_ch
 import shutil
 from constants import POLNCAL_DIR
 import numpy as np
-import psrchive as ps
+from archive_header import read_primary_header
 from log import Logger
 class SlurmConfig(object):
 	def __init__(self, num_simultaneous_jobs, partition, mail_user, mail_type, bash_setup):
@@ -41,11 +41,83 @@ class SlurmConfig(object):
 	
 
 
+# optional config keys for the state database, and the DBConfig arguments they set
+DB_CONFIG_KEYS = {'DB_JOURNAL_MODE': 'journal_mode', 'DB_SYNCHRONOUS': 'synchronous', 'DB_CACHE_SIZE': 'cache_size',
+				  'DB_MMAP_SIZE': 'mmap_size', 'DB_BUSY_TIMEOUT': 'busy_timeout', 'DB_MAX_RETRIES': 'max_retries',
+				  'DB_BATCH_SIZE': 'batch_size', 'DB_BATCH_INTERVAL': 'batch_interval', 'DB_STAGE_TIMEOUT': 'stage_timeout'}
+
+class DBConfig(object):
+	"""
+	SQLite settings for the state database. The defaults suit a database file on a shared
+	filesystem that many Slurm jobs write to; WAL lets readers carry on during a write, but
+	needs all jobs to see the file on a filesystem with working shared memory. Inside a
+	DBManager.batch(), changes are committed every batch_size objects or batch_interval seconds.
+	A chunk stage still running stage_timeout seconds after it started is taken to have died.
+	"""
+	def __init__(self, journal_mode="DELETE", synchronous="FULL", cache_size=-65536, mmap_size=0, busy_timeout=600, max_retries=10,
+				 batch_size=100, batch_interval=60, stage_timeout=86400):
+		self._journal_mode = journal_mode
+		self._synchronous = synchronous
+		self._cache_size = cache_size
+		self._mmap_size = mmap_size
+		self._busy_timeout = busy_timeout
+		self._max_retries = max_retries
+		self._batch_size = batch_size
+		self._batch_interval = batch_interval
+		self._stage_timeout = stage_timeout
+
+	@property
+	def journal_mode(self):
+		return self._journal_mode
+
+	@property
+	def synchronous(self):
+		return self._synchronous
+
+	@property
+	def cache_size(self):
+		return self._cache_size
+
+	@property
+	def mmap_size(self):
+		return self._mmap_size
+
+	@property
+	def busy_timeout(self):
+		return self._busy_timeout
+
+	@property
+	def max_retries(self):
+		return self._max_retries
+
+	@property
+	def batch_size(self):
+		return self._batch_size
+
+	@property
+	def batch_interval(self):
+		return self._batch_interval
+
+	@property
+	def stage_timeout(self):
+		return self._stage_timeout
+
+	def __str__(self):
+		return " journal_mode {} \n synchronous {} \n cache_size {} \n mmap_size {} \n busy_timeout {} \n max_retries {} \n batch_size {} \n batch_interval {} \n stage_timeout {} \n".format(
+			self.journal_mode, self.synchronous, self.cache_size, self.mmap_size, self.busy_timeout, self.max_retries,
+			self.batch_size, self.batch_interval, self.stage_timeout)
+
+	def __repr__(self):
+		return self.__str__()
+
+
+
 class Config(object):
 
-	def __init__(self, root_dir, dm_file, rm_file, decimation_file, db_file, global_fluxcal_db, global_polncal_db, global_metm_db, rfi_tolerance, slurm_config):
+	def __init__(self, root_dir, dm_file, rm_file, decimation_file, db_file, global_fluxcal_db, global_polncal_db, global_metm_db, rfi_tolerance, slurm_config, db_config=None):
 		self._root_dir = root_dir
 		self._slurm_config = slurm_config
+		self._db_config = db_config if db_config is not None else DBConfig()
 		self._dm_file = dm_file
 		self._rm_file = rm_file
 		self._decimation_file = decimation_file
@@ -123,6 +195,10 @@ class Config(object):
 	def slurm_config(self):
 		return self._slurm_config
 
+	@property
+	def db_config(self):
+		return self._db_config
+
 	@property
 	def dm_file(self):
 		return self._dm_file
@@ -151,6 +227,10 @@ class Config(object):
 	def global_metm_db(self):
 		return self._global_metm_db		
 
+	@property
+	def rfi_tolerance(self):
+		return self._rfi_tolerance
+
 class ConfigurationReader(object):
 
 	@classmethod
@@ -162,11 +242,12 @@ class ConfigurationReader(object):
 		new_file_names = []
 		for metm_pcm_file_path in metm_pcm_file_paths:
 
-			ar = ps.Archive_load(metm_pcm_file_path.resolve().as_posix())
+			# only the source and frequency are needed, which are in the primary header
+			header = read_primary_header(metm_pcm_file_path.resolve().as_posix())
 
 			utc = metm_pcm_file_path.name.split("_")[0]
 
-			pcm_dest_path = out_path.joinpath(POLNCAL_DIR).joinpath("P999").joinpath(ar.get_source()).joinpath("00000").joinpath(utc).joinpath(str(ar.get_centre_frequency()))
+			pcm_dest_path = out_path.joinpath(POLNCAL_DIR).joinpath("P999").joinpath(header['SRC_NAME']).joinpath("00000").joinpath(utc).joinpath(str(float(header['OBSFREQ'])))
 			pcm_dest_path.mkdir(parents=True, exist_ok=True)
 
 			new_file_name = pcm_dest_path.joinpath(metm_pcm_file_path.name).resolve().as_posix()
@@ -174,8 +255,6 @@ class ConfigurationReader(object):
 
 			new_file_names.append(new_file_name)
 
-			del ar 		
-
 		np.savetxt(out_path.joinpath(POLNCAL_DIR).joinpath("pcm.files").resolve().as_posix(),new_file_names,delimiter=" ", fmt="%s")
 
 		global_metm_db_path = out_path.joinpath("global_metm.db")
@@ -252,6 +331,8 @@ class ConfigurationReader(object):
 						  self.dict_process_config['MAIL_TYPE'],
 						  self.dict_process_config['SLURM_BASH_HEADER']) 
 
+		db_config = DBConfig(**{arg: self.dict_process_config[key] for key, arg in DB_CONFIG_KEYS.items() if key in self.dict_process_config})
+
 		self._config =  Config(self.dict_process_config['PSRPYPE_ROOT'], 
 							self.dict_process_config['DM_LIST'],
 							self.dict_process_config['RM_LIST'],
@@ -261,7 +342,8 @@ class ConfigurationReader(object):
 							self.dict_process_config['GLOBAL_POLNCAL_DB'],
 							self.dict_process_config['GLOBAL_METM_DB'],
 							self.dict_process_config['RFI_ZAP_TOLERANCE'],
-							slurm_config)
+							slurm_config,
+							db_config)
 
 
 	def get_config(self):
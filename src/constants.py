@@ -6,7 +6,8 @@ FLUXCAL_DIR="flux_cal"
 POLNCAL_DIR="poln_cal"
 PULSAR_DIR="pulsar"
 SCRATCH_DIR="scratch"
-PIPELINE_DIR_NAMES=[TEMPLATE_DIR, EPHEMERIS_DIR, FLUXCAL_DIR, POLNCAL_DIR, PULSAR_DIR, SCRATCH_DIR]
+SPOOL_DIR="spool"
+PIPELINE_DIR_NAMES=[TEMPLATE_DIR, EPHEMERIS_DIR, FLUXCAL_DIR, POLNCAL_DIR, PULSAR_DIR, SCRATCH_DIR, SPOOL_DIR]
 
 FLUXCAL_CLEANED_DIR = "cleaned"
 POLNCAL_CLEANED_DIR = "cleaned"
@@ -32,6 +33,31 @@ FLUX_CALIBRATOR_SOURCES=["0407-658_N", "0407-658_O", "0407-658_S", "0823-500_NS"
 "HYDRA_N", "HYDRA_O", "HYDRA_S", "HydraA_N", "HydraA_O", "HydraA_S"]
 
 CALIBRATOR_TYPES=['PolnCal', 'FluxCal-On', 'FluxCal-Off']
+# the kinds of calibrator database, one per kind and centre frequency
+FLUXCAL="fluxcal"
+POLNCAL="polncal"
 PULSAR_TYPES=['Pulsar']
 
+# processing stages of a chunk, in order, and the ObservationChunk column holding the output of each
+STAGE_PREPROCESS="preprocess"
+STAGE_CLEAN="clean"
+STAGE_CALIBRATE="calibrate"
+STAGE_RECLEAN="reclean"
+PULSAR_STAGES=[STAGE_PREPROCESS, STAGE_CLEAN, STAGE_CALIBRATE, STAGE_RECLEAN]
+CALIBRATOR_STAGES=[STAGE_PREPROCESS, STAGE_CLEAN]
+STAGE_OUTPUT_COLUMNS={STAGE_PREPROCESS: "preprocessed_file", STAGE_CLEAN: "cleaned_file",
+					  STAGE_CALIBRATE: "calibrated_file", STAGE_RECLEAN: "recleaned_file"}
+# the name each stage gives its output, see ObservationChunk.construct_output_archive_path
+STAGE_OUTPUT_NAMES={STAGE_PREPROCESS: "preprocessed", STAGE_CLEAN: "cleaned", STAGE_CALIBRATE: "calibrated", STAGE_RECLEAN: "recleaned"}
+
+# states of a chunk stage: waiting for the previous stage, ready to run, running, done or failed (and ready to retry)
+STAGE_WAITING="waiting"
+STAGE_READY="ready"
+STAGE_RUNNING="running"
+STAGE_DONE="done"
+STAGE_FAILED="failed"
+
+# sacct states of a slurm job that ended, whatever the outcome (cancelled jobs show as "CANCELLED by <uid>")
+SLURM_ENDED_STATES=['COMPLETED', 'FAILED', 'OUT_OF_MEMORY', 'CANCELLED', 'TIMEOUT', 'NODE_FAIL', 'BOOT_FAIL', 'DEADLINE', 'PREEMPTED']
+
 
@@ -0,0 +1,188 @@
+import os
+
+from sqlalchemy import text
+
+from log import Logger
+
+
+def _add_query_indexes(connection):
+	""" indexes for the observation shortlists of process_data/prepare_cals/slurm, the ingestion lookup and chunk loads """
+	connection.execute(text("CREATE INDEX IF NOT EXISTS ix_observations_type_processed_slurm ON observations (obs_type, processed, slurm_id)"))
+	connection.execute(text("CREATE INDEX IF NOT EXISTS ix_observations_start_cfreq_source ON observations (obs_start_utc, cfreq, source)"))
+	connection.execute(text("CREATE INDEX IF NOT EXISTS ix_observation_chunks_observation_id ON observation_chunks (observation_id)"))
+	connection.execute(text("CREATE INDEX IF NOT EXISTS ix_observation_chunks_collection_id ON observation_chunks (collection_id)"))
+
+
+def _add_chunk_stages(connection):
+	""" per-chunk stage states, backfilled from the output file columns of the existing chunks """
+	connection.execute(text("CREATE TABLE IF NOT EXISTS chunk_stages (chunk_id INTEGER NOT NULL, stage VARCHAR NOT NULL, "
+							"state VARCHAR NOT NULL, attempts INTEGER NOT NULL, start_time FLOAT, end_time FLOAT, host VARCHAR, "
+							"output_file VARCHAR, PRIMARY KEY (chunk_id, stage), FOREIGN KEY(chunk_id) REFERENCES observation_chunks (id))"))
+	connection.execute(text("CREATE INDEX IF NOT EXISTS ix_chunk_stages_state_stage ON chunk_stages (state, stage)"))
+
+	# the stages as they were when this migration was written, not as they may be later
+	stage_columns = [('preprocess', 'preprocessed_file'), ('clean', 'cleaned_file'), ('calibrate', 'calibrated_file'), ('reclean', 'recleaned_file')]
+	calibrator_stage_count = 2
+
+	rows = []
+	for chunk in connection.execute(text("SELECT id, obs_type, processed, preprocessed_file, cleaned_file, calibrated_file, recleaned_file "
+										 "FROM observation_chunks")).mappings():
+		stages = stage_columns if chunk['obs_type'] == 'Pulsar' else stage_columns[:calibrator_stage_count]
+		outputs = [chunk[column] for stage, column in stages]
+		# a stage is done if it, or any later stage, has an output, or if the chunk is processed
+		done = [bool(chunk['processed']) or any(o is not None for o in outputs[i:]) for i in range(len(stages))]
+		ready = done.index(False) if False in done else None
+		for i, (stage, column) in enumerate(stages):
+			state = 'done' if done[i] else 'ready' if i == ready else 'waiting'
+			rows.append(dict(chunk_id=chunk['id'], stage=stage, state=state, output_file=outputs[i] if done[i] else None))
+
+	if len(rows) > 0:
+		connection.execute(text("INSERT OR IGNORE INTO chunk_stages (chunk_id, stage, state, attempts, output_file) "
+								"VALUES (:chunk_id, :stage, :state, 0, :output_file)"), rows)
+
+
+def _merge_duplicates(connection, table, key_columns, referencing_column=None):
+	""" Keeps the first row of each key, moving what references the others (referencing_column of observation_chunks) to it """
+	key = ", ".join(key_columns)
+	match = " AND ".join("d.{0} = k.{0}".format(column) for column in key_columns)
+	duplicates = "SELECT id FROM {0} WHERE id NOT IN (SELECT MIN(id) FROM {0} GROUP BY {1})".format(table, key)
+
+	if referencing_column is not None:
+		connection.execute(text("UPDATE observation_chunks SET {2} = (SELECT MIN(k.id) FROM {0} d JOIN {0} k ON {1} WHERE d.id = observation_chunks.{2}) "
+								"WHERE {2} IN ({3})".format(table, match, referencing_column, duplicates)))
+
+	count = connection.execute(text("DELETE FROM {} WHERE id IN ({})".format(table, duplicates))).rowcount
+	if count > 0:
+		Logger.get_instance().warn("Merged {} duplicate rows of {} by ({})".format(count, table, key))
+
+
+def _add_natural_keys(connection):
+	""" unique natural keys for collections, observations and chunks, merging any duplicates made by concurrent ingestions """
+	_merge_duplicates(connection, "collections", ["collection_path", "pid", "name_alias"], "collection_id")
+
+	# an observation that gets the chunks of its duplicates has to be consolidated again
+	connection.execute(text("UPDATE observations SET processed = 0, decimated = 0, psradded_file = NULL WHERE id IN "
+							"(SELECT MIN(id) FROM observations GROUP BY obs_start_utc, cfreq, source HAVING COUNT(*) > 1)"))
+	_merge_duplicates(connection, "observations", ["obs_start_utc", "cfreq", "source"], "observation_id")
+
+	connection.execute(text("DELETE FROM chunk_stages WHERE chunk_id IN "
+							"(SELECT id FROM observation_chunks WHERE id NOT IN (SELECT MIN(id) FROM observation_chunks GROUP BY original_file))"))
+	_merge_duplicates(connection, "observation_chunks", ["original_file"])
+
+	connection.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_collections_path_pid_alias ON collections (collection_path, pid, name_alias)"))
+	connection.execute(text("DROP INDEX IF EXISTS ix_observations_start_cfreq_source"))
+	connection.execute(text("CREATE UNIQUE INDEX ix_observations_start_cfreq_source ON observations (obs_start_utc, cfreq, source)"))
+	connection.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_observation_chunks_original_file ON observation_chunks (original_file)"))
+
+
+def _relative_paths(connection):
+	""" paths under the pipeline root, the directory of the database file, stored relative to it (see db_orms.PipelinePath) """
+	db_file = [row[2] for row in connection.execute(text("PRAGMA database_list")) if row[1] == 'main'][0]
+	prefix = os.path.dirname(os.path.realpath(db_file)) + os.sep
+
+	path_columns = {'collections': ['collection_path'], 'observations': ['psradded_file'], 'chunk_stages': ['output_file'],
+					'observation_chunks': ['original_file', 'sym_file', 'preprocessed_file', 'cleaned_file', 'calibrated_file', 'recleaned_file']}
+
+	for table, columns in path_columns.items():
+		for column in columns:
+			connection.execute(text("UPDATE {0} SET {1} = substr({1}, :start) WHERE substr({1}, 1, :length) = :prefix".format(table, column)),
+							   dict(start=len(prefix) + 1, length=len(prefix), prefix=prefix))
+
+
+# tables whose rows carry a modified sequence number, for incremental exports (see export_catalog.py)
+MODIFIED_TABLES = ['collections', 'observations', 'observation_chunks', 'chunk_stages']
+
+
+def create_modified_triggers(connection):
+	"""
+	Triggers that give every inserted or updated row the next modified number of its table.
+	Writers hold the write lock, so the numbers are handed out in commit order.
+	"""
+	for table in MODIFIED_TABLES:
+		for event, condition in (("INSERT", ""), ("UPDATE", "WHEN NEW.modified IS OLD.modified ")):
+			connection.execute(text("CREATE TRIGGER IF NOT EXISTS tr_{0}_modified_{1} AFTER {2} ON {0} {3}BEGIN "
+									"UPDATE {0} SET modified = (SELECT IFNULL(MAX(modified), 0) + 1 FROM {0}) WHERE rowid = NEW.rowid; END"
+									.format(table, event.lower(), event, condition)))
+
+
+def _add_column(connection, table, column, column_type):
+	""" Adds a column to a table, unless it has it already """
+	if column not in [row[1] for row in connection.execute(text("PRAGMA table_info({})".format(table)))]:
+		connection.execute(text("ALTER TABLE {} ADD COLUMN {} {}".format(table, column, column_type)))
+
+
+def _add_modified_sequence(connection):
+	""" modified sequence numbers, starting from the row order of the existing rows """
+	for table in MODIFIED_TABLES:
+		_add_column(connection, table, "modified", "INTEGER")
+		connection.execute(text("UPDATE {} SET modified = rowid".format(table)))
+		connection.execute(text("CREATE INDEX IF NOT EXISTS ix_{0}_modified ON {0} (modified)".format(table)))
+	create_modified_triggers(connection)
+
+
+def _add_chunk_headers(connection):
+	""" header summaries of chunks ingested from now on; earlier chunks get theirs from initialise_data.py --fill_headers """
+	connection.execute(text("CREATE TABLE IF NOT EXISTS chunk_headers (chunk_id INTEGER NOT NULL, dm FLOAT, rm FLOAT, period FLOAT, "
+							"tsubint FLOAT, receiver VARCHAR, basis VARCHAR, state VARCHAR, chan_freq FLOAT, chan_bw FLOAT, chan_freqs BLOB, "
+							"PRIMARY KEY (chunk_id), FOREIGN KEY(chunk_id) REFERENCES observation_chunks (id))"))
+
+
+def _add_stage_pids(connection):
+	""" the process that runs a stage, to tell when a stage left running on this host has died """
+	_add_column(connection, "chunk_stages", "pid", "INTEGER")
+
+
+# MIGRATIONS[i] upgrades a database from schema version i to i + 1. Only ever append to this list:
+# the schema version is stored in the database (PRAGMA user_version) and steps that ran are never rerun.
+MIGRATIONS = [
+	_add_query_indexes,
+	_add_chunk_stages,
+	_add_natural_keys,
+	_relative_paths,
+	_add_modified_sequence,
+	_add_chunk_headers,
+	_add_stage_pids,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(connection):
+	return connection.execute(text("PRAGMA user_version")).scalar()
+
+
+def set_schema_version(connection, version):
+	connection.execute(text("PRAGMA user_version = {:d}".format(version)))
+
+
+def upgrade_database(engine):
+	"""
+	Brings an existing database up to SCHEMA_VERSION, in one transaction. Empty databases are
+	left alone, as DBManager.init_database creates them at the latest version.
+
+	The driver does not start transactions before DDL by itself, so the transaction is started
+	here, taking the write lock first: every step is then rolled back if one fails, and of two
+	processes opening an old database at once, the second sees the version the first left.
+	"""
+	logger = Logger.get_instance()
+
+	with engine.connect() as connection:
+		if get_schema_version(connection) >= SCHEMA_VERSION:
+			return
+
+	with engine.begin() as connection:
+		connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+		version = get_schema_version(connection)
+		if version >= SCHEMA_VERSION:
+			return
+
+		tables = connection.execute(text("SELECT name FROM sqlite_master WHERE type='table'")).scalars().all()
+		if len(tables) == 0:
+			return
+
+		for i in range(version, SCHEMA_VERSION):
+			logger.info("Upgrading database schema from version {} to {}".format(i, i + 1))
+			MIGRATIONS[i](connection)
+
+		set_schema_version(connection, SCHEMA_VERSION)
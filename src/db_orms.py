@@ -1,31 +1,94 @@
+import logging
+import os
+import random
+import socket
+import sqlite3
+import time
+from contextlib import contextmanager
 from pathlib import Path
 
 import numpy as np
 import sqlalchemy
-from sqlalchemy import (BigInteger, Column, Float, ForeignKey, Integer, String,
-                        create_engine)
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker
+from sqlalchemy import (BigInteger, Column, Float, ForeignKey, Index, Integer,
+                        LargeBinary, String, TypeDecorator, case,
+                        create_engine, event)
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import declarative_base, relationship, selectinload, sessionmaker
 from sqlalchemy.sql.sqltypes import Boolean
 
-from constants import (FLUX_CALIBRATOR_SOURCES, FLUXCAL_DIR, POLNCAL_DIR,
-                       PULSAR_DIR, SCRATCH_DIR)
+from config_parser import DBConfig
+from constants import (CALIBRATOR_STAGES, FLUX_CALIBRATOR_SOURCES,
+                       FLUXCAL_DIR, POLNCAL_DIR, PULSAR_DIR, PULSAR_STAGES,
+                       PULSAR_TYPES, SCRATCH_DIR, STAGE_DONE, STAGE_FAILED,
+                       STAGE_READY, STAGE_RUNNING, STAGE_WAITING)
+from db_migrations import (SCHEMA_VERSION, create_modified_triggers,
+                           set_schema_version, upgrade_database)
 from exceptions import IncorrectInputsException
-from gen_utils import get_utc_string
+from gen_utils import get_utc_string, process_exists
 from log import Logger
 
 Base = declarative_base()
 
+# seconds of the first and the longest wait between retries on a locked database
+RETRY_BASE_DELAY = 0.1
+RETRY_MAX_DELAY = 30
+
+
+class PipelinePath(TypeDecorator):
+	"""
+	A path column. Paths under the pipeline root, the directory of the database file, are stored
+	relative to it and read back as absolute paths, which keeps the rows short and lets the root
+	be moved without rewriting them. Other paths (e.g. the original files) are stored as they are.
+	DBManager sets the root when it opens the database.
+	"""
+	impl = String
+	cache_ok = True
+
+	root = None
+	# the root as it may be spelt in the paths given, e.g. also through a symlinked directory
+	root_prefixes = ()
+
+	@classmethod
+	def set_root(cls, root):
+		cls.root = os.path.realpath(root)
+		cls.root_prefixes = tuple(set(p + os.sep for p in (cls.root, os.path.abspath(root))))
+
+	def process_bind_param(self, value, dialect):
+		if value is None:
+			return None
+		value = str(value)
+		for prefix in PipelinePath.root_prefixes:
+			if value.startswith(prefix):
+				return value[len(prefix):]
+		return value
+
+	def process_result_value(self, value, dialect):
+		if value is None or PipelinePath.root is None or os.path.isabs(value):
+			return value
+		return os.path.join(PipelinePath.root, value)
+
+
+# header fields an observation takes from its first chunk
+OBSERVATION_FIELDS = ['nchan', 'nsubint', 'nbin', 'npol', 'cfreq', 'bw', 'source', 'backend', 'telescope', 'obs_start_utc', 'obs_type']
+
 class Collection(Base):
 	__tablename__="collections"
 
 	id = Column(Integer, primary_key=True)
 	collection_name = Column(String, nullable=False)
-	collection_path = Column(String, nullable=False)
+	collection_path = Column(PipelinePath, nullable=False)
 	pid = Column(String, nullable=False)
 	description = Column(String)
 	observation_chunks = relationship(
 		"ObservationChunk", back_populates="collection")
 	name_alias = Column(String, nullable=False)
+	modified = Column(Integer) # set by the triggers of db_migrations.create_modified_triggers
+
+	# the natural keys are unique, so that concurrent ingestions can insert with ON CONFLICT DO NOTHING
+	__table_args__ = (
+		Index('ix_collections_path_pid_alias', 'collection_path', 'pid', 'name_alias', unique=True),
+		Index('ix_collections_modified', 'modified'),
+	)
 
 	def __repr__(self):
 		return "<Collections (name='%s', pid='%s', description='%s'>" % (self.collection_name, self.description)
@@ -61,25 +124,23 @@ class Observation(Base):
 	cfreq = Column(Float, nullable=False)
 	backend = Column(String, nullable=False)
 	telescope = Column(String, nullable=False)	
-	psradded_file = Column(String)
+	psradded_file = Column(PipelinePath)
 	decimated = Column(Boolean, nullable=False, default=False)
 	processed = Column(Boolean, nullable=False, default=False)
+	modified = Column(Integer) # set by the triggers of db_migrations.create_modified_triggers
+
+	# existing databases get new indexes through db_migrations
+	__table_args__ = (
+		Index('ix_observations_type_processed_slurm', 'obs_type', 'processed', 'slurm_id'),
+		Index('ix_observations_start_cfreq_source', 'obs_start_utc', 'cfreq', 'source', unique=True),
+		Index('ix_observations_modified', 'modified'),
+	)
 
 	def __init__(self, observation_chunks):
 		self.observation_chunks = observation_chunks
 		observation_chunk = observation_chunks[0]
-		self.nchan = observation_chunk.nchan
-		self.nsubint = observation_chunk.nsubint
-		self.nbin = observation_chunk.nbin
-		self.npol = observation_chunk.npol
-		self.cfreq = observation_chunk.cfreq
-		self.bw = observation_chunk.bw
-		self.source = observation_chunk.source
-		self.cfreq = observation_chunk.cfreq
-		self.backend = observation_chunk.backend
-		self.telescope = observation_chunk.telescope
-		self.obs_start_utc = observation_chunk.obs_start_utc
-		self.obs_type = observation_chunk.obs_type
+		for field in OBSERVATION_FIELDS:
+			setattr(self, field, getattr(observation_chunk, field))
 		
 	def is_flux_cal(self):
 		return self.source in FLUX_CALIBRATOR_SOURCES
@@ -111,15 +172,20 @@ class ObservationChunk(Base):
 	end_mjd = Column(Float, nullable=False)
 	file_size=Column(BigInteger, nullable=False)
 	obs_type = Column(String, nullable=False)
-	original_file = Column(String, nullable=False)
-	sym_file = Column(String, nullable=False)
+	original_file = Column(PipelinePath, nullable=False)
+	sym_file = Column(PipelinePath, nullable=False)
 	processed = Column(Boolean, nullable=False, default=False)
-	preprocessed_file = Column(String)
-	cleaned_file = Column(String)
-	calibrated_file = Column(String)
-	recleaned_file = Column(String)
+	preprocessed_file = Column(PipelinePath)
+	cleaned_file = Column(PipelinePath)
+	calibrated_file = Column(PipelinePath)
+	recleaned_file = Column(PipelinePath)
+
+	def __init__(self, ar = None, original_file_path = None, sym_file_path = None, obs_start_utc = None, **kwargs):
+		if ar is None:
+			# a chunk given by its column values, e.g. from a work manifest
+			super().__init__(**kwargs)
+			return
 
-	def __init__(self, ar, original_file_path = None, sym_file_path = None, obs_start_utc = None):
 		self.nchan = ar.get_nchan()
 		self.nsubint = ar.get_nsubint()
 		self.nbin = ar.get_nbin()
@@ -142,6 +208,19 @@ class ObservationChunk(Base):
 
 	observation_id = Column(Integer, ForeignKey('observations.id'), nullable=False)
 	observation = relationship("Observation")
+	modified = Column(Integer) # set by the triggers of db_migrations.create_modified_triggers
+
+	# in pipeline order, not by name; the calibrator stages are the first of the pulsar stages
+	stages = relationship("ChunkStage", back_populates="observation_chunk",
+						  order_by=lambda: case({name: i for i, name in enumerate(PULSAR_STAGES)}, value=ChunkStage.stage, else_=len(PULSAR_STAGES)))
+	header = relationship("ChunkHeader", back_populates="observation_chunk", uselist=False)
+
+	__table_args__ = (
+		Index('ix_observation_chunks_observation_id', 'observation_id'),
+		Index('ix_observation_chunks_collection_id', 'collection_id'),
+		Index('ix_observation_chunks_original_file', 'original_file', unique=True),
+		Index('ix_observation_chunks_modified', 'modified'),
+	)
 
 
 
@@ -157,6 +236,12 @@ class ObservationChunk(Base):
 	def is_pulsar(self):
 		return self.obs_type == 'Pulsar'
 
+	def get_stage(self, name):
+		for stage in self.stages:
+			if stage.stage == name:
+				return stage
+		return None
+
 	def construct_output_path(self,root_dir_path, process_str):
 		if self.is_flux_cal():
 			out_root_dir = FLUXCAL_DIR
@@ -194,25 +279,150 @@ class ObservationChunk(Base):
 
 
 
+class WriteBatch(object):
+	""" Changes added to the session by DBManager.add_to_db since the last commit of a batch """
+
+	def __init__(self, max_size, max_interval):
+		self.max_size = max_size
+		self.max_interval = max_interval
+		self.reset()
+
+	def reset(self):
+		self.pending = 0
+		self.started = None
+
+	def add(self, n):
+		if self.started is None:
+			self.started = time.monotonic()
+		self.pending += n
+
+	def is_due(self):
+		return self.pending >= self.max_size or (self.started is not None and time.monotonic() - self.started >= self.max_interval)
+
+
+class ChunkHeader(Base):
+	"""
+	Header values of a chunk beyond those of observation_chunks, read once at ingestion (see
+	archive_header.get_header_summary), so that nothing has to open an archive for its metadata.
+	basis and state are FD_POLN and POL_TYPE for PSRFITS files. Evenly spaced channels are kept
+	as the first frequency and the channel width, others as chan_freqs.
+	"""
+	__tablename__="chunk_headers"
+
+	chunk_id = Column(Integer, ForeignKey('observation_chunks.id'), primary_key=True)
+	dm = Column(Float)
+	rm = Column(Float)
+	period = Column(Float)
+	tsubint = Column(Float)
+	receiver = Column(String)
+	basis = Column(String)
+	state = Column(String)
+	chan_freq = Column(Float)
+	chan_bw = Column(Float)
+	chan_freqs = Column(LargeBinary)
+
+	observation_chunk = relationship("ObservationChunk", back_populates="header")
+
+	def get_frequencies(self):
+		""" Channel centre frequencies in MHz, or None if the header had none """
+		if self.chan_freqs is not None:
+			return np.frombuffer(self.chan_freqs, dtype='<f8')
+		if self.chan_freq is None:
+			return None
+		return self.chan_freq + (self.chan_bw or 0.0) * np.arange(self.observation_chunk.nchan)
+
+	def __repr__(self):
+		return "<ChunkHeader (chunk_id = {}, dm = {}, rm = {}, period = {}, receiver = {})>".format(self.chunk_id, self.dm, self.rm, self.period, self.receiver)
+
+
+def get_stage_names(obs_type):
+	""" The processing stages of a chunk of the given type, in order """
+	return PULSAR_STAGES if obs_type in PULSAR_TYPES else CALIBRATOR_STAGES
+
+
+class ChunkStage(Base):
+	"""
+	State of one processing stage of one chunk. The rows of a chunk are made when it is ingested:
+	its first stage ready and the others waiting, each becoming ready when the one before is done.
+	What can run next is then one indexed query on (state, stage), see DBManager.get_ready_stages.
+	Times are seconds since the epoch, and host and pid are those of the process that last ran it.
+	"""
+	__tablename__="chunk_stages"
+
+	chunk_id = Column(Integer, ForeignKey('observation_chunks.id'), primary_key=True)
+	stage = Column(String, primary_key=True)
+	state = Column(String, nullable=False)
+	attempts = Column(Integer, nullable=False, default=0)
+	start_time = Column(Float)
+	end_time = Column(Float)
+	host = Column(String)
+	pid = Column(Integer)
+	output_file = Column(PipelinePath)
+	modified = Column(Integer) # set by the triggers of db_migrations.create_modified_triggers
+
+	observation_chunk = relationship("ObservationChunk", back_populates="stages")
+
+	# existing databases get new tables and indexes through db_migrations
+	__table_args__ = (
+		Index('ix_chunk_stages_state_stage', 'state', 'stage'),
+		Index('ix_chunk_stages_modified', 'modified'),
+	)
+
+	@staticmethod
+	def initial_rows(chunk_id, obs_type):
+		return [dict(chunk_id=chunk_id, stage=name, state=STAGE_READY if i == 0 else STAGE_WAITING, attempts=0)
+				for i, name in enumerate(get_stage_names(obs_type))]
+
+	def start(self):
+		self.state = STAGE_RUNNING
+		self.attempts = (self.attempts or 0) + 1
+		self.start_time = time.time()
+		self.end_time = None
+		self.host = socket.gethostname()
+		self.pid = os.getpid()
+
+	def finish(self, output_file):
+		""" Marks the stage done, and returns the next stage of the chunk, now ready, if there is one """
+		self.state = STAGE_DONE
+		self.end_time = time.time()
+		self.output_file = output_file
+
+		names = get_stage_names(self.observation_chunk.obs_type)
+		if self.stage not in names or names.index(self.stage) + 1 == len(names):
+			return None
+
+		next_stage = self.observation_chunk.get_stage(names[names.index(self.stage) + 1])
+		if next_stage is not None and next_stage.state == STAGE_WAITING:
+			next_stage.state = STAGE_READY
+		return next_stage
+
+	def fail(self):
+		self.state = STAGE_FAILED
+		self.end_time = time.time()
+
+	def __repr__(self):
+		return "<ChunkStage (chunk_id = {}, stage = {}, state = {}, attempts = {})>".format(self.chunk_id, self.stage, self.state, self.attempts)
+
+
 class DBManager(object):
 
 	__instance = None
 
 	@staticmethod
-	def get_instance(db_path = None):
+	def get_instance(db_path = None, db_config = None):
 		logger = Logger.get_instance()
 
 		""" Static access method. """
 		if DBManager.__instance is None:
 			logger.debug("creating new DB manager instance..")
-			DBManager.__instance = DBManager(db_path)
+			DBManager.__instance = DBManager(db_path, db_config)
 		else:
 			logger.debug("Using existing DB Manager instance..")
 
 		return DBManager.__instance
 
 
-	def __init__(self, db_path):
+	def __init__(self, db_path, db_config = None):
 
 		if db_path is None:
 			raise IncorrectInputsException("DB path is none")
@@ -220,32 +430,236 @@ class DBManager(object):
 		elif type(db_path) is str:
 			db_path = Path(db_path)
 
+		PipelinePath.set_root(db_path.absolute().parent.as_posix())
 		db_path = db_path.resolve().as_posix()
+		self.db_path = db_path
 		open(db_path, 'a').close()
 
 		self.logger = Logger.get_instance()
 		self.logger.debug("Opening {} ".format(db_path ))
 
+		self.db_config = db_config if db_config is not None else DBConfig()
+
 		self._engine = create_engine('sqlite+pysqlite:////{}?check_same_thread=False'.format(
-			db_path), echo=False, future=True, connect_args={'timeout': 600})
-		self._Session = sessionmaker(bind=self._engine)	
+			db_path), echo=False, future=True, connect_args={'timeout': self.db_config.busy_timeout})
+		event.listen(self._engine, "connect", self._set_pragmas)
+		self.query_count = 0
+		# the listener runs for every statement, so queries are only counted when they are logged
+		if any(handler.level <= logging.DEBUG for handler in self.logger.handlers):
+			self.count_queries()
+
+		# without autoflush, changes only reach the DB (and take its write lock) in add_to_db,
+		# never in a query made while psrchive is working on a chunk. Objects are not expired
+		# on commit, so that the chunks and collections loaded with the observations (see
+		# with_chunks) are not loaded again one by one after every commit.
+		self._Session = sessionmaker(bind=self._engine, autoflush=False, expire_on_commit=False)	
 		self._current_session = None
+		self._batch = None
+
+		self._retry(lambda: upgrade_database(self._engine), "upgrading the database")
+
+
+	def _set_pragmas(self, dbapi_connection, connection_record):
+		cursor = dbapi_connection.cursor()
+		# changing, or even reading, the journal mode needs a lock, which a new connection can find busy
+		journal_mode = self._retry(lambda: cursor.execute("PRAGMA journal_mode = {}".format(self.db_config.journal_mode)).fetchone()[0],
+								   "setting the journal mode")
+		if journal_mode.upper() != str(self.db_config.journal_mode).upper():
+			self.logger.warn("Could not set journal_mode = {}, using {}".format(self.db_config.journal_mode, journal_mode))
+		cursor.execute("PRAGMA synchronous = {}".format(self.db_config.synchronous))
+		cursor.execute("PRAGMA cache_size = {:d}".format(self.db_config.cache_size))
+		cursor.execute("PRAGMA mmap_size = {:d}".format(self.db_config.mmap_size))
+		cursor.close()
+
+
+	def _count_query(self, conn, cursor, statement, parameters, context, executemany):
+		self.query_count += 1
+
+
+	def count_queries(self):
+		""" Counts the SQL statements run from now on in query_count """
+		if not event.contains(self._engine, "before_cursor_execute", self._count_query):
+			event.listen(self._engine, "before_cursor_execute", self._count_query)
+
+
+	def log_query_count(self, what):
+		""" Logs the number of SQL statements run so far, to check that it does not grow with the number of chunks """
+		if not event.contains(self._engine, "before_cursor_execute", self._count_query):
+			return
+		self.logger.debug("{} SQL statements run after {}".format(self.query_count, what))
+
+
+	def get_ready_stages(self, stage=None, max_attempts=None):
+		""" The chunk stages that can run now (ready, or failed fewer than max_attempts times), optionally of one stage only """
+		query = self.get_session().query(ChunkStage)
+		if max_attempts is None:
+			query = query.filter(ChunkStage.state.in_([STAGE_READY, STAGE_FAILED]))
+		else:
+			query = query.filter((ChunkStage.state == STAGE_READY) | ((ChunkStage.state == STAGE_FAILED) & (ChunkStage.attempts < max_attempts)))
+		if stage is not None:
+			query = query.filter(ChunkStage.stage == stage)
+		return query
+
+
+	def fail_stale_stages(self):
+		"""
+		Marks failed the stages that a process which is gone left running, so that they can run again:
+		those on this host whose process no longer exists (e.g. after Ctrl-C or a crash), and any that
+		started more than the stage_timeout of the DB config ago (e.g. on a node that went down).
+		Returns the number of stages failed.
+		"""
+		session = self.get_session()
+		host = socket.gethostname()
+		oldest = time.time() - self.db_config.stage_timeout
+
+		# under the write lock, so that a stage that finishes meanwhile is not failed
+		self.begin_write()
+		stale = [chunk_stage for chunk_stage in session.query(ChunkStage).filter(ChunkStage.state == STAGE_RUNNING).populate_existing()
+				 if chunk_stage.start_time is None or chunk_stage.start_time < oldest
+				 or (chunk_stage.host == host and chunk_stage.pid is not None and not process_exists(chunk_stage.pid))]
+		for chunk_stage in stale:
+			self.logger.warn("{} of chunk {} was left running by {} (pid {}), marking it failed".format(
+				chunk_stage.stage, chunk_stage.chunk_id, chunk_stage.host, chunk_stage.pid))
+			chunk_stage.fail()
+		self.commit()
+		return len(stale)
+
+
+	def with_stages_to_run(self, query, max_attempts=None):
+		"""
+		Narrows an observation query to the observations with a chunk stage that can run now (see
+		get_ready_stages), or with all their stages done, e.g. still to be consolidated. Those whose
+		other stages are running elsewhere, or have failed max_attempts times, are left out.
+		"""
+		session = self.get_session()
+		ready_stages = (self.get_ready_stages(max_attempts=max_attempts).join(ChunkStage.observation_chunk)
+						.filter(ObservationChunk.observation_id == Observation.id))
+		unfinished_stages = (session.query(ChunkStage).join(ChunkStage.observation_chunk)
+							 .filter(ObservationChunk.observation_id == Observation.id, ChunkStage.state != STAGE_DONE))
+		return query.filter(ready_stages.exists() | ~unfinished_stages.exists())
+
+
+	@staticmethod
+	def with_chunks(query):
+		""" Loads the chunks of the observations of a query, with their collections and stages, with three more queries in all """
+		chunks = selectinload(Observation.observation_chunks)
+		return query.options(chunks.selectinload(ObservationChunk.collection), chunks.selectinload(ObservationChunk.stages))
+
+
+	def _retry(self, operation, description, backoff=True):
+		"""
+		Runs operation, retrying with jittered exponential backoff while the database is locked.
+		Without backoff, it is retried at once, e.g. while holding locks that others wait for.
+		"""
+		for attempt in range(self.db_config.max_retries + 1):
+			try:
+				return operation()
+			except (OperationalError, sqlite3.OperationalError) as e:
+				# errors of the driver itself in _set_pragmas, wrapped by sqlalchemy elsewhere
+				message = str(e.orig if isinstance(e, OperationalError) else e)
+				if ("locked" not in message and "busy" not in message) or attempt == self.db_config.max_retries:
+					raise
+				delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)) if backoff else 0
+				self.logger.warn("Database is locked while {}, retrying in {:.1f} s".format(description, delay))
+				time.sleep(delay)
+
+
+	def begin_write(self):
+		"""
+		Takes the write lock for the current session before anything is flushed, so that a busy
+		database is retried without losing the pending changes. Call it right before a commit,
+		to keep write transactions short.
+		"""
+		connection = self.get_session().connection()
+		if connection.connection.in_transaction:
+			return
+		self._retry(lambda: connection.exec_driver_sql("BEGIN IMMEDIATE"), "starting a write")
+
+
+	def begin_read(self):
+		"""
+		Starts a read transaction, so that all queries until the next commit or rollback see the
+		same state of the database. The driver only starts transactions before writes by itself.
+		"""
+		connection = self.get_session().connection()
+		if not connection.connection.in_transaction:
+			connection.exec_driver_sql("BEGIN")
 		
 
 	def init_database(self):
-		Base.metadata.create_all(self._engine, checkfirst=True)
+		with self._engine.begin() as connection:
+			Base.metadata.create_all(connection, checkfirst=True)
+			create_modified_triggers(connection)
+			set_schema_version(connection, SCHEMA_VERSION)
 
 
 	def add_to_db(self, objs):
 		session = self.get_session()
 
+		n = 0
 		try:
 			for x in objs:
 				session.add(x) 
+				n += 1
 		except TypeError:
 			session.add(objs)
-			
+			n = 1
+
+		if self._batch is None:
+			self.commit()
+			return
+
+		self._batch.add(n)
+		if self._batch.is_due():
+			self.flush()
+
+
+	def commit(self):
+		""" Commits the current session, retrying while the database is busy """
+		session = self.get_session()
+		self.begin_write()
+		session.flush()
+
+		# without WAL, COMMIT waits for the readers to finish and can be busy too. The transaction
+		# stays open when it is, so it is retried here, as the session would roll it back. The
+		# pending lock it keeps holds off new readers, so it is retried without waiting more.
+		connection = session.connection()
+		if connection.connection.in_transaction:
+			self._retry(lambda: connection.exec_driver_sql("COMMIT"), "committing", backoff=False)
 		session.commit()
+
+
+	@contextmanager
+	def batch(self, max_size=None, max_interval=None):
+		"""
+		Groups the add_to_db calls made inside it into one transaction, committed once max_size
+		objects were added or max_interval seconds passed (both from the DB config by default),
+		on flush() and when the batch ends, also if it ends with an exception. A batch opened
+		inside another one joins it, but still commits when it ends.
+
+		Thresholds are checked in add_to_db, so nothing is committed while the caller is busy.
+		"""
+		outer = self._batch
+		if outer is None:
+			self._batch = WriteBatch(max_size if max_size is not None else self.db_config.batch_size,
+									 max_interval if max_interval is not None else self.db_config.batch_interval)
+		try:
+			yield self._batch
+		finally:
+			try:
+				self.flush()
+			finally:
+				if outer is None:
+					self._batch = None
+
+
+	def flush(self):
+		""" Commits the changes pending in the current batch, e.g. at the end of a processing stage """
+		if self._batch is None or self._batch.pending == 0:
+			return
+		self.logger.debug("Committing {} changes".format(self._batch.pending))
+		self.commit()
+		self._batch.reset()
 		
 
 	def get_session(self):
@@ -0,0 +1,147 @@
+import argparse
+import datetime
+import os
+import sqlite3
+from pathlib import Path
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.types import TypeDecorator
+
+from config_parser import ConfigurationReader
+from db_orms import ChunkStage, Collection, DBManager, Observation, ObservationChunk
+from log import Logger
+
+CATALOG_FILE = "psrpype_catalog.sqlite3"
+
+# the tables copied to the catalog, which keeps their names, columns and primary keys
+CATALOG_TABLES = [Collection.__table__, Observation.__table__, ObservationChunk.__table__, ChunkStage.__table__]
+
+# the lookups readers of the catalog make
+CATALOG_INDEXES = [
+	"CREATE INDEX IF NOT EXISTS ix_observations_source_start ON observations (source, obs_start_utc)",
+	"CREATE INDEX IF NOT EXISTS ix_observation_chunks_observation_id ON observation_chunks (observation_id)",
+	"CREATE INDEX IF NOT EXISTS ix_chunk_stages_state_stage ON chunk_stages (state, stage)",
+]
+
+
+def get_args():
+	argparser = argparse.ArgumentParser(description="export a read-only catalog of the pipeline database",
+		formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	argparser.add_argument("--config", dest="config", help="config file", required=True)
+	argparser.add_argument("-o", "--output", dest="output", help="catalog file (default: {} in the pipeline root)".format(CATALOG_FILE))
+	argparser.add_argument("--full", dest="full", help="rebuild the catalog from scratch instead of updating it", action="store_true")
+
+	Logger.add_logger_argparse_options(argparser)
+
+	args = argparser.parse_args()
+	return args
+
+
+def _columns(table):
+	# the modified numbers only mean something in the pipeline database
+	return [c for c in table.columns if c.name != 'modified']
+
+
+def _column_type(column):
+	column_type = column.type.impl if isinstance(column.type, TypeDecorator) else column.type
+	return column_type.compile(dialect=sqlite.dialect())
+
+
+def create_catalog(catalog):
+	for table in CATALOG_TABLES:
+		columns = ", ".join("{} {}".format(c.name, _column_type(c)) for c in _columns(table))
+		primary_key = ", ".join(c.name for c in table.primary_key.columns)
+		catalog.execute("CREATE TABLE IF NOT EXISTS {} ({}, PRIMARY KEY ({}))".format(table.name, columns, primary_key))
+
+		# columns added to the database since the catalog was made
+		existing = [row[1] for row in catalog.execute("PRAGMA table_info({})".format(table.name))]
+		for column in _columns(table):
+			if column.name not in existing:
+				catalog.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table.name, column.name, _column_type(column)))
+
+	for statement in CATALOG_INDEXES:
+		catalog.execute(statement)
+
+	# the highest modified number exported from each table, and when and from where the catalog was last updated
+	catalog.execute("CREATE TABLE IF NOT EXISTS catalog_state (table_name TEXT PRIMARY KEY, modified INTEGER NOT NULL)")
+	catalog.execute("CREATE TABLE IF NOT EXISTS catalog_info (key TEXT PRIMARY KEY, value TEXT)")
+
+
+def _export_table(session, catalog, table, mark):
+	""" Copies the rows of a table modified after mark to the catalog, and drops rows deleted since. Returns the new mark and the number of rows copied. """
+	columns = _columns(table)
+	primary_key = list(table.primary_key.columns)
+
+	rows = session.execute(select(*columns, table.c.modified).where(table.c.modified > mark).order_by(table.c.modified)).all()
+	if len(rows) > 0:
+		catalog.executemany("INSERT OR REPLACE INTO {} ({}) VALUES ({})".format(table.name, ", ".join(c.name for c in columns), ", ".join("?" * len(columns))),
+							[tuple(row[:-1]) for row in rows])
+		mark = rows[-1][-1]
+
+	# rows are only deleted when duplicates are merged, which the counts are enough to notice
+	count = session.execute(select(func.count()).select_from(table)).scalar()
+	if catalog.execute("SELECT COUNT(*) FROM {}".format(table.name)).fetchone()[0] != count:
+		keys = set(tuple(row) for row in session.execute(select(*primary_key)))
+		stale = [key for key in catalog.execute("SELECT {} FROM {}".format(", ".join(c.name for c in primary_key), table.name)) if key not in keys]
+		catalog.executemany("DELETE FROM {} WHERE {}".format(table.name, " AND ".join("{} = ?".format(c.name) for c in primary_key)), stale)
+
+	return mark, len(rows)
+
+
+def export_catalog(db_manager, catalog_path, full=False):
+	"""
+	Brings the catalog at catalog_path up to date with the database, copying only the rows
+	modified since the last export. All tables are read in one read transaction and written in
+	one catalog transaction, so the catalog always shows one consistent state of the database,
+	and readers of the catalog never wait for the pipeline. With full, the catalog is rebuilt
+	in a new file that then replaces the old one.
+	"""
+	logger = Logger.get_instance()
+
+	catalog_path = Path(catalog_path).resolve()
+	write_path = catalog_path.with_name(catalog_path.name + ".tmp") if full else catalog_path
+	if full and write_path.exists():
+		write_path.unlink()
+
+	catalog = sqlite3.connect(write_path.as_posix(), timeout=600)
+	create_catalog(catalog)
+	marks = dict(catalog.execute("SELECT table_name, modified FROM catalog_state"))
+
+	session = db_manager.get_session()
+	db_manager.begin_read()
+	try:
+		with catalog:
+			for table in CATALOG_TABLES:
+				marks[table.name], count = _export_table(session, catalog, table, marks.get(table.name, 0))
+				logger.info("Exported {} changed rows of {}".format(count, table.name))
+
+			catalog.executemany("INSERT OR REPLACE INTO catalog_state (table_name, modified) VALUES (?, ?)", marks.items())
+			catalog.executemany("INSERT OR REPLACE INTO catalog_info (key, value) VALUES (?, ?)",
+								[('exported_at', datetime.datetime.utcnow().isoformat(timespec='seconds')),
+								 ('source', db_manager.db_path)])
+	finally:
+		session.rollback()
+
+	if full:
+		catalog.execute("VACUUM")
+	catalog.close()
+
+	if full:
+		os.replace(write_path, catalog_path)
+
+	logger.info("Catalog {} is up to date".format(catalog_path.as_posix()))
+
+
+def main():
+	args = get_args()
+	logger = Logger.get_instance(args)
+	config = ConfigurationReader(args.config).get_config()
+	db_manager = DBManager.get_instance(config.db_file, config.db_config)
+
+	output = args.output if args.output is not None else config.root_dir_path.joinpath(CATALOG_FILE)
+	export_catalog(db_manager, output, args.full)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,96 @@
+import os
+import sqlite3
+from pathlib import Path
+
+from log import Logger
+
+FILE_INDEX_SUFFIX = ".files.sqlite3"
+
+
+class FileIndex(object):
+	"""
+	Persistent index of the archive files that have already been ingested, keyed on
+	(path, size, mtime, inode). Lives next to the pipeline database so that re-ingesting a
+	collection can skip known, unchanged files without opening them. Also keeps the content
+	fingerprint of each file, to recognise new copies of data that was already ingested.
+	"""
+
+	def __init__(self, index_path):
+		self.logger = Logger.get_instance()
+		self.index_path = Path(index_path).resolve().as_posix()
+		self._connection = sqlite3.connect(self.index_path, timeout=600)
+		self._connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER NOT NULL, "
+									"mtime_ns INTEGER NOT NULL, inode INTEGER NOT NULL, fingerprint TEXT)")
+
+		# indices written before fingerprints were kept
+		columns = [row[1] for row in self._connection.execute("PRAGMA table_info(files)")]
+		if 'fingerprint' not in columns:
+			self._connection.execute("ALTER TABLE files ADD COLUMN fingerprint TEXT")
+		self._connection.commit()
+
+		self._files = {}
+		self._fingerprints = {}
+		for path, size, mtime_ns, inode, fingerprint in self._connection.execute("SELECT path, size, mtime_ns, inode, fingerprint FROM files"):
+			self._files[path] = (size, mtime_ns, inode)
+			if fingerprint is not None:
+				self._fingerprints.setdefault(fingerprint, path)
+		self._pending = {}
+		self._directories = {}
+		self.logger.debug("Loaded {} known files from {}".format(len(self._files), self.index_path))
+
+	@classmethod
+	def for_db(cls, db_file):
+		db_path = Path(db_file)
+		return cls(db_path.with_name(db_path.stem + FILE_INDEX_SUFFIX))
+
+	@staticmethod
+	def _key(file_name, stat_result=None):
+		if stat_result is None:
+			stat_result = os.stat(file_name)
+		return (stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino)
+
+	def _path(self, file_name):
+		"""
+		The path a file is indexed under: its resolved path, as Path.resolve() gives it, with each
+		directory resolved only once and a single lstat for the file itself.
+		"""
+		directory, name = os.path.split(os.path.abspath(file_name))
+		if directory not in self._directories:
+			self._directories[directory] = os.path.realpath(directory)
+		path = os.path.join(self._directories[directory], name)
+		return os.path.realpath(path) if os.path.islink(path) else path
+
+	def is_known(self, file_name, stat_result=None):
+		path = self._path(file_name)
+		known = self._files.get(path)
+		return known is not None and known == self._key(path, stat_result)
+
+	def find_fingerprint(self, fingerprint):
+		""" Returns the known file with the given fingerprint, if it still exists, else None """
+		path = self._fingerprints.get(fingerprint)
+		if path is None or not os.path.exists(path):
+			return None
+		return path
+
+	def add(self, file_name, stat_result=None, fingerprint=None):
+		path = self._path(file_name)
+		key = self._key(path, stat_result)
+		self._files[path] = key
+		self._pending[path] = key + (fingerprint,)
+		if fingerprint is not None:
+			self._fingerprints[fingerprint] = path
+
+	def save(self):
+		if len(self._pending) == 0:
+			return
+
+		with self._connection:
+			self._connection.executemany("INSERT OR REPLACE INTO files (path, size, mtime_ns, inode, fingerprint) VALUES (?, ?, ?, ?, ?)",
+										 [(path,) + row for path, row in self._pending.items()])
+
+		self.logger.debug("Saved {} files to {}".format(len(self._pending), self.index_path))
+		self._pending = {}
+
+	def close(self):
+		self.save()
+		self._connection.close()
@@ -6,15 +6,71 @@ from subprocess import call, PIPE, STDOUT
 from errno import ENOENT
 from log import Logger
 import time
-from astropy.time import Time
 import datetime
+import numpy as np
 import threading
 
 def get_nearest_even_number(number_int):
         return number_int if int(number_int) % 2 == 0 else number_int-1
 
+# UTC days whose last minute had a leap second (23:59:60)
+LEAP_SECOND_DATES = ["1972-06-30", "1972-12-31", "1973-12-31", "1974-12-31", "1975-12-31", "1976-12-31", "1977-12-31",
+                     "1978-12-31", "1979-12-31", "1981-06-30", "1982-06-30", "1983-06-30", "1985-06-30", "1987-12-31",
+                     "1989-12-31", "1990-12-31", "1992-06-30", "1993-06-30", "1994-06-30", "1995-12-31", "1997-06-30",
+                     "1998-12-31", "2005-12-31", "2008-12-31", "2012-06-30", "2015-06-30", "2016-12-31"]
+# the table is known to be complete up to this date, from IERS Bulletin C 70 (July 2025), which
+# announced no leap second at the end of December 2025. Update both from each new Bulletin C:
+# https://hpiers.obspm.fr/iers/bul/bulc/bulletinc.dat
+LEAP_SECONDS_VALID_UNTIL = "2026-06-28"
+MJD_EPOCH = np.datetime64("1858-11-17", "D")
+LEAP_SECOND_MJDS = (np.array(LEAP_SECOND_DATES, dtype="datetime64[D]") - MJD_EPOCH).astype(np.int64)
+LEAP_SECONDS_VALID_UNTIL_MJD = int((np.datetime64(LEAP_SECONDS_VALID_UNTIL, "D") - MJD_EPOCH).astype(np.int64))
+
+# warned once per process, as UTC strings are made in many small batches
+_leap_seconds_warned = False
+
+
+def _check_leap_seconds_valid(mjds):
+    global _leap_seconds_warned
+    if _leap_seconds_warned or len(mjds) == 0 or np.max(mjds) < LEAP_SECONDS_VALID_UNTIL_MJD:
+        return
+    _leap_seconds_warned = True
+    Logger.get_instance().warn("MJD {:.5f} is past {}, up to which the leap second table is known to be complete. "
+                               "UTC strings are wrong by a second after any leap second not in LEAP_SECOND_DATES: "
+                               "check IERS Bulletin C and update gen_utils".format(np.max(mjds), LEAP_SECONDS_VALID_UNTIL))
+
+
+def get_utc_strings(mjds):
+    """
+    Converts UTC MJDs to YYYY-MM-DD-HH:MM:SS strings, the same as astropy's isot rounded to the
+    millisecond and then cut at the second. Days that end with a leap second are 86401 s long.
+    Valid from 1972, when UTC started using leap seconds, to LEAP_SECONDS_VALID_UNTIL, past which
+    it warns.
+    """
+    mjds = np.atleast_1d(np.asarray(mjds, dtype=float))
+    _check_leap_seconds_valid(mjds)
+    days = np.floor(mjds).astype(np.int64)
+    day_lengths = 86400 + np.isin(days, LEAP_SECOND_MJDS).astype(np.int64)
+
+    milliseconds = np.floor((mjds - days) * day_lengths * 1000 + 0.5).astype(np.int64)
+
+    # rounding up to the millisecond can carry over into the next day
+    carry = milliseconds >= day_lengths * 1000
+    days[carry] += 1
+    milliseconds[carry] -= day_lengths[carry] * 1000
+
+    seconds = milliseconds // 1000
+    hours = np.minimum(seconds // 3600, 23)
+    minutes = np.minimum((seconds - hours * 3600) // 60, 59)
+    seconds = seconds - hours * 3600 - minutes * 60  # 60 during a leap second
+
+    dates = np.datetime_as_string(MJD_EPOCH + days.astype("timedelta64[D]"), unit="D")
+
+    return ["{}-{:02d}:{:02d}:{:02d}".format(d, h, m, s) for d, h, m, s in zip(dates.tolist(), hours.tolist(), minutes.tolist(), seconds.tolist())]
+
+
 def get_utc_string(mjd):
-    return Time(mjd,format="mjd", scale="utc").isot.replace("T","-").split(".")[0]
+    return get_utc_strings(mjd)[0]
 
 def split_and_strip(string, split_on):
     x = string.strip().split(split_on)
@@ -72,6 +128,35 @@ def run_subprocess(str_id, cmd_string, logger):
         log_subprocess_output(p.stdout)
     #exit_code = p.wait()
 
+def walk_archive_files(directory, extensions, recursive=False):
+    """ Yields the files in directory that end with one of extensions, listing each directory only once """
+    extensions = tuple(extensions)
+    sub_directories = []
+
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.startswith("."): # like glob, ignore hidden files
+                continue
+            if entry.is_file() and entry.name.endswith(extensions):
+                yield entry.path
+            elif recursive and entry.is_dir(follow_symlinks=False):
+                sub_directories.append(entry.path)
+
+    for sub_directory in sub_directories:
+        yield from walk_archive_files(sub_directory, extensions, recursive)
+
+
+def process_exists(pid):
+    """ Whether a process with this pid runs on this host """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError: # it exists, but belongs to another user
+        return True
+    return True
+
+
 def is_file_empty(file_name):
 
     return os.stat(file_name).st_size == 0
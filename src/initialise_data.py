@@ -1,16 +1,25 @@
-import glob, argparse, datetime, sys
+import argparse, datetime, os, sys
 import numpy as np
 from pathlib import Path, PurePath
-import psrchive as ps
 from log import Logger
 import numpy.lib.recfunctions as rfn
 from config_parser import ConfigurationReader
-from db_orms import DBManager, Collection, Observation, ObservationChunk
-from gen_utils import get_utc_string
-from itertools import groupby
+from db_orms import DBManager, Collection, Observation, ObservationChunk, ChunkStage, ChunkHeader, OBSERVATION_FIELDS
+from sqlalchemy import insert, select, func, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from archive_header import load_archive_header, get_header_summary, HEADER_FIELDS
+from file_index import FileIndex
+from times_index import TimesIndex, TIMES_FILE, group_chunks
+from gen_utils import get_utc_strings, walk_archive_files
+from functools import partial
+from multiprocessing import Pool
 
-TIMES_FILE="times.dat"
 TOLERANCE=0.00010 # < 10 seconds in MJD
+SCAN_CHUNK_SIZE=16 # files handed to a scan worker at a time
+READ_BACK_BATCH_SIZE=500 # keys per query when reading back the ids of new observations
+
+# FileInfo values that go into its observation_chunks row as they are
+CHUNK_FIELDS = ('backend', 'source', 'telescope', 'obs_type', 'cfreq', 'bw', 'nchan', 'nsubint', 'nbin', 'npol', 'file_size', 'start_mjd', 'end_mjd')
 
 
 def get_args():
@@ -24,9 +33,14 @@ def get_args():
 	group.add_argument("--dir_list", dest="dir_list", help="a list file containing PID DIR ALT_NAME per line", default=argparse.SUPPRESS)
 
 	argparser.add_argument("-e", "--extensions", dest="extensions", help="comma separated extensions of archive files to use", default=".ar,.cf,.rf,.zcf,.zrf")
+	argparser.add_argument("-p", "--prefer", dest="prefer", help="comma separated extensions, most preferred first, deciding which of several copies of the same data is ingested", default=".rf,.cf,.ar,.zrf,.zcf")
+	argparser.add_argument("-r", "--recursive", dest="recursive", help="also look for archive files in sub-directories", action="store_true")
 	argparser.add_argument("-b", "--backends", dest="backends", help="comma separated backends list to process, (default: ALL)")
 	argparser.add_argument("-s", "--sources", dest="sources", help="comma separated sources list to process, (default: ALL)")
 	argparser.add_argument("-c", "--centre_frequencies", dest="frequencies", help="comma separated centre frequencies list to process, (default: ALL)")
+	argparser.add_argument("-j", "--jobs", dest="jobs", help="number of processes used to read archive headers", type=int, default=1)
+	argparser.add_argument("--rescan", dest="rescan", help="re-read files that are already in the file index", action="store_true")
+	argparser.add_argument("--fill_headers", dest="fill_headers", help="also read the header summaries of chunks ingested before they were kept", action="store_true")
 	argparser.add_argument("--config", dest="config", help="config file", required=True)
 
 	Logger.add_logger_argparse_options(argparser)
@@ -38,42 +52,58 @@ def get_args():
 
 
 class FileInfo(object):
-	def __init__(self, file_name, archive):
-		self._file_name = file_name
-		self._backend = archive.get_backend_name()
-		self._source =  archive.get_source()
-		self._cfreq =  archive.get_centre_frequency()
-		self._start_mjd = archive.start_time().in_days()
-		self._end_mjd = archive.end_time().in_days()
-		self._observation_chunk = ObservationChunk(archive)
-
-	@property
-	def file_name(self):
-		return self._file_name
-
-	@property
-	def backend(self):
-		return self._backend
-
-	@property
-	def source(self):
-		return self._source
-
-	@property
-	def cfreq(self):
-		return self._cfreq
-
-	@property
-	def start_mjd(self):
-		return self._start_mjd
-
-	@property
-	def end_mjd(self):
-		return self._end_mjd
-
-	@property
-	def observation_chunk(self):
-		return self._observation_chunk		
+	"""
+	Header values of one archive file, as needed to group it and insert its chunk. Kept small,
+	as ingestion holds one per file of the collection: no __dict__, and the strings shared by
+	many files (source, backend, ...) are interned, also when unpickled from a scan worker.
+	header holds the archive_header.HEADER_FIELDS values that go into its chunk_headers row.
+	"""
+
+	__slots__ = ('file_name', 'backend', 'source', 'telescope', 'obs_type', 'cfreq', 'bw', 'nchan', 'nsubint',
+				 'nbin', 'npol', 'file_size', 'start_mjd', 'end_mjd', 'fingerprint', 'header')
+
+	def __init__(self, file_name, backend, source, telescope, obs_type, cfreq, bw, nchan, nsubint,
+				 nbin, npol, file_size, start_mjd, end_mjd, fingerprint=None, header=None):
+		self.file_name = file_name
+		self.backend = sys.intern(backend)
+		self.source = sys.intern(source)
+		self.telescope = sys.intern(telescope)
+		self.obs_type = sys.intern(obs_type)
+		self.cfreq = cfreq
+		self.bw = bw
+		self.nchan = nchan
+		self.nsubint = nsubint
+		self.nbin = nbin
+		self.npol = npol
+		self.file_size = file_size
+		self.start_mjd = start_mjd
+		self.end_mjd = end_mjd
+		self.fingerprint = fingerprint
+		self.header = tuple(sys.intern(v) if isinstance(v, str) else v for v in header) if header is not None else None
+
+	@classmethod
+	def from_archive(cls, file_name, archive):
+		return cls(file_name, archive.get_backend_name(), archive.get_source(), archive.get_telescope(), archive.get_type(),
+				   archive.get_centre_frequency(), archive.get_bandwidth(), archive.get_nchan(), archive.get_nsubint(),
+				   archive.get_nbin(), archive.get_npol(), Path(archive.get_filename()).stat().st_size/1e9,
+				   archive.start_time().in_days(), archive.end_time().in_days(),
+				   archive.get_fingerprint() if hasattr(archive, 'get_fingerprint') else None,
+				   get_header_summary(archive))
+
+	def __reduce__(self):
+		return (FileInfo, tuple(getattr(self, slot) for slot in self.__slots__))
+
+	def chunk_row(self, original_file, sym_file, obs_start_utc):
+		""" The observation_chunks row of this file, for bulk inserts """
+		row = {slot: getattr(self, slot) for slot in CHUNK_FIELDS}
+		row.update(original_file=original_file, sym_file=sym_file, obs_start_utc=obs_start_utc)
+		return row
+
+	def header_row(self, chunk_id):
+		""" The chunk_headers row of this file, for bulk inserts """
+		row = dict(zip(HEADER_FIELDS, self.header))
+		row['chunk_id'] = chunk_id
+		return row
 
 	def __repr__(self):
 		return self.__str__()
@@ -82,40 +112,196 @@ class FileInfo(object):
 		return "{} {} {} {} {} {} \n".format(self.file_name, self.backend, self.source, self.cfreq, self.start_mjd, self.end_mjd)
 
 
-def get_file_infos(file_list, backends, sources, frequencies):
+def read_file_info(file, backends, sources, frequencies):
+	""" Reads the header of one file and returns its FileInfo, or None if it is not shortlisted. Runs in the scan workers. """
 	logger = Logger.get_instance()
-	file_infos = []
-	float_freqencies = np.array(frequencies, dtype=np.float)
+	ar = load_archive_header(file, fingerprint=True)
 
-	for file in file_list:
-		ar = ps.Archive_load(file)
+	if(backends is not None and ar.get_backend_name() not in backends):
+		logger.debug("skipping {} as {} is not in backends list".format(ar.get_filename(),ar.get_backend_name() ))
+		return None
 
-		if(backends is not None and ar.get_backend_name() not in backends):
-			logger.debug("skipping {} as {} is not in backends list".format(ar.get_filename(),ar.get_backend_name() ))
-			continue
+	if(sources is not None and ar.get_source() not in sources):
+		logger.debug("skipping {} as {} is not in sources list".format(ar.get_filename(),ar.get_source() ))
+		return None
 
-		if(sources is not None and ar.get_source() not in sources):
-			logger.debug("skipping {} as {} is not in sources list".format(ar.get_filename(),ar.get_source() ))
-			continue
+	if(frequencies is not None and not np.any(np.isclose(ar.get_centre_frequency(),np.array(frequencies, dtype=float)))):
+		logger.debug("skipping {} as {} is not in centre freq list".format(ar.get_filename(),ar.get_centre_frequency() ))			
+		return None
+
+	logger.debug("adding {} {} {}".format(ar.get_source(),ar.get_backend_name(),ar.get_centre_frequency()))
+	return FileInfo.from_archive(file, ar)
+
+
+def iter_file_infos(file_list, backends, sources, frequencies, jobs=1):
+	""" Yields the FileInfo of every shortlisted file, in the order of file_list. With jobs > 1 the headers are read in a process pool. """
+
+	read = partial(read_file_info, backends=backends, sources=sources, frequencies=frequencies)
 
-		if(frequencies is not None and not np.any(np.isclose(ar.get_centre_frequency(),float_freqencies))):
-			logger.debug("skipping {} as {} is not in centre freq list".format(ar.get_filename(),ar.get_centre_frequency() ))			
-			continue	
+	if jobs <= 1:
+		yield from (file_info for file_info in map(read, file_list) if file_info is not None)
+		return
 
-		file_infos.append(FileInfo(file, ar))
-		logger.debug("adding {} {} {}".format(ar.get_source(),ar.get_backend_name(),ar.get_centre_frequency()))
+	with Pool(processes=jobs) as pool:
+		for file_info in pool.imap(read, file_list, chunksize=SCAN_CHUNK_SIZE):
+			if file_info is not None:
+				yield file_info
 
-		del ar
+
+def get_file_infos(file_list, backends, sources, frequencies, jobs=1):
+	logger = Logger.get_instance()
+	file_infos = list(iter_file_infos(file_list, backends, sources, frequencies, jobs))
 	logger.debug("{} files added".format(len(file_infos)))
 	return file_infos
 
 
 
-def get_times_for_cfreq(file_name, cfreq):
-	times = np.loadtxt(file_name, dtype={'names': ('cfreq', 'mjd_start', 'utc_start', 'mjd_end', 'utc_end', 'utc_dir'),
-	                     'formats': (np.float, np.float, 'S32',  np.float, 'S32', 'S32')}) # UTC_START CFREQ MJD_END
-	times_for_cfreq = times[ times['cfreq'] == cfreq ] 
-	return times_for_cfreq
+def skip_known_files(file_list, file_index):
+	logger = Logger.get_instance()
+	for file in file_list:
+		if file_index.is_known(file):
+			logger.debug("skipping {} as it is already known".format(file))
+			continue
+		yield file
+
+
+def drop_duplicate_copies(file_infos, preferred_extensions, file_index):
+	"""
+	Keeps one file per content fingerprint: the copy that was ingested before if there is one,
+	else the one whose extension comes first in preferred_extensions (then the first found).
+	Files without a fingerprint are always kept. Returns the kept and the dropped FileInfos.
+	"""
+	logger = Logger.get_instance()
+
+	def rank(file_info):
+		file_ext = "".join(Path(file_info.file_name).suffixes)
+		return preferred_extensions.index(file_ext) if file_ext in preferred_extensions else len(preferred_extensions)
+
+	copies = {}
+	for file_info in file_infos:
+		if file_info.fingerprint is not None:
+			copies.setdefault(file_info.fingerprint, []).append(file_info)
+
+	preferred = {}
+	for fingerprint, group in copies.items():
+		ingested = file_index.find_fingerprint(fingerprint)
+		preferred[fingerprint] = ingested if ingested is not None else min(group, key=rank).file_name
+
+	kept, dropped = [], []
+	for file_info in file_infos:
+		if file_info.fingerprint is None or os.path.abspath(file_info.file_name) == os.path.abspath(preferred[file_info.fingerprint]):
+			kept.append(file_info)
+		else:
+			logger.info("skipping {} as it holds the same data as {}".format(file_info.file_name, preferred[file_info.fingerprint]))
+			dropped.append(file_info)
+
+	return kept, dropped
+
+
+def get_observation_ids(session):
+	""" Returns the ids of all observations in the DB, keyed by (obs_start_utc, cfreq, source) """
+	query = session.query(Observation.id, Observation.obs_start_utc, Observation.cfreq, Observation.source)
+	return {(utc, cfreq, source): id for id, utc, cfreq, source in query}
+
+
+def insert_collection(db_manager, collection_row, chunk_rows, observation_ids, file_infos):
+	"""
+	Inserts a collection with its chunks, their stages and headers, and any observations they start,
+	with one bulk insert per table in a single transaction. observation_ids is updated with the new
+	observations. file_infos gives the FileInfo of each chunk by its original_file.
+
+	Other processes may be ingesting into the same DB, so observation_ids can be out of date. Rows
+	are inserted with ON CONFLICT DO NOTHING on their natural keys and the ids then read back by key,
+	all under the write lock, so that rows another process inserted first are used instead of
+	duplicated. Chunks of files that are already in the DB are not inserted again, and observations
+	that gain chunks have to be consolidated again.
+	"""
+	logger = Logger.get_instance()
+	session = db_manager.get_session()
+	db_manager.begin_write()
+
+	max_chunk_id = session.execute(select(func.max(ObservationChunk.id))).scalar() or 0
+
+	session.execute(sqlite_insert(Collection).values(**collection_row).on_conflict_do_nothing())
+	collection_id = session.query(Collection.id).filter_by(collection_path=collection_row['collection_path'], pid=collection_row['pid'],
+															name_alias=collection_row['name_alias']).scalar()
+
+	new_observation_rows, new_observation_count = {}, 0
+	for chunk_row in chunk_rows:
+		key = (chunk_row['obs_start_utc'], chunk_row['cfreq'], chunk_row['source'])
+		if key not in observation_ids and key not in new_observation_rows:
+			new_observation_rows[key] = {field: chunk_row[field] for field in OBSERVATION_FIELDS}
+
+	if len(new_observation_rows) > 0:
+		new_observation_count = session.execute(sqlite_insert(Observation).on_conflict_do_nothing(), list(new_observation_rows.values())).rowcount
+		utcs = sorted(set(utc for utc, cfreq, source in new_observation_rows))
+		# in batches, as older SQLite builds allow only 999 parameters per statement
+		for i in range(0, len(utcs), READ_BACK_BATCH_SIZE):
+			query = (session.query(Observation.id, Observation.obs_start_utc, Observation.cfreq, Observation.source)
+					 .filter(Observation.obs_start_utc.in_(utcs[i:i + READ_BACK_BATCH_SIZE])))
+			observation_ids.update({(utc, cfreq, source): id for id, utc, cfreq, source in query})
+
+	for chunk_row in chunk_rows:
+		chunk_row['collection_id'] = collection_id
+		chunk_row['observation_id'] = observation_ids[(chunk_row['obs_start_utc'], chunk_row['cfreq'], chunk_row['source'])]
+
+	session.execute(sqlite_insert(ObservationChunk).on_conflict_do_nothing(), chunk_rows)
+
+	new_chunks = session.query(ObservationChunk.id, ObservationChunk.obs_type, ObservationChunk.original_file).filter(ObservationChunk.id > max_chunk_id).all()
+	stage_rows = [row for chunk_id, obs_type, original_file in new_chunks for row in ChunkStage.initial_rows(chunk_id, obs_type)]
+	if len(stage_rows) > 0:
+		session.execute(insert(ChunkStage), stage_rows)
+
+	header_rows = [file_infos[original_file].header_row(chunk_id) for chunk_id, obs_type, original_file in new_chunks
+				   if file_infos[original_file].header is not None]
+	if len(header_rows) > 0:
+		session.execute(insert(ChunkHeader), header_rows)
+
+	# as when duplicate observations are merged, see db_migrations._add_natural_keys
+	gained_chunks = select(ObservationChunk.observation_id).where(ObservationChunk.id > max_chunk_id)
+	consolidated = (Observation.processed == True) | (Observation.decimated == True) | (Observation.psradded_file != None)
+	reset = (update(Observation).where(Observation.id.in_(gained_chunks), consolidated)
+			 .values(processed=False, decimated=False, psradded_file=None).execution_options(synchronize_session="fetch"))
+	reset_count = session.execute(reset).rowcount
+
+	db_manager.commit()
+
+	if len(new_chunks) < len(chunk_rows):
+		logger.warn("{} chunks of {} were already in the DB and were not added again".format(len(chunk_rows) - len(new_chunks), collection_row['collection_name']))
+
+	if reset_count > 0:
+		logger.warn("{} observations that were already processed gained chunks from {}, and will be processed again".format(reset_count, collection_row['collection_name']))
+
+	logger.info("Added {} chunks and {} new observations for {}".format(len(new_chunks), new_observation_count, collection_row['collection_name']))
+
+
+def read_header_summary(file):
+	""" Returns the header summary of one file. Runs in the scan workers. """
+	return get_header_summary(load_archive_header(file))
+
+
+def fill_chunk_headers(db_manager, jobs=1):
+	""" Reads and inserts the header summaries of the chunks that have none, i.e. chunks ingested before they were kept """
+	logger = Logger.get_instance()
+	session = db_manager.get_session()
+
+	chunks = session.query(ObservationChunk.id, ObservationChunk.original_file).outerjoin(ObservationChunk.header).filter(ChunkHeader.chunk_id == None).all()
+	if len(chunks) == 0:
+		return
+
+	files = [original_file for chunk_id, original_file in chunks]
+	if jobs <= 1:
+		headers = list(map(read_header_summary, files))
+	else:
+		with Pool(processes=jobs) as pool:
+			headers = pool.map(read_header_summary, files, chunksize=SCAN_CHUNK_SIZE)
+
+	db_manager.begin_write()
+	session.execute(sqlite_insert(ChunkHeader).on_conflict_do_nothing(),
+					[dict(zip(HEADER_FIELDS, header), chunk_id=chunk_id) for (chunk_id, original_file), header in zip(chunks, headers)])
+	db_manager.commit()
+
+	logger.info("Added the header summaries of {} chunks".format(len(chunks)))
 
 
 def main():
@@ -124,8 +310,10 @@ def main():
 	args = get_args()
 	logger = Logger.get_instance(args)
 	config = ConfigurationReader(args.config).get_config()
-	db_manager = DBManager.get_instance(config.db_file)
+	db_manager = DBManager.get_instance(config.db_file, config.db_config)
 	session = db_manager.get_session()
+	file_index = FileIndex.for_db(config.db_file)
+	observation_ids = get_observation_ids(session)
 
 	#get pid_list, dap_id_list, alt_name_list from input
 	pid_list, dap_id_list, alt_name_list  = None, None, None
@@ -161,116 +349,96 @@ def main():
 	backends = args.backends.split(",") if args.backends is not None else None
 	sources = args.sources.split(",") if args.sources is not None else None
 	frequencies = args.frequencies.split(",") if args.frequencies is not None else None 
+	preferred_extensions = args.prefer.split(",")
 
 
 	for in_dir_path, dap_id, pid, alt_name in zip(in_dir_paths, dap_id_list, pid_list, alt_name_list):
 
 		dap_dir= in_dir_path.name
 
-		file_list = []
+		d = in_dir_path.resolve().as_posix()
+		logger.debug("looking for {} files in {}".format(args.extensions, d))
+		file_list = walk_archive_files(d, args.extensions.split(","), args.recursive)
 
-		for ext in args.extensions.split(","):
-			d = in_dir_path.resolve().as_posix()
-			logger.debug("looking for " + d + "/*"+ ext)
-			file_list.extend(glob.glob(d + "/*"+ ext)) 
+		# skip files that were ingested before and have not changed since
+		if not args.rescan:
+			file_list = skip_known_files(file_list, file_index)
 
 		#Get file infos and sort by start time. 
-		file_infos=get_file_infos(file_list, backends, sources, frequencies)
-		file_infos.sort(key=lambda x: x.cfreq)
+		file_infos=get_file_infos(file_list, backends, sources, frequencies, args.jobs)
 		logger.debug(file_infos)
 
+		# only ingest one of several copies of the same data, e.g. a .rf and its .zrf
+		file_infos, duplicates = drop_duplicate_copies(file_infos, preferred_extensions, file_index)
+		for file_info in duplicates:
+			file_index.add(file_info.file_name)
 
+		collection_row = dict(collection_name = dap_dir, name_alias = alt_name, pid=pid, collection_path=in_dir_path.resolve().as_posix())
+		chunk_rows = []
+		chunk_file_infos = {}
+		times_indices = {}
 
-		collection = Collection(collection_name = dap_dir, name_alias = alt_name, pid=pid, collection_path=in_dir_path.resolve().as_posix())
-
-		file_info_groups = [list(g[1]) for g in groupby( file_infos, lambda o: o.cfreq)] 
-
-
-		for file_info_group in file_info_groups:
-
-			file_info_group.sort(key=lambda x: x.start_mjd)
-
-			for file_info in file_info_group:
-				logger.debug("considering {}".format(file_info.file_name))
-
-				file_path = Path(file_info.file_name)
-				file_ext = "".join(file_path.suffixes)
-
-
-				dap_path = out_dir.joinpath(pid).joinpath(file_info.source).joinpath(dap_dir+"_"+alt_name)
-				dap_path.mkdir(parents=True, exist_ok=True)
-
-				utc_start = get_utc_string(file_info.start_mjd) 
-				utc_end   = get_utc_string(file_info.end_mjd)
-
-				utc_dir = utc_start
-
-
-				times_file_path = dap_path.joinpath(TIMES_FILE).resolve()
-
-				if times_file_path.exists():
-
-					times_for_cfreq = get_times_for_cfreq(times_file_path, file_info.cfreq)
+		for source in set(f.source for f in file_infos):
+			dap_path = out_dir.joinpath(pid).joinpath(source).joinpath(dap_dir+"_"+alt_name)
+			dap_path.mkdir(parents=True, exist_ok=True)
+			times_indices[source] = TimesIndex(dap_path.joinpath(TIMES_FILE).resolve())
 
-					#check if the file is not empty, meaning there are files at this frequency
-					if times_for_cfreq.size is not 0:
+		# group the chunks of each source and centre frequency into observations
+		group_keys = sorted(set((f.source, f.cfreq) for f in file_infos))
+		key_codes = {key: i for i, key in enumerate(group_keys)}
+		codes = np.array([key_codes[(f.source, f.cfreq)] for f in file_infos], dtype=int)
+		start_mjds = np.array([f.start_mjd for f in file_infos], dtype=float)
+		end_mjds = np.array([f.end_mjd for f in file_infos], dtype=float)
+		initial_ends = np.array([times_indices[source].latest_end(cfreq) for source, cfreq in group_keys], dtype=float)
 
+		utc_starts = get_utc_strings(start_mjds)
+		utc_ends = get_utc_strings(end_mjds)
 
-						#if the files are the same - .rf vs .zrf, look if there are already UTCs with the same name
-						if times_for_cfreq[ times_for_cfreq['utc_dir'] == utc_dir.encode() ].size is not 0:
-							logger.info("Using existing utc_start=utc_dir for {}".format(utc_start))
+		# chunks that already have their own utc_dir (e.g. on --rescan) stay in it
+		known_dirs = [times_indices[f.source].has_utc_dir(f.cfreq, utc_start) for f, utc_start in zip(file_infos, utc_starts)]
 
+		labels, heads = group_chunks(codes, start_mjds, end_mjds, TOLERANCE, initial_ends, known_dirs)
 
-						else:
+		# the first chunk of a group may continue an observation from an earlier ingestion
+		utc_dirs = [times_indices[file_infos[head].source].find_utc_dir(file_infos[head].cfreq, start_mjds[head], utc_starts[head], TOLERANCE) for head in heads]
 
-							#current obs succeeds the previous ones as they are sorted, so mjd_start_now always > mjd_end_before, so this is always positive
-							times_for_cfreq = sorted(times_for_cfreq,key=lambda x: (file_info.start_mjd-x['mjd_end']))
+		for i in np.lexsort((start_mjds, codes)):
+			file_info = file_infos[i]
+			logger.debug("considering {}".format(file_info.file_name))
 
-							#if there is a very close UTC
-							if(file_info.start_mjd  - times_for_cfreq[0]['mjd_end'] < TOLERANCE):
-								utc_close = times_for_cfreq[0]['utc_start']
-								utc_dir = times_for_cfreq[0]['utc_dir'].decode() # change the utc directory to the start utc of the observation
+			file_path = Path(file_info.file_name)
+			file_ext = "".join(file_path.suffixes)
 
+			times_index = times_indices[file_info.source]
+			utc_start, utc_dir = utc_starts[i], utc_dirs[labels[i]]
+			times_index.add(file_info.cfreq, file_info.start_mjd, utc_start, file_info.end_mjd, utc_ends[i], utc_dir)
 
-				with open(times_file_path,'a') as f:
-					line="{:8.3f} {:20.12f} {} {:20.12f} {} {}\n".format(file_info.cfreq, file_info.start_mjd, utc_start, file_info.end_mjd, utc_end,  utc_dir)
-					logger.debug("writing to times.dat: {}".format(line))
-					f.write(line)
+			new_path = times_index.times_file_path.parent.joinpath(utc_dir).joinpath(str(file_info.cfreq))
+			new_path.mkdir(parents=True, exist_ok=True)
 
+			new_file_path = new_path.joinpath(utc_start + file_ext)
+			if not new_file_path.exists():
+				new_file_path.symlink_to(file_path)
+				chunk_rows.append(file_info.chunk_row(file_path.resolve().as_posix(), new_file_path.absolute().as_posix(), utc_dir))
+				chunk_file_infos[file_path.resolve().as_posix()] = file_info
+			else:
+				logger.warn("{} already exists, skipping...".format(new_file_path.resolve().as_posix() ))    
 
-				new_path = dap_path.joinpath(utc_dir).joinpath(str(file_info.cfreq))
-				new_path.mkdir(parents=True, exist_ok=True)
+			file_index.add(file_path, fingerprint=file_info.fingerprint)
 
-				new_file_path = new_path.joinpath(utc_start + file_ext)
-				if not new_file_path.exists():
-					new_file_path.symlink_to(file_path)
-					observation_chunk = file_info.observation_chunk
-					observation_chunk.sym_file = new_file_path.absolute().as_posix()
-					observation_chunk.original_file = file_path.resolve().as_posix()
-					observation_chunk.obs_start_utc = utc_dir
-					collection.observation_chunks.append(observation_chunk)
-				else:
-					logger.warn("{} already exists, skipping...".format(new_file_path.resolve().as_posix() ))    
+		if len(chunk_rows) > 0:
+			insert_collection(db_manager, collection_row, chunk_rows, observation_ids, chunk_file_infos)
 
-			session.add(collection)
-			
+		for times_index in times_indices.values():
+			times_index.save()
+		file_index.save()
 
 
-			# group observation chunks by start utc and add it to observations table
-			for group in [list(g[1]) for g in groupby(collection.observation_chunks, lambda o: o.obs_start_utc)]:
-				observation = None
-				with session.no_autoflush:
-					observation = db_manager.get_session().query(Observation).filter(
-						Observation.obs_start_utc == group[0].obs_start_utc).filter(Observation.cfreq == group[0].cfreq).first()
-					if observation is None:
-						observation = Observation(group)
-					else:
-						observation.observation_chunks.extend(group)
-					session.add(observation)
-			session.commit()
+	file_index.close()
 
+	if args.fill_headers:
+		fill_chunk_headers(db_manager, args.jobs)
 
-	session.commit()
 	print("All Done")
 
 
@@ -0,0 +1,146 @@
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from cal_utils import CalUtils
+from config_parser import ConfigurationReader
+from db_orms import get_stage_names
+from log import Logger
+from manifest import (SpoolWriter, get_chunk_spool_path, get_spool_path, load_chunk_rows, load_manifest, merge_spools,
+					  write_manifest)
+from processor import Processor
+from session import ObservingSession
+
+# the config of a worker process, read once by init_worker
+_config = None
+
+
+def init_worker(config_file, log_args):
+	global _config
+	Logger.get_instance(log_args)
+	_config = ConfigurationReader(config_file).get_config()
+
+
+def _process_chunk(manifest_file, chunk_id, spool_file):
+	""" Processes one chunk of the observation of a manifest, spooling the results to spool_file """
+	observation, manifest = load_manifest(manifest_file)
+	observation_chunk = [o for o in observation.observation_chunks if o.id == chunk_id][0]
+
+	spool = SpoolWriter(spool_file)
+	try:
+		observing_session = ObservingSession(_config, observation, spool)
+		observing_session.process_chunk(observation_chunk, in_memory=manifest.get('in_memory', False),
+										keep_intermediates=manifest.get('keep_intermediates', False), scratch=manifest.get('scratch', False))
+	finally:
+		spool.close()
+
+
+def run_chunk_stage(rows, stage, spool_file):
+	""" Runs one stage of the chunk of get_chunk_rows, spooling the results to spool_file """
+	observation_chunk = load_chunk_rows(rows)
+
+	spool = SpoolWriter(spool_file)
+	try:
+		Processor(_config, observation_chunk, spool).run_stage(stage)
+		if stage == get_stage_names(observation_chunk.obs_type)[-1]:
+			observation_chunk.processed = True
+	finally:
+		# the output columns and the new obs_type of calibrators, failed or not
+		spool.add_to_db(observation_chunk)
+		spool.close()
+
+
+def make_cal_db(cleaned_files, cal_type, cfreq, timestamp):
+	""" Makes the local calibrator DB of one kind and centre frequency, returning its path """
+	return CalUtils(_config).make_cal_db(cleaned_files, cal_type, cfreq, timestamp)
+
+
+def consolidate_observation(manifest_file):
+	""" Consolidates the observation of a manifest, whose chunks are all processed, spooling the results to the spool of the manifest """
+	observation, manifest = load_manifest(manifest_file)
+
+	spool = SpoolWriter(manifest['spool'])
+	try:
+		ObservingSession(_config, observation, spool).consolidate()
+		observation.processed = True
+		spool.add_to_db(observation)
+	finally:
+		spool.close()
+
+
+class LocalExecutor(object):
+	"""
+	Processes observations on this machine with a pool of worker processes, one chunk per task.
+	Like the slurm jobs, the workers never open the DB: they work from a manifest per observation
+	and spool their results, one spool file per task, which this process merges into the DB as
+	the tasks finish. An observation is consolidated, in one more task, once all its chunks are.
+	"""
+
+	def __init__(self, config_file, jobs, spool_dir, log_args, consolidate = False, in_memory = False, keep_intermediates = False, scratch = False):
+		self.logger = Logger.get_instance()
+		self.config_file = config_file
+		self.jobs = jobs
+		self.spool_dir = spool_dir
+		self.log_args = log_args
+		self.consolidate = consolidate
+		self.in_memory = in_memory
+		self.keep_intermediates = keep_intermediates
+		self.scratch = scratch
+
+	def _write_manifest(self, observation):
+		return write_manifest(self.spool_dir, observation, self.config_file, self.consolidate, self.in_memory, self.keep_intermediates, self.scratch)
+
+	def run(self, db_manager, observations):
+		"""
+		Processes the observations and returns the ones that failed. A chunk that fails leaves its
+		observation unprocessed, without stopping the other chunks and observations.
+		"""
+		remaining = {observation.id: len(observation.observation_chunks) for observation in observations}
+		failed = set()
+		tasks = {}
+		consolidations = set()
+
+		# spawned workers do not inherit the DB connections of this process
+		with ProcessPoolExecutor(max_workers=self.jobs, mp_context=multiprocessing.get_context("spawn"),
+								 initializer=init_worker, initargs=(self.config_file, self.log_args)) as executor:
+
+			for observation in observations:
+				manifest_file = self._write_manifest(observation)
+				for observation_chunk in observation.observation_chunks:
+					spool_file = get_chunk_spool_path(self.spool_dir, observation.id, observation_chunk.id).resolve().as_posix()
+					future = executor.submit(_process_chunk, manifest_file, observation_chunk.id, spool_file)
+					tasks[future] = (observation, spool_file)
+
+			self.logger.info("Submitted {} chunks of {} observations to {} local workers".format(len(tasks), len(observations), self.jobs))
+
+			while len(tasks) > 0:
+				done, _ = wait(tasks, return_when=FIRST_COMPLETED)
+
+				finished = [(future,) + tasks.pop(future) for future in done]
+				# the spools of failed tasks too, for their stage states
+				merge_spools(db_manager, [spool_file for future, observation, spool_file in finished])
+
+				for future, observation, spool_file in finished:
+					if future.exception() is not None:
+						self.logger.error("Processing {} {} {} failed: {}".format(observation.source, observation.obs_start_utc,
+																					 observation.cfreq, future.exception()))
+						failed.add(observation.id)
+
+					if future in consolidations:
+						continue
+
+					remaining[observation.id] -= 1
+					if remaining[observation.id] > 0 or observation.id in failed:
+						continue
+
+					if self.consolidate:
+						# the manifest again, now with the outputs of the chunks
+						future = executor.submit(consolidate_observation, self._write_manifest(observation))
+						tasks[future] = (observation, get_spool_path(self.spool_dir, observation.id).resolve().as_posix())
+						consolidations.add(future)
+					else:
+						observation.processed = True
+						db_manager.add_to_db(observation)
+
+		db_manager.log_query_count("processing {} observations locally".format(len(observations)))
+
+		return [observation for observation in observations if observation.id in failed]
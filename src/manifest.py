@@ -0,0 +1,233 @@
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+from sqlalchemy import and_, bindparam, update
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
+
+from db_orms import ChunkStage, Collection, Observation, ObservationChunk
+from log import Logger
+
+MANIFEST_VERSION = 2
+MANIFEST_SUFFIX = ".manifest.json"
+SPOOL_SUFFIX = ".spool"
+
+# the columns a worker can change, and so writes to its spool file
+SPOOL_COLUMNS = {
+	ObservationChunk.__tablename__: ['processed', 'obs_type', 'preprocessed_file', 'cleaned_file', 'calibrated_file', 'recleaned_file'],
+	Observation.__tablename__: ['processed', 'decimated', 'psradded_file'],
+	ChunkStage.__tablename__: ['state', 'attempts', 'start_time', 'end_time', 'host', 'pid', 'output_file'],
+}
+# the columns that identify the row to update
+SPOOL_KEYS = {
+	ObservationChunk.__tablename__: ['id'],
+	Observation.__tablename__: ['id'],
+	ChunkStage.__tablename__: ['chunk_id', 'stage'],
+}
+SPOOL_TABLES = {ObservationChunk.__tablename__: ObservationChunk.__table__, Observation.__tablename__: Observation.__table__,
+				ChunkStage.__tablename__: ChunkStage.__table__}
+SPOOL_CLASSES = {ObservationChunk.__tablename__: ObservationChunk, Observation.__tablename__: Observation, ChunkStage.__tablename__: ChunkStage}
+
+
+def _row(obj):
+	return {c.key: getattr(obj, c.key) for c in obj.__table__.columns}
+
+
+def get_manifest_path(spool_dir, observation_id):
+	return Path(spool_dir).joinpath("observation_{}{}".format(observation_id, MANIFEST_SUFFIX))
+
+
+def get_spool_path(spool_dir, observation_id):
+	return Path(spool_dir).joinpath("observation_{}{}".format(observation_id, SPOOL_SUFFIX))
+
+
+def get_chunk_spool_path(spool_dir, observation_id, chunk_id):
+	return Path(spool_dir).joinpath("observation_{}_chunk_{}{}".format(observation_id, chunk_id, SPOOL_SUFFIX))
+
+
+def write_manifest(spool_dir, observation, config_file, consolidate, in_memory=False, keep_intermediates=False, scratch=False):
+	"""
+	Writes everything a job needs to process an observation without the DB: the observation,
+	its chunks with their stages and collections, the config file and where to spool the results.
+	Returns the path of the manifest.
+	"""
+	Path(spool_dir).mkdir(parents=True, exist_ok=True)
+
+	manifest = {
+		'version': MANIFEST_VERSION,
+		'config': Path(config_file).resolve().as_posix(),
+		'consolidate': consolidate,
+		'in_memory': in_memory,
+		'keep_intermediates': keep_intermediates,
+		'scratch': scratch,
+		'spool': get_spool_path(spool_dir, observation.id).resolve().as_posix(),
+		'observation': _row(observation),
+		'chunks': [_row(o) for o in observation.observation_chunks],
+		'stages': [_row(s) for o in observation.observation_chunks for s in o.stages],
+		'collections': {str(o.collection_id): _row(o.collection) for o in observation.observation_chunks},
+	}
+
+	manifest_path = get_manifest_path(spool_dir, observation.id)
+	tmp_path = manifest_path.with_name(manifest_path.name + ".tmp")
+	with open(tmp_path, 'w') as f:
+		json.dump(manifest, f, indent=1)
+	os.replace(tmp_path, manifest_path)
+
+	return manifest_path.resolve().as_posix()
+
+
+def load_manifest(manifest_path):
+	"""
+	Returns the observation of a manifest, with its chunks and their stages and collections, as objects
+	that belong to no DB session, and the manifest itself.
+	"""
+	with open(manifest_path) as f:
+		manifest = json.load(f)
+
+	collections = {int(id): Collection(**row) for id, row in manifest['collections'].items()}
+
+	stages = {}
+	for row in manifest.get('stages', []):
+		stages.setdefault(row['chunk_id'], []).append(ChunkStage(**row))
+
+	observation_chunks = []
+	for row in manifest['chunks']:
+		observation_chunk = ObservationChunk(**row)
+		observation_chunk.collection = collections[observation_chunk.collection_id]
+		observation_chunk.stages = stages.get(observation_chunk.id, [])
+		observation_chunks.append(observation_chunk)
+
+	observation = Observation(observation_chunks)
+	for key, value in manifest['observation'].items():
+		setattr(observation, key, value)
+
+	return observation, manifest
+
+
+def get_chunk_rows(observation_chunk):
+	""" The rows a job needs to run the stages of one chunk without the DB: the chunk, its stages and its collection """
+	return {
+		'chunk': _row(observation_chunk),
+		'stages': [_row(s) for s in observation_chunk.stages],
+		'collection': _row(observation_chunk.collection),
+	}
+
+
+def load_chunk_rows(rows):
+	""" Returns the chunk of get_chunk_rows, with its stages and collection, as objects that belong to no DB session """
+	observation_chunk = ObservationChunk(**rows['chunk'])
+	observation_chunk.collection = Collection(**rows['collection'])
+	observation_chunk.stages = [ChunkStage(**row) for row in rows['stages']]
+	return observation_chunk
+
+
+class SpoolWriter(object):
+	"""
+	Stands in for DBManager in jobs that run from a manifest: add_to_db appends the result
+	columns of the objects to an append-only spool file, one JSON line per object, which the
+	coordinator merges into the DB with merge_spools.
+	"""
+
+	def __init__(self, spool_path):
+		self.logger = Logger.get_instance()
+		self.spool_path = Path(spool_path).resolve().as_posix()
+		self._file = open(self.spool_path, 'a')
+
+	def add_to_db(self, objs):
+		try:
+			objs = list(objs)
+		except TypeError:
+			objs = [objs]
+
+		for obj in objs:
+			table = obj.__tablename__
+			row = {column: getattr(obj, column) for column in SPOOL_KEYS[table] + SPOOL_COLUMNS[table]}
+			self._file.write(json.dumps({'table': table, 'row': row}) + "\n")
+			self._file.flush()
+
+	@contextmanager
+	def batch(self, max_size=None, max_interval=None):
+		try:
+			yield self
+		finally:
+			self.flush()
+
+	def flush(self):
+		self._file.flush()
+		os.fsync(self._file.fileno())
+
+	def close(self):
+		self.flush()
+		self._file.close()
+
+
+def read_spool(spool_path):
+	""" Returns the latest row written for each object in a spool file, keyed by the table and the SPOOL_KEYS of the row """
+	logger = Logger.get_instance()
+
+	rows = {}
+	with open(spool_path) as f:
+		for line in f:
+			try:
+				record = json.loads(line)
+			except ValueError:
+				# e.g. the last line of a job that was killed while writing it
+				logger.warn("Ignoring incomplete line in {}: {}".format(spool_path, line))
+				continue
+			table = record['table']
+			rows[(table,) + tuple(record['row'][key] for key in SPOOL_KEYS[table])] = record['row']
+
+	return rows
+
+
+def _refresh_merged(session, rows):
+	"""
+	Sets the merged rows on the objects of the session that they update, as the bulk updates bypass
+	them and objects are not expired on commit. Unlike expiring them, this needs no queries to load
+	them again, and leaves the other objects and the relationships loaded.
+	"""
+	for key, row in rows.items():
+		obj = session.identity_map.get(identity_key(SPOOL_CLASSES[key[0]], key[1:]))
+		if obj is None:
+			continue
+		for column in SPOOL_COLUMNS[key[0]]:
+			set_committed_value(obj, column, row[column])
+
+
+def merge_spools(db_manager, spool_paths):
+	"""
+	Applies the spool files of finished jobs to the DB, with one bulk update per table in a
+	single transaction, and then removes them.
+	"""
+	logger = Logger.get_instance()
+
+	spool_paths = [p for p in spool_paths if Path(p).exists()]
+	if len(spool_paths) == 0:
+		return
+
+	rows = {}
+	for spool_path in spool_paths:
+		rows.update(read_spool(spool_path))
+
+	session = db_manager.get_session()
+	db_manager.begin_write()
+
+	for table_name, table in SPOOL_TABLES.items():
+		params = [{'b_' + key: value for key, value in row.items()} for key, row in rows.items() if key[0] == table_name]
+		if len(params) == 0:
+			continue
+		statement = (update(table)
+						.where(and_(*[table.c[key] == bindparam('b_' + key) for key in SPOOL_KEYS[table_name]]))
+						.values({column: bindparam('b_' + column) for column in SPOOL_COLUMNS[table_name]}))
+		session.execute(statement, params)
+
+	db_manager.commit()
+	_refresh_merged(session, rows)
+
+	# the rows would be reapplied as they are if the next line fails, which is harmless
+	for spool_path in spool_paths:
+		os.remove(spool_path)
+
+	logger.info("Merged {} rows from {} spool files".format(len(rows), len(spool_paths)))
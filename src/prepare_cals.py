@@ -2,7 +2,6 @@ import glob, argparse, datetime, sys
 import numpy as np
 from pathlib import Path, PurePath
 import psrchive as ps
-from astropy.time import Time
 from log import Logger
 import numpy.lib.recfunctions as rfn
 from config_parser import ConfigurationReader
@@ -12,12 +11,10 @@ from gen_utils import split_and_strip,run_process,get_current_timestamp_String
 import clfd
 from clfd.interfaces import PsrchiveInterface
 from rfi_utils import *
-from constants import FLUX_CALIBRATOR_SOURCES, FLUXCAL_DIR, FLUXCAL_CLEANED_DIR, CALIBRATOR_TYPES,SCRATCH_DIR
-from cal_utils import CalUtils
+from constants import FLUX_CALIBRATOR_SOURCES, FLUXCAL_DIR, FLUXCAL_CLEANED_DIR, CALIBRATOR_TYPES,SCRATCH_DIR, CALIBRATOR_STAGES, FLUXCAL, POLNCAL
+from cal_utils import CalUtils, group_cal_chunks
 from processor import Processor
 from app_utils import AppUtils
-from exceptions import IncorrectFileHeaderException
-from itertools import groupby
 
 
 
@@ -26,30 +23,21 @@ def get_args():
 		formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
 	argparser.add_argument("--config", dest="config", help="config file", required=True)
+	argparser.add_argument("--max_attempts", dest="max_attempts", help="run failed stages again only if they have failed fewer times than this (default: always)", type=int)
 	AppUtils.add_shortlist_options(argparser)
 	Logger.add_logger_argparse_options(argparser)
 
 	args = argparser.parse_args()
 	return args 
 
-def group_by_freq(observations):
-	freq_obs = {}
-	for obs in observations: # obs object containing several chunks
-		freq_chunk_group = [list(g[1]) for g in groupby(
-				obs.observation_chunks, lambda o: o.cfreq)] # group chunks by frequency
-		for freq_chunks in freq_chunk_group:
-			in_dict_list = freq_obs.get(freq_chunks[0].cfreq, [])
-			in_dict_list.append(freq_chunks)
-			freq_obs[freq_chunks[0].cfreq] = in_dict_list
-	return freq_obs
-
 def main():
 
 	# get arguments, and with that initialise the logger, and obtain the config file and the DB session
 	args = get_args()
 	logger = Logger.get_instance(args)
 	config = ConfigurationReader(args.config).get_config()
-	db_manager = DBManager.get_instance(config.db_file)
+	db_manager = DBManager.get_instance(config.db_file, config.db_config)
+	db_manager.fail_stale_stages()
 	cal_utils = CalUtils(config)
 
 	# get the list of observations to process
@@ -57,73 +45,47 @@ def main():
 	query = query.filter(Observation.obs_type.in_(CALIBRATOR_TYPES))
 	query = query.filter(Observation.processed == False)
 	query = AppUtils.add_shortlist_filters(query, args)
+	query = db_manager.with_stages_to_run(query, args.max_attempts)
 
-	observations = query.all()
+	observations = db_manager.with_chunks(query).all()
+	db_manager.log_query_count("selecting {} observations".format(len(observations)))
 
-	fluxcal_observations = []
-	polncal_observations = []
-	
 	timestamp = get_current_timestamp_String() 
 
-	# process each observation
-	for observation in observations:
+	# process each observation, committing the chunks in batches and all of them before the calibrator DBs are made
+	with db_manager.batch():
+		for observation in observations:
+
+			# process each chunk if it is not already processed
+			for observation_chunk in [o for o in observation.observation_chunks if o.processed == False]:
+
+				logger.debug("considering {}".format(observation_chunk))
+
+				processor = Processor(config, observation_chunk)
+				processor.process(CALIBRATOR_STAGES)
+				observation_chunk.processed = True
+			
+				db_manager.add_to_db(observation_chunk)
+
+	db_manager.log_query_count("processing the calibrator chunks")
+
+	# one local DB per kind of calibrator and centre frequency, added to the global DB of its kind
+	cal_groups = group_cal_chunks(observations)
+
+	for cal_type in [FLUXCAL, POLNCAL]:
+		cfreqs = [cfreq for t, cfreq in cal_groups if t == cal_type]
+		if len(cfreqs) == 0:
+			logger.warning("No {} observations found".format("flux calibrator" if cal_type == FLUXCAL else "polarisation calibrator"))
 
-		# process each chunk if it is not already processed
-		for observation_chunk in [o for o in observation.observation_chunks if o.processed == False]:
-
-			logger.debug("considering {}".format(observation_chunk))
-
-			processor = Processor(config, observation_chunk)
-			processor.preprocess()
-			processor.clean()
-			observation_chunk.processed = True
-		
-			db_manager.add_to_db(observation_chunk)
-
-		# if observation is a fluxcal/polncal, add it to the list of fluxcals/polncals
-		if observation.is_flux_cal():
-			fluxcal_observations.append(observation)
-		elif observation.is_poln_cal():
-			polncal_observations.append(observation)
-		else:
-			raise IncorrectFileHeaderException("Unknown observation type {} in header of {}".format(observation.obs_type, observation.obs_source_utc))
-
-	# if there are fluxcals, add them to global list
-	if len(fluxcal_observations) > 0:	
-		freq_obs = group_by_freq(fluxcal_observations)
-
-		for cfreq, v in freq_obs.items():
-			logger.info("preparing flux calibrator for {} MHz".format(cfreq))
-			cleaned_files = []
-			for freq_chunks in v:
-				for chunk in freq_chunks:
-					cleaned_files.append(chunk.cleaned_file)
-			fluxcal_list = "{}_{}_fluxcal_list.txt".format(timestamp, cfreq)
-			local_db = cal_utils.create_cal_db(cleaned_files, fluxcal_list)
-			cal_utils.add_to_fluxcal_db(local_db, cfreq)
-	else:
-		logger.warning("No flux calibrator observations found")
-
-	# if there are polncals, add them to global list
-	if len(polncal_observations) > 0:
-		freq_obs = group_by_freq(polncal_observations)
-
-		for cfreq, v in freq_obs.items():
-			logger.info("preparing polarisation calibrator for {} MHz".format(cfreq))
-			cleaned_files = []
-			for freq_chunks in v:
-				for chunk in freq_chunks:
-					cleaned_files.append(chunk.cleaned_file)
-			polncal_list = "{}_{}_polncal_list.txt".format(timestamp, cfreq)
-			local_db = cal_utils.create_cal_db(cleaned_files, polncal_list)
-			cal_utils.add_to_polncal_db(local_db)	
-	else:
-		logger.warning("No polarisation calibrator observations found")		
+		for cfreq in cfreqs:
+			logger.info("preparing {} for {} MHz".format(cal_type, cfreq))
+			local_db = cal_utils.make_cal_db([chunk.cleaned_file for chunk in cal_groups[(cal_type, cfreq)]], cal_type, cfreq, timestamp)
+			cal_utils.add_cal_db(local_db, cal_type)
 
 	#mark observation as processed
 	for observation in observations:
 		observation.processed = True
-		db_manager.add_to_db(observation)
+	db_manager.add_to_db(observations)
 
  
 if __name__ == "__main__":
@@ -10,7 +10,6 @@ import clfd
 import numpy as np
 import numpy.lib.recfunctions as rfn
 import psrchive as ps
-from astropy.time import Time
 from clfd.interfaces import PsrchiveInterface
 from sqlalchemy import select
 
@@ -18,11 +17,13 @@ from app_utils import AppUtils
 from cal_utils import CalUtils
 from config_parser import ConfigurationReader
 from constants import (FLUX_CALIBRATOR_SOURCES, FLUXCAL_CLEANED_DIR,
-					   FLUXCAL_DIR, PULSAR_TYPES, SCRATCH_DIR)
+					   FLUXCAL_DIR, PULSAR_TYPES, SCRATCH_DIR, SPOOL_DIR)
 from db_orms import Collection, DBManager, ObservationChunk
 from gen_utils import (get_current_timestamp_String, run_process,
 					   split_and_strip)
 from log import Logger
+from local_executor import LocalExecutor
+from manifest import SpoolWriter, load_manifest, write_manifest
 from processor import Processor
 from rfi_utils import *
 from session import ObservingSession
@@ -37,6 +38,12 @@ def get_args():
 
 	argparser.add_argument("--with-slurm", dest="slurm", help="Queue with slurm", action='store_true')
 	argparser.add_argument("--consolidate", dest="consolidate", help="psradd recleaned files + produce decimated products", action='store_true')
+	argparser.add_argument("--in_memory", dest="in_memory", help="process each chunk in one pass, keeping its archive in memory between stages", action='store_true')
+	argparser.add_argument("--keep_intermediates", dest="keep_intermediates", help="with --in_memory, also write the preprocessed, cleaned and calibrated archives", action='store_true')
+	argparser.add_argument("--scratch", dest="scratch", help="write the intermediate archives to $TMPDIR, and only copy the recleaned archives to the pipeline root", action='store_true')
+	argparser.add_argument("-j", "--jobs", dest="jobs", help="without slurm, the number of chunks to process at the same time on this machine", type=int, default=1)
+	argparser.add_argument("--manifest", dest="manifest", help="process the observation of this work manifest without opening the DB, as done by the slurm jobs")
+	argparser.add_argument("--max_attempts", dest="max_attempts", help="run failed stages again only if they have failed fewer times than this (default: always)", type=int)
 
 	AppUtils.add_shortlist_options(argparser)
 	Logger.add_logger_argparse_options(argparser)
@@ -45,30 +52,44 @@ def get_args():
 	args = argparser.parse_args()
 	return args
 
+def process_manifest(config, manifest_file):
+	""" Processes the observation of a work manifest, writing the results to its spool file rather than to the DB """
+	logger = Logger.get_instance()
+
+	observation, manifest = load_manifest(manifest_file)
+	logger.info("Processing {} {} {} from {}".format(observation.source, observation.obs_start_utc, observation.cfreq, manifest_file))
+
+	spool = SpoolWriter(manifest['spool'])
+	observing_session = ObservingSession(config, observation, spool)
+	observing_session.process(consolidate=manifest['consolidate'], in_memory=manifest.get('in_memory', False),
+							  keep_intermediates=manifest.get('keep_intermediates', False), scratch=manifest.get('scratch', False))
+	observation.processed = True
+	spool.add_to_db(observation)
+	spool.close()
+
+
 def main():
 
 	# get arguments, and with that initialise the logger, and obtain the config file and the DB session
 	args = get_args()
 	logger = Logger.get_instance(args)
 	config = ConfigurationReader(args.config).get_config()
-	db_manager = DBManager.get_instance(config.db_file)
 
+	# jobs started from a work manifest never open the DB
+	if args.manifest is not None:
+		process_manifest(config, args.manifest)
+		return
 
-	# get the list of observations to process
-	query = db_manager.get_session().query(Observation).join(SlurmJob, Observation.slurm_id == SlurmJob.id, isouter=True)
-	query = query.filter(Observation.obs_type.in_(PULSAR_TYPES))
+	db_manager = DBManager.get_instance(config.db_file, config.db_config)
+	db_manager.fail_stale_stages()
 
-	# 1. processed is false, no slurm job attached
-	# 2. processed is false, slurm job is not running
-	# 3. processed is false, slurm job is failed
-	query = query.filter( ((Observation.processed == False) & (Observation.slurm_job == None))| 
-							((Observation.processed == False) & ((Observation.slurm_job != None) & (SlurmJob.state != 'RUNNING'))) |
-							((Observation.slurm_job != None) & 	((SlurmJob.state == 'FAILED') | (SlurmJob.state == 'OUT_OF_MEMORY'))) 
-						)
 
+	# get the list of observations to process
+	query = AppUtils.get_pulsars_to_process(db_manager, args.max_attempts)
 	query = AppUtils.add_shortlist_filters(query, args)
 
-	observations = query.all()	
+	observations = db_manager.with_chunks(query).all()	
+	db_manager.log_query_count("selecting {} observations".format(len(observations)))
 
 	if(len(observations) == 0):
 		logger.info("No observations to process")
@@ -85,35 +106,49 @@ def main():
 
 	if args.slurm: 
 		job_ids = []
+		spool_dir = config.root_dir_path.joinpath(SPOOL_DIR)
 		for observation in observations:
-			consolidate_flag= "--consolidate" if args.consolidate else ""
-			command = "python {} --config={} --obs_utcs=\"{}\" -c \"{}\" {} --stream_log_level=DEBUG".format(Path(__file__).resolve().as_posix(),
-																								Path(args.config).resolve().as_posix(), 
-                            observation.obs_start_utc, observation.cfreq, consolidate_flag)
+			# the job gets all it needs in a manifest, and spools its results for the slurm checker to merge
+			manifest_file = write_manifest(spool_dir, observation, args.config, args.consolidate, args.in_memory, args.keep_intermediates, args.scratch)
+			command = "python {} --config={} --manifest={} --stream_log_level=DEBUG".format(Path(__file__).resolve().as_posix(),
+																								Path(args.config).resolve().as_posix(), manifest_file)
 			job_id = slurm_launcher.launch(observation, command)
 			job_ids.append(job_id)
 			time.sleep(2)
 
 			slurm_job = SlurmJob(id=job_id, state="QUEUED")
 			observation.slurm_job = slurm_job
+			# committed before the next submission, so no queued job is missing from the DB if this process dies
 			db_manager.add_to_db([observation,slurm_job])
 
 		logger.info("All jobs submitted..")
+		db_manager.log_query_count("submitting the jobs")
 
-		slurm_checker = SlurmChecker(job_ids)
+		slurm_checker = SlurmChecker(job_ids, spool_dir)
 		SlurmChecker.signal_init()
 		slurm_checker.start()
 		slurm_checker.join()
 
 
+	elif args.jobs > 1:
+
+		# the workers spool their results, which only this process writes to the DB
+		local_executor = LocalExecutor(Path(args.config).resolve().as_posix(), args.jobs, config.root_dir_path.joinpath(SPOOL_DIR), args,
+									   args.consolidate, args.in_memory, args.keep_intermediates, args.scratch)
+		failed = local_executor.run(db_manager, observations)
+
+		if len(failed) > 0:
+			logger.error("{} of {} observations failed".format(len(failed), len(observations)))
+
 	else:
 
 		for observation in observations:
 			observing_session = ObservingSession(config, observation)
-			observing_session.process(consolidate=args.consolidate) 
+			observing_session.process(consolidate=args.consolidate, in_memory=args.in_memory, keep_intermediates=args.keep_intermediates, scratch=args.scratch)
 			observation.processed = True
 		
 		db_manager.add_to_db(observations)
+		db_manager.log_query_count("processing the observations")
 
 
 
@@ -1,18 +1,336 @@
 from log import Logger
 from db_orms import *
-from cal_utils import CalUtils
+from cal_utils import CalUtils, cal_db_digest
 from rfi_utils import Cleaner
 from gen_utils import run_process
+from stage_cache import file_digest, get_stage_key, is_current, read_stage_key, remove_output, write_stage_manifest
+from constants import (STAGE_CALIBRATE, STAGE_CLEAN, STAGE_DONE, STAGE_OUTPUT_COLUMNS,
+					   STAGE_OUTPUT_NAMES, STAGE_PREPROCESS, STAGE_RECLEAN, PULSAR_STAGES)
+import psrchive as ps
+import os
 import shutil
+import tempfile
+
+# the calibration options of pac, besides the calibrator DBs
+PAC_FLAGS = "-k 3.0 -S -T"
 
 class Processor(object):
 
-	def __init__(self, config, observation_chunk):
+	def __init__(self, config, observation_chunk, db_manager = None):
 		self.observation_chunk = observation_chunk
 		self.config = config
 		self.logger = Logger.get_instance()
-		self.db_manager = DBManager.get_instance()
-		self.cleaner = 	cleaner = Cleaner(self.config, 'clfd')
+		self.db_manager = db_manager if db_manager is not None else DBManager.get_instance()
+		self.cleaner = 	cleaner = Cleaner(self.config, 'clfd', self.config.rfi_tolerance)
+
+		# the keys of the outputs of the stages of the chunk, see stage_cache
+		self._stage_keys = {}
+
+		# where the stages write their outputs: the pipeline root, or a scratch copy of its tree
+		self.output_root_path = self.config.root_dir_path
+
+		# state of process_in_memory
+		self._archive = None
+		self._scratch_path = None
+		self._cleaned_path = None
+		self._keep_intermediates = False
+
+	def process(self, stages, scratch = False):
+		"""
+		Runs the stages of the chunk. With scratch, the stages write to a temporary directory
+		(under $TMPDIR, ideally node-local), and only the output of the last stage is copied to the
+		pipeline root, by an atomic rename. The other outputs are removed with the directory.
+		Chunks that already have an up to date output of the last stage are not processed again.
+		"""
+		if not scratch:
+			for name in stages:
+				self.run_stage(name)
+			return
+
+		# the stages before it would otherwise run again in the new scratch directory
+		if self._has_output(stages[-1]):
+			self.logger.warn("{} file exists, skipping all stages...".format(STAGE_OUTPUT_NAMES[stages[-1]].capitalize()))
+			# as preprocess would, for calibrator chunks ingested with the wrong type
+			if not self.observation_chunk.is_pulsar():
+				self.fix_cal_type()
+			for name in stages:
+				self.run_stage(name, lambda: None)
+			return
+
+		with tempfile.TemporaryDirectory(prefix="psrpype_") as scratch_dir:
+			self.output_root_path = Path(scratch_dir)
+			try:
+				for name in stages[:-1]:
+					self.run_stage(name)
+				self.run_stage(stages[-1], lambda: self._copy_back(stages[-1]))
+			finally:
+				for column in STAGE_OUTPUT_COLUMNS.values():
+					if self._in_scratch(getattr(self.observation_chunk, column)):
+						setattr(self.observation_chunk, column, None)
+				self.output_root_path = self.config.root_dir_path
+
+	def _in_scratch(self, file_name):
+		if file_name is None or self.output_root_path == self.config.root_dir_path:
+			return False
+		return Path(file_name).resolve().as_posix().startswith(self.output_root_path.resolve().as_posix() + "/")
+
+	def _copy_back(self, name):
+		""" Runs a stage in the scratch directory and copies its output to the same place under the pipeline root """
+		getattr(self, name)()
+
+		column = STAGE_OUTPUT_COLUMNS[name]
+		scratch_file_path = Path(getattr(self.observation_chunk, column))
+		if not self._in_scratch(scratch_file_path.as_posix()):
+			return
+
+		out_file_path = self.config.root_dir_path.joinpath(scratch_file_path.relative_to(self.output_root_path))
+		out_file_path.parent.mkdir(parents=True, exist_ok=True)
+
+		# readers of the pipeline root never see a partial file
+		tmp_file_path = out_file_path.with_name(out_file_path.name + ".tmp")
+		shutil.copyfile(scratch_file_path, tmp_file_path)
+		os.replace(tmp_file_path, out_file_path)
+
+		setattr(self.observation_chunk, column, out_file_path.resolve().as_posix())
+		self._record(name)
+		self.logger.debug("Copied {} to {}".format(scratch_file_path, out_file_path))
+
+	def _input_key(self):
+		""" The identity of the original file of the chunk, as ingested. obs_type is left out, as fix_cal_type changes it. """
+		input_key = {field: getattr(self.observation_chunk, field) for field in OBSERVATION_FIELDS if field != 'obs_type'}
+		input_key['file'] = Path(self.observation_chunk.original_file).name
+		return input_key
+
+	def _stage_parameters(self, name):
+		""" Everything besides its input that the output of a stage depends on """
+		if name == STAGE_PREPROCESS:
+			source = self.observation_chunk.source
+			pulsar = self.observation_chunk.is_pulsar()
+			return {'dm': self.config.dms.get(source) if pulsar else None,
+					'rm': self.config.rms.get(source) if pulsar else None,
+					'ephemeris': file_digest(self._ephemeris_path()) if pulsar else None,
+					'reverse_freqs': self.observation_chunk.bw < 0}
+
+		if name == STAGE_CALIBRATE:
+			# only the calibrators at the centre frequency of the chunk, as the global DBs grow with every campaign
+			cfreq = self.observation_chunk.cfreq
+			return {'flags': PAC_FLAGS,
+					'databases': [cal_db_digest(self.config.global_fluxcal_db, cfreq), cal_db_digest(self.config.global_polncal_db, cfreq),
+								  file_digest(self.config.global_metm_db)]}
+
+		return self.cleaner.get_parameters()
+
+	def _stage_key(self, name):
+		""" The key of the output of a stage, from the key of the stage before and the parameters of this one """
+		if name not in self._stage_keys:
+			index = PULSAR_STAGES.index(name)
+			input_key = self._stage_key(PULSAR_STAGES[index - 1]) if index > 0 else self._input_key()
+			self._stage_keys[name] = get_stage_key(input_key, name, self._stage_parameters(name))
+		return self._stage_keys[name]
+
+	def _input_file(self, name):
+		""" The file a stage reads """
+		if name == STAGE_PREPROCESS:
+			return self.observation_chunk.original_file
+		if name == STAGE_CLEAN:
+			return self.observation_chunk.preprocessed_file if self.observation_chunk.preprocessed_file is not None else self.observation_chunk.sym_file
+		if name == STAGE_CALIBRATE:
+			return self.observation_chunk.cleaned_file
+		return self.observation_chunk.calibrated_file
+
+	def _is_current(self, name, output_file):
+		output_file = Path(output_file).as_posix()
+		if not is_current(output_file, self._stage_key(name), [self._input_file(name)]):
+			return False
+
+		# outputs made before keys were recorded are taken to be made with the current parameters
+		if read_stage_key(output_file) is None:
+			write_stage_manifest(output_file, name, self._stage_key(name), self._stage_parameters(name))
+		return True
+
+	def _is_done(self, name):
+		"""
+		Whether the output of a stage is recorded and up to date. An output that is out of date, as
+		something it was made from changed since, is removed so that the stage runs again.
+		"""
+		column = STAGE_OUTPUT_COLUMNS[name]
+		output_file = getattr(self.observation_chunk, column)
+		if output_file is None:
+			return False
+
+		if self._is_current(name, output_file):
+			return True
+
+		self.logger.info("{} is out of date, running {} again".format(output_file, name))
+		remove_output(output_file)
+		setattr(self.observation_chunk, column, None)
+		return False
+
+	def _has_output(self, name):
+		"""
+		Whether the output of a stage is done (see _is_done), or is up to date in its place under the
+		pipeline root without being recorded, in which case it is recorded in the chunk.
+		"""
+		if self._is_done(name):
+			return True
+
+		output_file_path = self.observation_chunk.construct_output_archive_path(self.config.root_dir_path, STAGE_OUTPUT_NAMES[name])
+		if not self._is_current(name, output_file_path):
+			return False
+
+		setattr(self.observation_chunk, STAGE_OUTPUT_COLUMNS[name], output_file_path.resolve().as_posix())
+		return True
+
+	def _record(self, name):
+		""" Writes the key of the output of a stage next to it """
+		output_file = getattr(self.observation_chunk, STAGE_OUTPUT_COLUMNS[name])
+		if output_file is not None:
+			write_stage_manifest(output_file, name, self._stage_key(name), self._stage_parameters(name))
+
+	def process_in_memory(self, keep_intermediates = False):
+		"""
+		Runs all the stages of a pulsar chunk loading its archive once. The DM and RM updates and
+		both cleanings are applied to the archive in memory. Only the recleaned archive is written to
+		the output directories: the cleaned archive that pac needs, and the calibrated one it makes,
+		stay in a temporary directory (under $TMPDIR, ideally node-local), unless keep_intermediates.
+		Chunks that need a new ephemeris or reversed frequencies are still preprocessed with pam.
+		Chunks that already have a recleaned archive are not processed again.
+		"""
+		if self._has_output(STAGE_RECLEAN):
+			self.logger.warn("Recleaned file exists, skipping all stages...")
+			for name in PULSAR_STAGES:
+				self.run_stage(name, lambda: None)
+			return
+
+		self._keep_intermediates = keep_intermediates
+		with tempfile.TemporaryDirectory(prefix="psrpype_") as scratch_dir:
+			self._scratch_path = Path(scratch_dir)
+			try:
+				self.run_stage(STAGE_PREPROCESS, self._preprocess_in_memory)
+				self.run_stage(STAGE_CLEAN, self._clean_in_memory)
+				self.run_stage(STAGE_CALIBRATE, self._calibrate_in_memory)
+				self.run_stage(STAGE_RECLEAN, self._reclean_in_memory)
+			finally:
+				self._archive = None
+				self._scratch_path = None
+
+	def _intermediate_path(self, process_str):
+		""" Where an intermediate archive goes: its output directory if intermediates are kept, else the temporary directory """
+		if self._keep_intermediates:
+			return self.observation_chunk.construct_output_archive_path(self.config.root_dir_path, process_str)
+		return self._scratch_path.joinpath(self.observation_chunk.construct_output_archive_name(process_str))
+
+	def _update_archive(self, archive):
+		""" The DM and RM updates of pam -d and -R, on an archive in memory """
+		source = self.observation_chunk.source
+
+		if source in self.config.dms:
+			archive.set_dispersion_measure(float(self.config.dms[source]))
+			if archive.get_dedispersed():
+				archive.dedisperse()
+
+		if source in self.config.rms:
+			archive.set_rotation_measure(float(self.config.rms[source]))
+			if archive.get_faraday_corrected():
+				archive.defaraday()
+
+	def _preprocess_in_memory(self):
+
+		if self._is_done(STAGE_PREPROCESS):
+			self._archive = ps.Archive_load(self.observation_chunk.preprocessed_file)
+			return
+
+		if self._ephemeris_path() is not None or self.observation_chunk.bw < 0:
+			# pam installs the ephemeris and reverses the frequencies, with the DM and RM updates
+			preprocessed_file_path = self._intermediate_path("preprocessed")
+			self._run_pam(self._preprocess_flags(), preprocessed_file_path.parent, preprocessed_file_path.name)
+			self._archive = ps.Archive_load(preprocessed_file_path.resolve().as_posix())
+			if self._keep_intermediates:
+				self.observation_chunk.preprocessed_file = preprocessed_file_path.resolve().as_posix()
+				self._record(STAGE_PREPROCESS)
+			return
+
+		self._archive = ps.Archive_load(self.observation_chunk.original_file)
+		self._update_archive(self._archive)
+
+		if self._keep_intermediates and self._preprocess_flags() != "":
+			preprocessed_file_path = self._intermediate_path("preprocessed")
+			self._archive.unload(preprocessed_file_path.resolve().as_posix())
+			self.observation_chunk.preprocessed_file = preprocessed_file_path.resolve().as_posix()
+			self._record(STAGE_PREPROCESS)
+
+	def _clean_in_memory(self):
+
+		if self._is_done(STAGE_CLEAN):
+			self._cleaned_path = Path(self.observation_chunk.cleaned_file)
+			return
+
+		self.cleaner.clean_archive(self.observation_chunk, self._archive)
+
+		# pac works on files
+		self._cleaned_path = self._intermediate_path("cleaned")
+		self._archive.unload(self._cleaned_path.resolve().as_posix())
+		self._archive = None
+
+		if self._keep_intermediates:
+			self.observation_chunk.cleaned_file = self._cleaned_path.resolve().as_posix()
+			self._record(STAGE_CLEAN)
+
+	def _calibrate_in_memory(self):
+
+		if self._is_done(STAGE_CALIBRATE):
+			self._archive = ps.Archive_load(self.observation_chunk.calibrated_file)
+			return
+
+		calibrated_file_path = self._run_pac(self._cleaned_path.resolve().as_posix(), self._intermediate_path("calibrated").parent)
+		self._archive = ps.Archive_load(calibrated_file_path.resolve().as_posix())
+
+		if self._keep_intermediates:
+			new_file_name = self._cleaned_path.resolve().as_posix().replace("cleaned", "calibrated")
+			shutil.move(calibrated_file_path.resolve().as_posix(), new_file_name)
+			self.observation_chunk.calibrated_file = new_file_name
+			self._record(STAGE_CALIBRATE)
+
+	def _reclean_in_memory(self):
+
+		recleaned_file_path = self.observation_chunk.construct_output_archive_path(self.config.root_dir_path, "recleaned")
+
+		self.cleaner.clean_archive(self.observation_chunk, self._archive)
+		self._archive.unload(recleaned_file_path.resolve().as_posix())
+		self._archive = None
+
+		self.observation_chunk.recleaned_file = recleaned_file_path.resolve().as_posix()
+		self._record(STAGE_RECLEAN)
+		self.logger.info("in-memory processing done successfully...")
+
+	def run_stage(self, name, method=None):
+		"""
+		Runs one stage (preprocess, clean, calibrate or reclean) of the chunk, recording in its
+		stage row when and where it ran and how it ended. Stages that are already done, and
+		chunks without stage rows, just run the stage method, which skips existing outputs.
+		method replaces the method of the same name, e.g. for the in-memory stages.
+		"""
+		method = method if method is not None else getattr(self, name)
+		stage = self.observation_chunk.get_stage(name)
+		if stage is None or stage.state == STAGE_DONE:
+			method()
+			return
+
+		stage.start()
+		self.db_manager.add_to_db(stage)
+
+		try:
+			method()
+		except Exception:
+			self.logger.error("{} failed for {} (attempt {})".format(name, self.observation_chunk.sym_file, stage.attempts))
+			stage.fail()
+			self.db_manager.add_to_db(stage)
+			raise
+
+		# outputs in the scratch directory are gone after the chunk
+		output_file = getattr(self.observation_chunk, STAGE_OUTPUT_COLUMNS[name])
+		next_stage = stage.finish(None if self._in_scratch(output_file) else output_file)
+		self.db_manager.add_to_db([stage] if next_stage is None else [stage, next_stage])
 
 	def fix_cal_type(self):
 
@@ -25,53 +343,32 @@ class Processor(object):
 
 	def preprocess(self):
 
-		preprocessed_dir_path = self.observation_chunk.construct_output_path(self.config.root_dir_path, "preprocessed")
+		preprocessed_dir_path = self.observation_chunk.construct_output_path(self.output_root_path, "preprocessed")
 		preprocessed_file_name = self.observation_chunk.construct_output_archive_name("preprocessed")
 		preprocessed_file_path = preprocessed_dir_path.joinpath(preprocessed_file_name)
 
-		if self.observation_chunk.preprocessed_file is not None:
+		if self._is_done(STAGE_PREPROCESS):
 			self.logger.warn("Preprocessed file exists in the db, skipping...")
 			return
 
-		if preprocessed_file_path.exists():
+		if preprocessed_file_path.exists() and self._is_current(STAGE_PREPROCESS, preprocessed_file_path):
 			self.logger.warn("Preprocessed file exists in the file system, skipping...")
 			self.observation_chunk.preprocessed_file = preprocessed_file_path.resolve().as_posix()
 			#self.db_manager.add_to_db(self.observation_chunk)
 
 		else:
 
-			flags = ""
-
-			# if the observation is a pulsar, then also change dm, rm and ephemeris,if they need to be updated.
-			if self.observation_chunk.is_pulsar():
-			
-				if self.observation_chunk.source in self.config.dms:
-					flags = flags + " -d " + self.config.dms[self.observation_chunk.source] 
-
-				if  self.observation_chunk.source in self.config.rms:
-					flags = flags + " -R " + self.config.rms[self.observation_chunk.source] + ""
-
-				ephemeris_path = self.config.root_dir_path.joinpath("ephemeris").joinpath(self.observation_chunk.source + ".par")
-
-				if ephemeris_path.exists():
-					flags = flags +  " -E " + ephemeris_path.resolve().as_posix()
-
-			else:
+			if not self.observation_chunk.is_pulsar():
 				self.fix_cal_type()
 
-			if self.observation_chunk.bw < 0:
-				flags = flags + " --reverse_freqs "
-
+			flags = self._preprocess_flags()
 
 			if flags != "":
 
-				command = "pam {} {} -u {} ".format(flags, self.observation_chunk.original_file, preprocessed_dir_path.resolve().as_posix())
-				run_process(command)
-
-				self.logger.debug("Moving {} to {}".format(preprocessed_dir_path.joinpath(Path(self.observation_chunk.original_file).name), preprocessed_dir_path.joinpath(preprocessed_file_name)))
-				shutil.move(preprocessed_dir_path.joinpath(Path(self.observation_chunk.original_file).name), preprocessed_dir_path.joinpath(preprocessed_file_name))
+				self._run_pam(flags, preprocessed_dir_path, preprocessed_file_name)
 
 				self.observation_chunk.preprocessed_file = preprocessed_dir_path.joinpath(preprocessed_file_name).resolve().as_posix()
+				self._record(STAGE_PREPROCESS)
 				
 				self.logger.info("preprocessing done successfully...")
 				#self.db_manager.add_to_db(self.observation_chunk)
@@ -80,59 +377,106 @@ class Processor(object):
 			else:
 				self.logger.warn("Nothing to preprocess for {}".format(self.observation_chunk.sym_file))
 
+	def _ephemeris_path(self):
+		ephemeris_path = self.config.root_dir_path.joinpath("ephemeris").joinpath(self.observation_chunk.source + ".par")
+		return ephemeris_path if ephemeris_path.exists() else None
+
+	def _preprocess_flags(self):
+
+		flags = ""
 
+		# if the observation is a pulsar, then also change dm, rm and ephemeris,if they need to be updated.
+		if self.observation_chunk.is_pulsar():
+		
+			if self.observation_chunk.source in self.config.dms:
+				flags = flags + " -d " + self.config.dms[self.observation_chunk.source] 
+
+			if  self.observation_chunk.source in self.config.rms:
+				flags = flags + " -R " + self.config.rms[self.observation_chunk.source] + ""
+
+			if self._ephemeris_path() is not None:
+				flags = flags +  " -E " + self._ephemeris_path().resolve().as_posix()
+
+		if self.observation_chunk.bw < 0:
+			flags = flags + " --reverse_freqs "
+
+		return flags
+
+	def _run_pam(self, flags, out_dir_path, out_file_name):
+
+		command = "pam {} {} -u {} ".format(flags, self.observation_chunk.original_file, out_dir_path.resolve().as_posix())
+		run_process(command)
 
+		self.logger.debug("Moving {} to {}".format(out_dir_path.joinpath(Path(self.observation_chunk.original_file).name), out_dir_path.joinpath(out_file_name)))
+		shutil.move(out_dir_path.joinpath(Path(self.observation_chunk.original_file).name), out_dir_path.joinpath(out_file_name))
 
+		return out_dir_path.joinpath(out_file_name)
 
-	def _clean(self, name):
 
-		self.cleaner.clean_and_save(self.observation_chunk, name)
+
+
+
+	def _clean(self, name, stage):
+
+		# the cleaner keeps any file it finds in place
+		cleaned_file_path = self.observation_chunk.construct_output_archive_path(self.output_root_path, name)
+		if cleaned_file_path.exists() and not self._is_current(stage, cleaned_file_path):
+			remove_output(cleaned_file_path)
+
+		self.cleaner.clean_and_save(self.observation_chunk, name, self.output_root_path)
+		self._record(stage)
 		#self.db_manager.add_to_db(self.observation_chunk)
 
 	def clean(self):
-		if self.observation_chunk.cleaned_file is not None:
+		if self._is_done(STAGE_CLEAN):
 			self.logger.warn("Cleaned file exists, skipping...")		
 			return
-		self._clean("cleaned")
+		self._clean("cleaned", STAGE_CLEAN)
 		self.logger.info("cleaning done successfully...")
 
 
 	def reclean(self):
-		if self.observation_chunk.recleaned_file is not None:
+		if self._is_done(STAGE_RECLEAN):
 			self.logger.warn("Recleaned file exists, skipping...")	
 			return			
-		self._clean("recleaned")
+		self._clean("recleaned", STAGE_RECLEAN)
 		self.logger.info("recleaning done successfully...")
 
 
 	def calibrate(self):
 
-		if self.observation_chunk.calibrated_file is not None:
+		if self._is_done(STAGE_CALIBRATE):
 			self.logger.warn("Calibrated file exists in db, skipping...")		
 			return
 
-		calibrated_dir_path = self.observation_chunk.construct_output_path(self.config.root_dir_path, "calibrated")
+		calibrated_dir_path = self.observation_chunk.construct_output_path(self.output_root_path, "calibrated")
 		ext = Path(self.observation_chunk.cleaned_file).suffix
 		calibrated_file_name = Path(self.observation_chunk.cleaned_file).name.replace(ext, ".calib")
 		new_file_name = self.observation_chunk.cleaned_file.replace("cleaned", "calibrated")
 
-		if calibrated_dir_path.joinpath(new_file_name).exists():
+		if calibrated_dir_path.joinpath(new_file_name).exists() and self._is_current(STAGE_CALIBRATE, new_file_name):
 			self.logger.warn("Calibrated file exists in file system, skipping...")		
 			self.observation_chunk.calibrated_file = new_file_name
 			#self.db_manager.add_to_db(self.observation_chunk)
 			return
 		
 
-		command = "pac -k 3.0 -S -T -O {} -d {} -d {} -d {} {}".format(calibrated_dir_path.resolve().as_posix(), 
-																			self.config.global_fluxcal_db, 
-																			self.config.global_polncal_db, 
-																			self.config.global_metm_db,
-																			self.observation_chunk.cleaned_file)
-
-		run_process(command)
+		self._run_pac(self.observation_chunk.cleaned_file, calibrated_dir_path)
 		shutil.move(calibrated_dir_path.joinpath(calibrated_file_name).resolve().as_posix(), calibrated_dir_path.joinpath(new_file_name))
 		self.observation_chunk.calibrated_file = new_file_name
+		self._record(STAGE_CALIBRATE)
 		#self.db_manager.add_to_db(self.observation_chunk)
 		self.logger.info("calibration done successfully...")
 
 
+	def _run_pac(self, cleaned_file, out_dir_path):
+		""" Calibrates cleaned_file into out_dir_path, and returns the path of the .calib file pac makes """
+
+		command = "pac {} -O {} -d {} -d {} -d {} {}".format(PAC_FLAGS, out_dir_path.resolve().as_posix(), 
+																			self.config.global_fluxcal_db, 
+																			self.config.global_polncal_db, 
+																			self.config.global_metm_db,
+																			cleaned_file)
+
+		run_process(command)
+		return out_dir_path.joinpath(Path(cleaned_file).name.replace(Path(cleaned_file).suffix, ".calib"))
@@ -3,6 +3,9 @@ import numpy as np
 import psrchive as ps
 from threading import Thread
 
+# the clfd settings of clean_archive
+CLFD_FEATURES = ('std', 'ptp', 'lfamp','skew', 'kurtosis', 'acf')
+CLFD_Q = 4.0
 
 
 class Cleaner(object):
@@ -13,25 +16,36 @@ class Cleaner(object):
 		self.config = config
 		self.logger = Logger.get_instance()
 
+	def get_parameters(self):
+		""" The settings the output of the cleaner depends on """
+		return {'type': self.type, 'tolerance': self.tolerance, 'features': list(CLFD_FEATURES), 'q': CLFD_Q}
+
 	def clfd_cleaner(self, observation_chunk, in_file, cleaned_file_path):
 
+		archive = ps.Archive_load(in_file)
+
+		self.clean_archive(observation_chunk, archive)
+
+		archive.unload(cleaned_file_path.resolve().as_posix())
+
+		del archive
+
+	def clean_archive(self, observation_chunk, archive):
+		""" Zaps the profiles clfd finds bad, and the known RFI channels, in an archive already in memory """
+
 		import clfd
 		from clfd.interfaces import PsrchiveInterface
 
 		dirty_channels = self._get_known_dirty_channels(observation_chunk, self.tolerance)
 		self.logger.info("{} channels are dirty...".format(len(dirty_channels)))
 
-		archive = ps.Archive_load(in_file)
-
 		cube = clfd.DataCube(archive.get_data()[:, 0, :, :]) 
-		features = clfd.featurize(cube, features=('std', 'ptp', 'lfamp','skew', 'kurtosis', 'acf'))
-		stats, mask = clfd.profile_mask(features, q=4.0,  zap_channels=dirty_channels)	
+		features = clfd.featurize(cube, features=CLFD_FEATURES)
+		stats, mask = clfd.profile_mask(features, q=CLFD_Q,  zap_channels=dirty_channels)	
 	
 		PsrchiveInterface.apply_profile_mask(mask, archive)
 
-		archive.unload(cleaned_file_path.resolve().as_posix())
-
-		del archive, mask, cube
+		del mask, cube
 
 	
 	def coast_guard_cleaner(self, observation, in_file, cleaned_file_path):
@@ -40,10 +54,11 @@ class Cleaner(object):
 
 
 
-	def clean_and_save(self, observation_chunk, out_dir):
+	def clean_and_save(self, observation_chunk, out_dir, root_dir_path=None):
 
 
-		cleaned_file_path = observation_chunk.construct_output_archive_path(self.config.root_dir_path, out_dir)
+		root_dir_path = root_dir_path if root_dir_path is not None else self.config.root_dir_path
+		cleaned_file_path = observation_chunk.construct_output_archive_path(root_dir_path, out_dir)
 		in_file = None
 
 		if out_dir is "cleaned":
@@ -0,0 +1,249 @@
+import argparse
+import heapq
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+from app_utils import AppUtils
+from cal_utils import CalUtils, group_cal_chunks
+from config_parser import ConfigurationReader
+from constants import CALIBRATOR_TYPES, PULSAR_TYPES, SPOOL_DIR, STAGE_CALIBRATE, STAGE_DONE, STAGE_RUNNING
+from db_orms import DBManager, Observation, get_stage_names
+from gen_utils import get_current_timestamp_String
+from local_executor import consolidate_observation, init_worker, make_cal_db, run_chunk_stage
+from log import Logger
+from manifest import get_chunk_rows, get_chunk_spool_path, get_spool_path, merge_spools, write_manifest
+
+# node kinds other than the chunk stages, whose nodes are (stage, chunk id)
+CAL_DB_NODE = "cal_db"            # (CAL_DB_NODE, cal_type, cfreq)
+CONSOLIDATE_NODE = "consolidate"  # (CONSOLIDATE_NODE, observation id)
+
+
+def get_args():
+	argparser = argparse.ArgumentParser(description="prepare the calibrators and process the pulsars in one task graph",
+		formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+	argparser.add_argument("--config", dest="config", help="config file", required=True)
+	argparser.add_argument("-j", "--jobs", dest="jobs", help="the number of tasks to run at the same time on this machine", type=int, default=1)
+	argparser.add_argument("--consolidate", dest="consolidate", help="psradd recleaned files + produce decimated products", action='store_true')
+	argparser.add_argument("--max_attempts", dest="max_attempts", help="run failed stages again only if they have failed fewer times than this (default: always)", type=int)
+
+	AppUtils.add_shortlist_options(argparser)
+	Logger.add_logger_argparse_options(argparser)
+
+	args = argparser.parse_args()
+	return args
+
+
+class StageScheduler(object):
+	"""
+	Runs the calibrator preparation and the pulsar processing as one graph of tasks on a local
+	pool of worker processes. The nodes are the stages that are not done of every chunk, the
+	calibrator DB of each kind and centre frequency, and the consolidation of each pulsar
+	observation. A node runs as soon as the nodes it depends on are done:
+
+	 - a chunk stage after the stage before it
+	 - a calibrator DB after the clean stages of its chunks
+	 - the calibrate stage of a pulsar chunk after the calibrator DBs of its centre frequency
+	 - the consolidation of an observation after the reclean stages of its chunks
+
+	so e.g. pulsar chunks are preprocessed and cleaned while the calibrators are. Calibrator work
+	goes first, as the pulsars wait for it. As in LocalExecutor, the workers spool their results
+	and only this process writes to the DB. A node that fails is skipped with all that depends on it.
+	"""
+
+	def __init__(self, config, config_file, jobs, spool_dir, log_args, consolidate = False):
+		self.logger = Logger.get_instance()
+		self.cal_utils = CalUtils(config)
+		self.config_file = config_file
+		self.jobs = jobs
+		self.spool_dir = spool_dir
+		self.log_args = log_args
+		self.consolidate = consolidate
+		self.timestamp = get_current_timestamp_String()
+
+		self.dependencies = {}  # node -> nodes it waits for
+		self.dependents = {}    # node -> nodes that wait for it
+		self.priorities = {}    # node -> 0 for the calibrators, 1 for the pulsars
+		self.chunks = {}        # chunk id -> chunk
+		self.observation_objects = {}
+		self.observations = {}  # node -> ids of the observations it is part of
+		self.cal_groups = {}
+
+	def _add_node(self, node, dependencies, priority, observation_ids):
+		self.dependencies[node] = set(d for d in dependencies if d in self.dependencies)
+		for dependency in self.dependencies[node]:
+			self.dependents[dependency].add(node)
+		self.dependents[node] = set()
+		self.priorities[node] = priority
+		self.observations[node] = set(observation_ids)
+
+	def _add_chunk_nodes(self, observation_chunk, priority):
+		""" Adds the stages of a chunk that are not done, and returns the node of its last stage """
+		self.chunks[observation_chunk.id] = observation_chunk
+
+		previous = None
+		for stage in get_stage_names(observation_chunk.obs_type):
+			node = (stage, observation_chunk.id)
+			chunk_stage = observation_chunk.get_stage(stage)
+			if chunk_stage is None or chunk_stage.state != STAGE_DONE:
+				dependencies = [previous]
+				if stage == STAGE_CALIBRATE:
+					dependencies += [(CAL_DB_NODE, cal_type, cfreq) for cal_type, cfreq in self.cal_groups if cfreq == observation_chunk.cfreq]
+				self._add_node(node, dependencies, priority, [observation_chunk.observation_id])
+			previous = node
+
+		return previous
+
+	def build(self, cal_observations, pulsar_observations):
+		""" Makes the graph of the calibrator and pulsar observations to process """
+		self.cal_groups = group_cal_chunks(cal_observations)
+
+		for observation in cal_observations:
+			for observation_chunk in observation.observation_chunks:
+				self._add_chunk_nodes(observation_chunk, 0)
+
+		for (cal_type, cfreq), observation_chunks in self.cal_groups.items():
+			self._add_node((CAL_DB_NODE, cal_type, cfreq), [(get_stage_names(o.obs_type)[-1], o.id) for o in observation_chunks], 0,
+						   [o.observation_id for o in observation_chunks])
+
+		for observation in pulsar_observations:
+			last_nodes = [self._add_chunk_nodes(observation_chunk, 1) for observation_chunk in observation.observation_chunks]
+			if self.consolidate:
+				self._add_node((CONSOLIDATE_NODE, observation.id), last_nodes, 1, [observation.id])
+
+		self.logger.info("{} tasks for {} calibrator and {} pulsar observations".format(len(self.dependencies), len(cal_observations), len(pulsar_observations)))
+
+	def _submit(self, executor, node):
+		""" Submits the task of a node, and returns its future and the spool file it writes to """
+		if node[0] == CAL_DB_NODE:
+			cleaned_files = [o.cleaned_file for o in self.cal_groups[node[1:]]]
+			return executor.submit(make_cal_db, cleaned_files, node[1], node[2], self.timestamp), None
+
+		if node[0] == CONSOLIDATE_NODE:
+			observation = self.observation_objects[node[1]]
+			manifest_file = write_manifest(self.spool_dir, observation, self.config_file, self.consolidate)
+			return executor.submit(consolidate_observation, manifest_file), get_spool_path(self.spool_dir, observation.id).resolve().as_posix()
+
+		stage, chunk_id = node
+		observation_chunk = self.chunks[chunk_id]
+		spool_file = get_chunk_spool_path(self.spool_dir, observation_chunk.observation_id, chunk_id).resolve().as_posix()
+		return executor.submit(run_chunk_stage, get_chunk_rows(observation_chunk), stage, spool_file), spool_file
+
+	def _fail_running_stage(self, db_manager, node):
+		""" Marks the stage of a chunk node failed if its worker died while running it, so that it is selected again """
+		if node[0] in (CAL_DB_NODE, CONSOLIDATE_NODE):
+			return
+		chunk_stage = self.chunks[node[1]].get_stage(node[0])
+		if chunk_stage is not None and chunk_stage.state == STAGE_RUNNING:
+			chunk_stage.fail()
+			db_manager.add_to_db(chunk_stage)
+
+	def _skip(self, node, failed_nodes):
+		""" Marks a node that failed, and all that depends on it, as failed """
+		pending = [node]
+		while len(pending) > 0:
+			node = pending.pop()
+			if node in failed_nodes:
+				continue
+			failed_nodes.add(node)
+			pending.extend(self.dependents[node])
+
+	def run(self, db_manager, cal_observations, pulsar_observations):
+		"""
+		Processes the observations and returns the ones that failed. The others are marked processed:
+		the calibrators once their DBs are in the global DBs, the pulsars once consolidated (with
+		consolidate) or their chunks are processed.
+		"""
+		self.observation_objects = {o.id: o for o in cal_observations + pulsar_observations}
+		self.build(cal_observations, pulsar_observations)
+
+		remaining = {node: set(dependencies) for node, dependencies in self.dependencies.items()}
+		ready = []
+		for node, dependencies in remaining.items():
+			if len(dependencies) == 0:
+				heapq.heappush(ready, (self.priorities[node], len(ready), node))
+		sequence = len(ready)
+
+		failed_nodes = set()
+		tasks = {}
+
+		# spawned workers do not inherit the DB connections of this process
+		with ProcessPoolExecutor(max_workers=self.jobs, mp_context=multiprocessing.get_context("spawn"),
+								 initializer=init_worker, initargs=(self.config_file, self.log_args)) as executor:
+
+			while len(ready) > 0 or len(tasks) > 0:
+
+				# only as many tasks as workers are queued, so that the calibrators can overtake pulsars that became ready earlier
+				while len(ready) > 0 and len(tasks) < self.jobs:
+					_, _, node = heapq.heappop(ready)
+					future, spool_file = self._submit(executor, node)
+					tasks[future] = (node, spool_file)
+
+				done, _ = wait(tasks, return_when=FIRST_COMPLETED)
+				finished = [(future,) + tasks.pop(future) for future in done]
+				# the spools of failed tasks too, for their stage states
+				merge_spools(db_manager, [spool_file for future, node, spool_file in finished if spool_file is not None])
+
+				for future, node, spool_file in finished:
+					if future.exception() is not None:
+						self.logger.error("{} failed: {}".format(node, future.exception()))
+						self._fail_running_stage(db_manager, node)
+						self._skip(node, failed_nodes)
+						continue
+
+					if node[0] == CAL_DB_NODE:
+						self.cal_utils.add_cal_db(future.result(), node[1])
+
+					for dependent in self.dependents[node]:
+						remaining[dependent].discard(node)
+						if len(remaining[dependent]) == 0 and dependent not in failed_nodes:
+							heapq.heappush(ready, (self.priorities[dependent], sequence, dependent))
+							sequence += 1
+
+		failed = set(id for node in failed_nodes for id in self.observations[node])
+
+		# consolidation marks its observation processed itself
+		with db_manager.batch():
+			for observation in cal_observations + pulsar_observations:
+				if observation.id not in failed and not (self.consolidate and observation.obs_type in PULSAR_TYPES):
+					observation.processed = True
+					db_manager.add_to_db(observation)
+
+		db_manager.log_query_count("running {} tasks".format(len(self.dependencies)))
+
+		return [o for o in cal_observations + pulsar_observations if o.id in failed]
+
+
+def main():
+
+	args = get_args()
+	logger = Logger.get_instance(args)
+	config = ConfigurationReader(args.config).get_config()
+	db_manager = DBManager.get_instance(config.db_file, config.db_config)
+	db_manager.fail_stale_stages()
+
+	query = db_manager.get_session().query(Observation)
+	query = query.filter(Observation.processed == False)
+	query = AppUtils.add_shortlist_filters(query, args)
+	query = db_manager.with_stages_to_run(query, args.max_attempts)
+
+	observations = db_manager.with_chunks(query).all()
+	db_manager.log_query_count("selecting {} observations".format(len(observations)))
+
+	if len(observations) == 0:
+		logger.info("No observations to process")
+		return
+
+	cal_observations = [o for o in observations if o.obs_type in CALIBRATOR_TYPES]
+	pulsar_observations = [o for o in observations if o.obs_type in PULSAR_TYPES]
+
+	scheduler = StageScheduler(config, Path(args.config).resolve().as_posix(), args.jobs, config.root_dir_path.joinpath(SPOOL_DIR), args, args.consolidate)
+	failed = scheduler.run(db_manager, cal_observations, pulsar_observations)
+
+	if len(failed) > 0:
+		logger.error("{} of {} observations failed".format(len(failed), len(observations)))
+
+
+if __name__ == "__main__":
+	main()
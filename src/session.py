@@ -2,40 +2,47 @@ from log import Logger
 from processor import Processor
 from gen_utils import run_process
 from db_orms import DBManager
+from constants import PULSAR_STAGES
+from stage_cache import get_stage_key, is_current, read_stage_key, remove_output, write_stage_manifest
 from pathlib import Path
 
 class ObservingSession(object):
 
-	def __init__(self, config, observation):
+	def __init__(self, config, observation, db_manager = None):
 		self.observation = observation
 		self.observation_chunks = observation.observation_chunks
 		self.logger = Logger.get_instance()
-		self.db_manager = DBManager.get_instance()
+		self.db_manager = db_manager if db_manager is not None else DBManager.get_instance()
 		self.config = config
 
-	def process(self, consolidate = True):
-		for observation_chunk in self.observation_chunks:
+	def process(self, consolidate = True, in_memory = False, keep_intermediates = False, scratch = False):
+		# the chunks are committed in batches, and all of them before consolidating
+		with self.db_manager.batch():
+			for observation_chunk in self.observation_chunks:
+				self.process_chunk(observation_chunk, in_memory, keep_intermediates, scratch)
+		
 
-			self.logger.debug("considering {}".format(observation_chunk))
+		if consolidate:
+			self.consolidate()
 
-			processor = Processor(self.config, observation_chunk)
+	def process_chunk(self, observation_chunk, in_memory = False, keep_intermediates = False, scratch = False):
 
-			processor.preprocess()
-			processor.clean()
-			processor.calibrate()
-			processor.reclean()
+		self.logger.debug("considering {}".format(observation_chunk))
 
-			observation_chunk.processed = True
-			self.db_manager.add_to_db(observation_chunk)
-		
+		processor = Processor(self.config, observation_chunk, self.db_manager)
 
-		if consolidate:
-			self._consolidate()
+		if in_memory:
+			processor.process_in_memory(keep_intermediates)
+		else:
+			processor.process(PULSAR_STAGES, scratch)
+
+		observation_chunk.processed = True
+		self.db_manager.add_to_db(observation_chunk)
 
 
-	def _consolidate(self):
-		psradded_file = self._psradd()
-		self._decimate(psradded_file)
+	def consolidate(self):
+		psradded_file, remade = self._psradd()
+		self._decimate(psradded_file, remade)
 
 	def _psradd(self):
 		self.logger.debug("Psradding..." + str([o.recleaned_file for o in self.observation_chunks]))
@@ -43,24 +50,33 @@ class ObservingSession(object):
 		out_file = self.observation_chunks[0].construct_output_path(self.config.root_dir_path, "").joinpath(
 			self.observation_chunks[0].source + "_" + self.observation_chunks[0].obs_start_utc + "_psradd.rf").resolve().as_posix()
 
-		if Path(out_file).exists():
+		# the psradded file is up to date if the recleaned files it is made of are the same
+		recleaned_files = [o.recleaned_file for o in self.observation_chunks]
+		key = get_stage_key([read_stage_key(f) for f in recleaned_files], "psradd", {})
+
+		if is_current(out_file, key, recleaned_files):
 			self.logger.debug("{} already exists, skipping...".format(out_file))
-			return out_file
+			if read_stage_key(out_file) is None:
+				write_stage_manifest(out_file, "psradd", key, {})
+			return out_file, False
 
+		remove_output(out_file)
 		command = "psradd -o {} {}".format(out_file, files)
 		self.logger.debug("Running {}".format(command))
 		run_process(command)
+		write_stage_manifest(out_file, "psradd", key, {})
 		for o in self.observation_chunks:
 			o.psradded_file = out_file
 		
 		self.db_manager.add_to_db(self.observation_chunks)
 
 
-		return out_file
+		return out_file, True
 
-	def _decimate(self, psradded_file):
+	def _decimate(self, psradded_file, remade = False):
 
-		if(self.observation.decimated):
+		# files decimated from an earlier psradded file are remade
+		if(self.observation.decimated and not remade):
 			self.logger.debug("Decimated files already exists, skipping...")
 			return
 
@@ -74,7 +90,7 @@ class ObservingSession(object):
 			decimations = decimation_list.strip().split(",")			
 			num_files_in_dir = len(list(decimated_file_path.glob('*')))
 
-			if num_files_in_dir == len(decimations):
+			if num_files_in_dir == len(decimations) and not remade:
 				self.logger.debug("Decimated files already exists in system, skipping...")
 
 			else:
@@ -10,10 +10,11 @@ from pathlib import Path
 import signal
 import math
 from config_parser import ConfigurationReader
-from constants import PULSAR_TYPES
-from db_orms import DBManager, Observation, SlurmJob
+from constants import PULSAR_TYPES, SLURM_ENDED_STATES, SPOOL_DIR, STAGE_RUNNING
+from db_orms import ChunkStage, DBManager, Observation, ObservationChunk, SlurmJob
 from gen_utils import run_process
 from log import Logger
+from manifest import get_spool_path, merge_spools
 
 TEMPLATE = """\
 #!/bin/bash
@@ -122,16 +123,17 @@ class SlurmChecker(threading.Thread):
 		signal.signal(signal.SIGINT, SlurmChecker.signal_handler)
 
 		
-	def __init__(self, job_ids=None):
+	def __init__(self, job_ids=None, spool_dir=None):
 		self.logger = Logger.get_instance()
 		self.db_manager = DBManager.get_instance()
+		self.spool_dir = spool_dir
 		self.job_ids = job_ids
 		if self.job_ids is None:
-			query = self.db_manager.get_session().query(Observation)
+			query = self.db_manager.get_session().query(Observation.slurm_id)
 			query = query.filter(Observation.obs_type.in_(PULSAR_TYPES))
 			query = query.filter(Observation.processed == False)
 			query = query.filter(Observation.slurm_id != None)
-			self.job_ids = [obs.slurm_id for obs in query.all()]
+			self.job_ids = [slurm_id for slurm_id, in query.all()]
 		threading.Thread.__init__(self)
 
 
@@ -152,20 +154,31 @@ class SlurmChecker(threading.Thread):
 		self.logger.debug("jobs_ids: {}".format(self.job_ids))
 		if len(self.job_ids) > 0:
 			job_info_dict = self.get_job_dict(self.job_ids)
-			for job_id in self.job_ids[:]:
-				slurm_job = self.db_manager.get_session().query(SlurmJob).filter(SlurmJob.id == job_id).first()
-				new_status = job_info_dict[str(job_id)]
-				self.logger.debug("Job ID: {} old status: {} new status: {}".format(
-					job_id, slurm_job.state, new_status))
-				if new_status != slurm_job.state:
-					slurm_job.state = new_status
-					self.db_manager.add_to_db(slurm_job)
-					if(new_status not in ['COMPLETED','PENDING', 'RUNNING']):
-						self.logger.error("Job {}  failed with status {}".format(
-							job_id, new_status))
-						
-					if(new_status in ['COMPLETED','FAILED', 'OUT_OF_MEMORY']):
-						self.job_ids.remove(job_id)			
+			query = self.db_manager.get_session().query(SlurmJob).filter(SlurmJob.id.in_([int(j) for j in self.job_ids]))
+			slurm_jobs = {slurm_job.id: slurm_job for slurm_job in query}
+			finished_job_ids = []
+			# all state changes seen in one check are committed together
+			with self.db_manager.batch(max_size=len(self.job_ids)):
+				for job_id in self.job_ids[:]:
+					slurm_job = slurm_jobs[int(job_id)]
+					new_status = job_info_dict[str(job_id)]
+					self.logger.debug("Job ID: {} old status: {} new status: {}".format(
+						job_id, slurm_job.state, new_status))
+					ended = new_status.split(" ")[0] in SLURM_ENDED_STATES
+					if ended:
+						finished_job_ids.append(job_id)
+						self.job_ids.remove(job_id)
+					if new_status != slurm_job.state:
+						slurm_job.state = new_status
+						self.db_manager.add_to_db(slurm_job)
+						if(new_status not in ['COMPLETED','PENDING', 'RUNNING']):
+							self.logger.error("Job {}  failed with status {}".format(
+								job_id, new_status))
+
+
+			self.merge_spools(finished_job_ids)
+			self.fail_running_stages(finished_job_ids)
+			self.db_manager.log_query_count("checking {} jobs".format(len(job_info_dict)))
 							
 		else:
 			self.logger.info("No jobs to check...")
@@ -173,6 +186,26 @@ class SlurmChecker(threading.Thread):
 			
 						
 
+	def merge_spools(self, job_ids):
+		""" Merges the results spooled by the jobs that finished into the DB """
+		if self.spool_dir is None or len(job_ids) == 0:
+			return
+		query = self.db_manager.get_session().query(Observation.id).filter(Observation.slurm_id.in_([int(j) for j in job_ids]))
+		merge_spools(self.db_manager, [get_spool_path(self.spool_dir, id) for id, in query])
+
+	def fail_running_stages(self, job_ids):
+		""" Marks failed the stages that jobs which ended left running, e.g. when they were killed, so that they are selected again """
+		if len(job_ids) == 0:
+			return
+		query = (self.db_manager.get_session().query(ChunkStage).join(ChunkStage.observation_chunk).join(ObservationChunk.observation)
+				 .filter(Observation.slurm_id.in_([int(j) for j in job_ids]), ChunkStage.state == STAGE_RUNNING))
+		chunk_stages = query.populate_existing().all()
+		for chunk_stage in chunk_stages:
+			self.logger.warn("{} of chunk {} was left running by its slurm job, marking it failed".format(chunk_stage.stage, chunk_stage.chunk_id))
+			chunk_stage.fail()
+		if len(chunk_stages) > 0:
+			self.db_manager.add_to_db(chunk_stages)
+
 	def run(self):
 		while True:
 			self.logger.debug("checking slurm jobs...")
@@ -206,9 +239,9 @@ def main():
 	args = get_args()
 	logger = Logger.get_instance(args)
 	config = ConfigurationReader(args.config).get_config()
-	db_manager = DBManager.get_instance(config.db_file)
+	db_manager = DBManager.get_instance(config.db_file, config.db_config)
 	SlurmChecker.signal_init()
-	slurm_checker = SlurmChecker()
+	slurm_checker = SlurmChecker(spool_dir=config.root_dir_path.joinpath(SPOOL_DIR))
 	slurm_checker.start()
 	slurm_checker.join()
 	logger.info("done")
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from log import Logger
+
+STAGE_MANIFEST_SUFFIX = ".stage.json"
+
+# (path, size, mtime) -> digest, for files read by many chunks such as ephemerides and calibrator DBs
+_digests = {}
+
+
+def file_digest(file_name):
+	""" The SHA-256 of the contents of a file, or None if there is no such file """
+	if file_name is None or not os.path.exists(file_name):
+		return None
+
+	stat_result = os.stat(file_name)
+	key = (os.path.abspath(file_name), stat_result.st_size, stat_result.st_mtime_ns)
+	if key not in _digests:
+		digest = hashlib.sha256()
+		with open(file_name, 'rb') as f:
+			for block in iter(lambda: f.read(1 << 20), b''):
+				digest.update(block)
+		_digests[key] = digest.hexdigest()
+
+	return _digests[key]
+
+
+def get_stage_key(input_key, stage, parameters):
+	"""
+	The key of the output of a stage: a hash of the key of its input (that of the stage before, or
+	the identity of the original file) and of all the parameters the stage depends on, so that it
+	changes when anything upstream of the output does.
+	"""
+	content = json.dumps({'input': input_key, 'stage': stage, 'parameters': parameters}, sort_keys=True)
+	return hashlib.sha256(content.encode()).hexdigest()
+
+
+def get_stage_manifest_path(output_file):
+	return Path(output_file).with_name(Path(output_file).name + STAGE_MANIFEST_SUFFIX)
+
+
+def write_stage_manifest(output_file, stage, key, parameters):
+	""" Records the key and parameters of the output of a stage next to it """
+	manifest = {'stage': stage, 'key': key, 'parameters': parameters}
+
+	manifest_path = get_stage_manifest_path(output_file)
+	tmp_path = manifest_path.with_name(manifest_path.name + ".tmp")
+	with open(tmp_path, 'w') as f:
+		json.dump(manifest, f, indent=1, sort_keys=True)
+	os.replace(tmp_path, manifest_path)
+
+
+def read_stage_key(output_file):
+	""" The key recorded next to the output of a stage, or None for outputs made before keys were recorded """
+	manifest_path = get_stage_manifest_path(output_file)
+	if not manifest_path.exists():
+		return None
+
+	try:
+		with open(manifest_path) as f:
+			return json.load(f)['key']
+	except (ValueError, KeyError):
+		Logger.get_instance().warn("Ignoring unreadable stage manifest {}".format(manifest_path))
+		return ""
+
+
+def is_current(output_file, key, input_files=()):
+	"""
+	Whether the output of a stage exists and was made from the inputs and parameters of key. An
+	output made before keys were recorded is taken to be current if it is newer than its input files.
+	"""
+	if output_file is None or not os.path.exists(output_file):
+		return False
+
+	recorded_key = read_stage_key(output_file)
+	if recorded_key is not None:
+		return recorded_key == key
+
+	mtime = os.stat(output_file).st_mtime_ns
+	return all(f is None or not os.path.exists(f) or os.stat(f).st_mtime_ns <= mtime for f in input_files)
+
+
+def remove_output(output_file):
+	""" Removes the output of a stage and its manifest """
+	for path in [Path(output_file), get_stage_manifest_path(output_file)]:
+		if path.exists():
+			path.unlink()
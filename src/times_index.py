@@ -0,0 +1,155 @@
+from bisect import bisect_left, bisect_right
+from pathlib import Path
+
+import numpy as np
+
+from log import Logger
+
+TIMES_FILE="times.dat"
+
+
+def group_chunks(keys, start_mjds, end_mjds, tolerance, initial_ends=None, forced_heads=None):
+	"""
+	Groups chunks into observations. Within each key (e.g. a source and centre frequency), chunks
+	are sorted by start MJD and each joins the observation of the earlier chunk that ends last (the
+	earliest of them on ties) if it starts within tolerance of its end, else starts a new one,
+	which is the rule TimesIndex.find_utc_dir applies one chunk at a time. initial_ends optionally
+	gives, per key, the latest end already on disk, and forced_heads flags chunks that start an
+	observation regardless (e.g. chunks whose utc_start is already a utc_dir).
+
+	Returns the group label of every chunk, and the index of the first chunk of every group. A
+	chunk whose latest earlier end is on disk is the first of its group, for find_utc_dir to place.
+	"""
+	keys = np.asarray(keys)
+	start_mjds = np.asarray(start_mjds, dtype=float)
+	end_mjds = np.asarray(end_mjds, dtype=float)
+
+	if len(keys) == 0:
+		return np.empty(0, dtype=int), np.empty(0, dtype=int)
+
+	order = np.lexsort((start_mjds, keys))
+	sorted_keys, starts, ends = keys[order], start_mjds[order], end_mjds[order]
+	positions = np.arange(len(order))
+
+	key_starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+	key_ends = np.r_[key_starts[1:], len(order)]
+
+	# the latest end of the earlier chunks of the key, and the position of the chunk it is the end
+	# of (-1 for an end on disk), which only a strictly later end takes over, as ties keep the earliest
+	previous_ends = np.empty_like(ends)
+	owners = np.full(len(order), -1)
+	for first, last in zip(key_starts, key_ends):
+		initial_end = -np.inf if initial_ends is None else initial_ends[sorted_keys[first]]
+		latest_ends = np.maximum(np.maximum.accumulate(ends[first:last]), initial_end)
+		previous_ends[first] = initial_end
+		previous_ends[first + 1:last] = latest_ends[:-1]
+
+		takes_over = ends[first:last] > np.r_[initial_end, latest_ends[:-1]]
+		latest_owners = np.maximum.accumulate(np.where(takes_over, positions[first:last], -1))
+		owners[first + 1:last] = latest_owners[:-1]
+
+	boundaries = (starts - previous_ends >= tolerance) | (owners < 0)
+	if forced_heads is not None:
+		boundaries |= np.asarray(forced_heads, dtype=bool)[order]
+
+	# each chunk is in the group of the chunk it joins, which is earlier, so following the links
+	# (doubling the distance each step) ends at the first chunk of its group
+	roots = np.where(boundaries, positions, owners)
+	while True:
+		next_roots = roots[roots]
+		if np.array_equal(next_roots, roots):
+			break
+		roots = next_roots
+
+	group_numbers = np.cumsum(boundaries) - 1
+	labels = np.empty(len(order), dtype=int)
+	labels[order] = group_numbers[roots]
+
+	return labels, order[boundaries]
+
+
+class TimesIndex(object):
+	"""
+	In-memory copy of one times.dat file (one per source and collection), with the chunk end
+	MJDs kept sorted per centre frequency. New rows are held in memory and appended to the
+	file once, by save().
+	"""
+
+	def __init__(self, times_file_path):
+		self.logger = Logger.get_instance()
+		self.times_file_path = Path(times_file_path)
+		self._ends = {}     # cfreq -> sorted chunk end MJDs
+		self._dirs = {}     # cfreq -> utc_dir of each entry in _ends
+		self._utc_dirs = {} # cfreq -> set of all utc_dirs
+		self._new_lines = []
+
+		if self.times_file_path.exists() and self.times_file_path.stat().st_size > 0:
+			times = np.loadtxt(self.times_file_path.resolve().as_posix(), ndmin=1,
+				dtype={'names': ('cfreq', 'mjd_start', 'utc_start', 'mjd_end', 'utc_end', 'utc_dir'),
+					   'formats': (float, float, 'S32',  float, 'S32', 'S32')})
+			for row in times:
+				self._insert(row['cfreq'], row['mjd_end'], row['utc_dir'].decode())
+
+	@staticmethod
+	def _key(cfreq):
+		# times.dat stores the centre frequency with 3 decimals
+		return round(float(cfreq), 3)
+
+	def _insert(self, cfreq, mjd_end, utc_dir):
+		key = self._key(cfreq)
+		ends = self._ends.setdefault(key, [])
+		dirs = self._dirs.setdefault(key, [])
+
+		# insert after any equal end, so that ties keep file order
+		i = bisect_right(ends, mjd_end)
+		ends.insert(i, mjd_end)
+		dirs.insert(i, utc_dir)
+		self._utc_dirs.setdefault(key, set()).add(utc_dir)
+
+	def has_utc_dir(self, cfreq, utc_dir):
+		return utc_dir in self._utc_dirs.get(self._key(cfreq), ())
+
+	def latest_end(self, cfreq):
+		ends = self._ends.get(self._key(cfreq))
+		return ends[-1] if ends else -np.inf
+
+	def find_utc_dir(self, cfreq, start_mjd, utc_start, tolerance):
+		"""
+		Returns the utc_dir that a chunk starting at start_mjd belongs to: utc_start itself if it
+		is already a utc_dir (e.g. .rf vs .zrf of the same chunk), else the utc_dir of the chunk
+		that ends last, if this one starts within tolerance of it, else utc_start.
+		"""
+		key = self._key(cfreq)
+		ends = self._ends.get(key)
+
+		if not ends:
+			return utc_start
+
+		if utc_start in self._utc_dirs[key]:
+			self.logger.info("Using existing utc_start=utc_dir for {}".format(utc_start))
+			return utc_start
+
+		# the earliest written of the chunks that end last
+		i = bisect_left(ends, ends[-1])
+		if start_mjd - ends[i] < tolerance:
+			return self._dirs[key][i]
+
+		return utc_start
+
+	def add(self, cfreq, start_mjd, utc_start, end_mjd, utc_end, utc_dir):
+		line="{:8.3f} {:20.12f} {} {:20.12f} {} {}\n".format(cfreq, start_mjd, utc_start, end_mjd, utc_end, utc_dir)
+		self.logger.debug("adding to times.dat: {}".format(line))
+		self._new_lines.append(line)
+
+		# use the value as it will be read back from the file
+		self._insert(cfreq, float("{:20.12f}".format(end_mjd)), utc_dir)
+
+	def save(self):
+		if len(self._new_lines) == 0:
+			return
+
+		with open(self.times_file_path, 'a') as f:
+			f.writelines(self._new_lines)
+
+		self.logger.debug("wrote {} lines to {}".format(len(self._new_lines), self.times_file_path))
+		self._new_lines = []
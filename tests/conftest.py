@@ -0,0 +1,48 @@
+import argparse
+import sys
+from pathlib import Path
+
+import pytest
+
+# the pipeline modules import each other from src, as the scripts do
+SRC_DIR = Path(__file__).resolve().parent.parent.joinpath("src")
+sys.path.insert(0, SRC_DIR.as_posix())
+
+from log import Logger
+
+LOG_ARGS = argparse.Namespace(log_to_file=False, log_to_stream=False)
+Logger.get_instance(LOG_ARGS)
+
+from db_orms import DBManager
+from gen_utils import get_utc_string
+from initialise_data import FileInfo, get_observation_ids, insert_collection
+
+
+@pytest.fixture
+def db_manager(tmp_path):
+	""" A new database, in the pipeline root tmp_path """
+	db_manager = DBManager(tmp_path.joinpath("psrpype.sqlite3").as_posix())
+	db_manager.init_database()
+	return db_manager
+
+
+def ingest(db_manager, collection_name, chunk_counts, source="J0437-4715", obs_type="Pulsar", cfreq=2368.0):
+	"""
+	Ingests a collection as initialise_data does, with an observation of chunk_counts[i] chunks for
+	each i, 15 minutes apart. Returns the obs_start_utc of the observations.
+	"""
+	utcs, chunk_rows, file_infos = [], [], {}
+	for i, chunk_count in enumerate(chunk_counts):
+		start_mjd = 58000 + i / 96.0
+		utc = get_utc_string(start_mjd)
+		utcs.append(utc)
+		for j in range(chunk_count):
+			original_file = "/data/{}/{}/{}_{}.rf".format(collection_name, utc, source, j)
+			file_info = FileInfo(original_file, "Medusa", source, "Parkes", obs_type, cfreq, 3328.0, 3328, 8, 1024, 4, 1.0,
+								 start_mjd + j * 1e-5, start_mjd + (j + 1) * 1e-5)
+			file_infos[original_file] = file_info
+			chunk_rows.append(file_info.chunk_row(original_file, original_file.replace("/data/", "/sym/"), utc))
+
+	collection_row = dict(collection_name=collection_name, name_alias=collection_name, pid="P000", collection_path="/data/" + collection_name)
+	insert_collection(db_manager, collection_row, chunk_rows, get_observation_ids(db_manager.get_session()), file_infos)
+	return utcs
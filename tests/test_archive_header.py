@@ -0,0 +1,136 @@
+import gzip
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from archive_header import (ArchiveHeader, HeaderFormatException, compact_frequencies, get_header_summary,
+                            read_primary_header)
+
+NSUBINT, NCHAN, NBIN, NPOL = 5, 8, 16, 4
+TSUBINT = 8.0
+STT_IMJD, STT_SMJD, STT_OFFS = 58849, 43200, 0.25
+CFREQ, BW = 2368.0, -3328.0
+FREQS = CFREQ + BW / NCHAN * (np.arange(NCHAN) - (NCHAN - 1) / 2.0)
+
+
+def write_psrfits(path, obs_mode="PSR", data_seed=0):
+	""" A small PSRFITS file, with a HISTORY table before SUBINT and columns of most TFORM types """
+	primary = fits.PrimaryHDU()
+	for key, value in [("FITS_TYP", "PSRFITS"), ("SRC_NAME", "J0437-4715"), ("TELESCOP", "Parkes"), ("BACKEND", "Medusa"),
+					   ("FRONTEND", "UWL"), ("FD_POLN", "LIN"), ("OBS_MODE", obs_mode), ("OBSFREQ", CFREQ), ("OBSBW", BW),
+					   ("OBSNCHAN", NCHAN), ("STT_IMJD", STT_IMJD), ("STT_SMJD", STT_SMJD), ("STT_OFFS", STT_OFFS)]:
+		primary.header[key] = value
+
+	history = fits.BinTableHDU.from_columns([fits.Column(name="PROC_CMD", format="80A", array=np.array(["pam -m"] * 3))])
+	history.header["EXTNAME"] = "HISTORY"
+
+	data = np.random.default_rng(data_seed).integers(-1000, 1000, (NSUBINT, NPOL * NCHAN * NBIN), dtype=np.int16)
+	columns = [
+		fits.Column(name="INDEXVAL", format="D", array=np.arange(NSUBINT, dtype=float)),
+		fits.Column(name="FLAGS", format="12X", array=np.zeros((NSUBINT, 12), dtype=bool)),
+		fits.Column(name="TSUBINT", format="D", array=np.full(NSUBINT, TSUBINT)),
+		fits.Column(name="OFFS_SUB", format="D", array=TSUBINT * (np.arange(NSUBINT) + 0.5)),
+		fits.Column(name="PERIOD", format="D", array=np.full(NSUBINT, 0.00575745)),
+		fits.Column(name="DAT_FREQ", format="{}D".format(NCHAN), array=np.tile(FREQS, (NSUBINT, 1))),
+		fits.Column(name="DAT_WTS", format="{}E".format(NCHAN), array=np.ones((NSUBINT, NCHAN), dtype=np.float32)),
+		fits.Column(name="DATA", format="{}I".format(NPOL * NCHAN * NBIN), array=data),
+	]
+	subint = fits.BinTableHDU.from_columns(columns)
+	for key, value in [("EXTNAME", "SUBINT"), ("NCHAN", NCHAN), ("NBIN", NBIN), ("NPOL", NPOL), ("POL_TYPE", "AABBCRCI"),
+					   ("DM", 2.64476), ("RM", 0.0)]:
+		subint.header[key] = value
+
+	fits.HDUList([primary, history, subint]).writeto(path)
+	return path
+
+
+def gzip_file(path):
+	gz_path = path.with_name(path.name + ".gz")
+	with open(path, 'rb') as f, gzip.open(gz_path, 'wb') as g:
+		g.write(f.read())
+	return gz_path
+
+
+@pytest.fixture(params=["plain", "gzipped"])
+def psrfits_file(request, tmp_path):
+	path = write_psrfits(tmp_path.joinpath("J0437-4715.rf"))
+	return (path if request.param == "plain" else gzip_file(path)).as_posix()
+
+
+def test_header_values(psrfits_file):
+	header = ArchiveHeader(psrfits_file)
+
+	assert header.get_source() == "J0437-4715"
+	assert header.get_telescope() == "Parkes"
+	assert header.get_backend_name() == "Medusa"
+	assert header.get_type() == "Pulsar"
+	assert (header.get_nchan(), header.get_nsubint(), header.get_nbin(), header.get_npol()) == (NCHAN, NSUBINT, NBIN, NPOL)
+	assert header.get_centre_frequency() == CFREQ
+	assert header.get_bandwidth() == BW
+	assert header.get_dispersion_measure() == pytest.approx(2.64476)
+	assert header.get_rotation_measure() == 0.0
+	assert header.get_receiver_name() == "UWL"
+	assert header.get_basis() == "LIN"
+	assert header.get_state() == "AABBCRCI"
+	assert header.get_folding_period() == pytest.approx(0.00575745)
+	assert header.get_subint_duration() == TSUBINT
+	np.testing.assert_allclose(header.get_frequencies(), FREQS)
+
+
+def test_start_and_length(psrfits_file):
+	header = ArchiveHeader(psrfits_file)
+
+	# the first sub-integration starts at the reference time, and the last ends NSUBINT * TSUBINT after it
+	start_mjd = STT_IMJD + (STT_SMJD + STT_OFFS) / 86400.0
+	assert header.start_time().in_days() == pytest.approx(start_mjd, abs=1e-11)
+	assert (header.end_time().in_days() - header.start_time().in_days()) * 86400.0 == pytest.approx(NSUBINT * TSUBINT, abs=1e-5)
+
+
+@pytest.mark.parametrize("obs_mode,obs_type", [("PSR", "Pulsar"), ("CAL", "PolnCal"), ("FON", "FluxCal-On"),
+											   ("FOF", "FluxCal-Off"), ("SEARCH", "Unknown")])
+def test_type(tmp_path, obs_mode, obs_type):
+	assert ArchiveHeader(write_psrfits(tmp_path.joinpath("a.rf"), obs_mode).as_posix()).get_type() == obs_type
+
+
+def test_fingerprint(tmp_path):
+	path = write_psrfits(tmp_path.joinpath("a.rf"))
+	other_path = write_psrfits(tmp_path.joinpath("b.rf"), data_seed=1)
+
+	fingerprint = ArchiveHeader(path.as_posix(), fingerprint=True).get_fingerprint()
+	assert ArchiveHeader(gzip_file(path).as_posix(), fingerprint=True).get_fingerprint() == fingerprint
+	assert ArchiveHeader(other_path.as_posix(), fingerprint=True).get_fingerprint() != fingerprint
+	assert ArchiveHeader(path.as_posix()).get_fingerprint() is None
+
+
+def test_header_summary(psrfits_file):
+	dm, rm, period, tsubint, receiver, basis, state, chan_freq, chan_bw, chan_freqs = get_header_summary(ArchiveHeader(psrfits_file))
+
+	assert (receiver, basis, state, tsubint) == ("UWL", "LIN", "AABBCRCI", TSUBINT)
+	assert (chan_freq, chan_bw, chan_freqs) == (pytest.approx(FREQS[0]), pytest.approx(BW / NCHAN), None)
+
+
+def test_uneven_frequencies_are_kept_in_full():
+	freqs = np.array([1000.0, 1001.0, 1003.0])
+	assert compact_frequencies(freqs) == (None, None, freqs.astype('<f8').tobytes())
+
+
+def test_primary_header(psrfits_file):
+	assert read_primary_header(psrfits_file)["SRC_NAME"] == "J0437-4715"
+
+
+def test_other_files_raise(tmp_path):
+	not_fits = tmp_path.joinpath("a.txt")
+	not_fits.write_text("not a FITS file\n" * 200)
+	with pytest.raises(HeaderFormatException):
+		ArchiveHeader(not_fits.as_posix())
+
+	not_psrfits = tmp_path.joinpath("a.fits")
+	fits.PrimaryHDU(np.zeros(10)).writeto(not_psrfits)
+	with pytest.raises(HeaderFormatException):
+		ArchiveHeader(not_psrfits.as_posix())
+
+	truncated = tmp_path.joinpath("truncated.rf")
+	truncated.write_bytes(write_psrfits(tmp_path.joinpath("c.rf")).read_bytes()[:2880 * 2 + 100])
+	with pytest.raises(HeaderFormatException):
+		ArchiveHeader(truncated.as_posix())
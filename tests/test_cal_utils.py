@@ -0,0 +1,33 @@
+from cal_utils import cal_db_digest, get_cal_db_entries
+
+HEADER = "Pulsar::Database # 2.0\nPulsar::Database::path /cals\n# filename type source MJD frequency bandwidth nchan\n"
+
+
+def cal_db_line(name, cfreq, mjd=58000.1):
+	return "{}.pcm Polar J1939-6342 {} {} 3328.0 1024\n".format(name, mjd, cfreq)
+
+
+def test_entries_at_other_frequencies_leave_the_digest(tmp_path):
+	db_file = tmp_path.joinpath("polncal.db")
+	db_file.write_text(HEADER + cal_db_line("a", 2368.0) + cal_db_line("b", 1369.0))
+	digest = cal_db_digest(db_file.as_posix(), 2368.0)
+
+	with open(db_file, 'a') as f:
+		f.write(cal_db_line("c", 1369.0) + cal_db_line("d", 3100.0, mjd=58001.2))
+	assert cal_db_digest(db_file.as_posix(), 2368.0) == digest
+	assert cal_db_digest(db_file.as_posix(), 1369.0) != digest
+
+	with open(db_file, 'a') as f:
+		f.write(cal_db_line("e", 2368.0, mjd=58002.3))
+	assert cal_db_digest(db_file.as_posix(), 2368.0) != digest
+
+
+def test_entries_leave_out_the_header(tmp_path):
+	db_file = tmp_path.joinpath("fluxcal.db")
+	db_file.write_text(HEADER + cal_db_line("a", 2368.0) + "\n" + cal_db_line("b", 1369.0))
+
+	assert get_cal_db_entries(db_file.as_posix(), 2368.0) == [cal_db_line("a", 2368.0).strip()]
+
+
+def test_missing_db(tmp_path):
+	assert cal_db_digest(tmp_path.joinpath("missing.db").as_posix(), 2368.0) is None
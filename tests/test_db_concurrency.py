@@ -0,0 +1,110 @@
+import multiprocessing
+import sqlite3
+import threading
+import time
+
+import pytest
+from sqlalchemy import func
+
+from config_parser import DBConfig
+from conftest import LOG_ARGS
+from db_orms import DBManager, SlurmJob
+from log import Logger
+
+WRITER_COUNT = 12
+READER_COUNT = 4
+JOBS_PER_WRITER = 100
+
+# a busy timeout well below the default, that busy writers can run out of, while a query can still
+# wait out the commits queued before it (queries are not retried). The retries themselves are
+# tested deterministically below.
+STRESS_BUSY_TIMEOUT = 5
+
+
+def get_db_manager(db_file, journal_mode):
+	# also in the spawned processes, which do not run conftest
+	Logger.get_instance(LOG_ARGS)
+	return DBManager(db_file, DBConfig(journal_mode=journal_mode, busy_timeout=STRESS_BUSY_TIMEOUT, max_retries=40))
+
+
+def write_jobs(db_file, journal_mode, first_id):
+	""" Inserts JOBS_PER_WRITER jobs in batches, then updates them one commit at a time """
+	db_manager = get_db_manager(db_file, journal_mode)
+	ids = range(first_id, first_id + JOBS_PER_WRITER)
+
+	with db_manager.batch(max_size=10):
+		for id in ids:
+			db_manager.add_to_db(SlurmJob(id=id, state="QUEUED"))
+
+	slurm_jobs = db_manager.get_session().query(SlurmJob).filter(SlurmJob.id.in_(ids)).all()
+	for slurm_job in slurm_jobs:
+		slurm_job.state = "COMPLETED"
+		db_manager.add_to_db(slurm_job)
+
+
+def read_jobs(db_file, journal_mode, stop_time):
+	""" Holds read transactions, which a commit without WAL has to wait for """
+	db_manager = get_db_manager(db_file, journal_mode)
+	session = db_manager.get_session()
+	while time.time() < stop_time:
+		db_manager.begin_read()
+		session.query(func.count(SlurmJob.id)).scalar()
+		time.sleep(0.02)
+		session.rollback()
+		time.sleep(0.005)
+
+
+@pytest.mark.parametrize("journal_mode", ["DELETE", "WAL"])
+def test_many_writer_processes(tmp_path, journal_mode):
+	db_file = tmp_path.joinpath("psrpype.sqlite3").as_posix()
+	get_db_manager(db_file, journal_mode).init_database()
+
+	context = multiprocessing.get_context("spawn")
+	with context.Pool(WRITER_COUNT + READER_COUNT) as pool:
+		readers = [pool.apply_async(read_jobs, (db_file, journal_mode, time.time() + 60)) for i in range(READER_COUNT)]
+		writers = [pool.apply_async(write_jobs, (db_file, journal_mode, i * JOBS_PER_WRITER + 1)) for i in range(WRITER_COUNT)]
+
+		# a database is locked error in a writer is raised here
+		for writer in writers:
+			writer.get(timeout=600)
+		pool.terminate()
+
+	session = get_db_manager(db_file, journal_mode).get_session()
+	assert session.query(func.count(SlurmJob.id)).scalar() == WRITER_COUNT * JOBS_PER_WRITER
+	assert session.query(SlurmJob.state).distinct().all() == [("COMPLETED",)]
+
+
+def test_commit_is_retried_while_readers_hold_the_database(tmp_path):
+	db_file = tmp_path.joinpath("psrpype.sqlite3").as_posix()
+	db_manager = DBManager(db_file, DBConfig(journal_mode="DELETE", busy_timeout=0.05, max_retries=40))
+	db_manager.init_database()
+
+	# the lock of the reader lets the write start, but not commit
+	reader = sqlite3.connect(db_file, isolation_level=None, check_same_thread=False)
+	reader.execute("BEGIN")
+	reader.execute("SELECT COUNT(*) FROM slurm_jobs").fetchall()
+	threading.Timer(0.5, lambda: reader.execute("COMMIT")).start()
+
+	start = time.monotonic()
+	db_manager.add_to_db(SlurmJob(id=1, state="QUEUED"))
+	assert time.monotonic() - start >= 0.4
+
+	reader.close()
+	assert sqlite3.connect(db_file).execute("SELECT state FROM slurm_jobs WHERE id = 1").fetchall() == [("QUEUED",)]
+
+
+def test_write_is_retried_while_another_writer_holds_the_database(tmp_path):
+	db_file = tmp_path.joinpath("psrpype.sqlite3").as_posix()
+	db_manager = DBManager(db_file, DBConfig(busy_timeout=0.01, max_retries=40))
+	db_manager.init_database()
+
+	writer = sqlite3.connect(db_file, isolation_level=None, check_same_thread=False)
+	writer.execute("BEGIN IMMEDIATE")
+	threading.Timer(0.5, lambda: writer.execute("COMMIT")).start()
+
+	start = time.monotonic()
+	db_manager.add_to_db(SlurmJob(id=1, state="QUEUED"))
+	assert time.monotonic() - start >= 0.4
+
+	writer.close()
+	assert sqlite3.connect(db_file).execute("SELECT state FROM slurm_jobs WHERE id = 1").fetchall() == [("QUEUED",)]
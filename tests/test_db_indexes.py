@@ -0,0 +1,145 @@
+import time
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event, text
+
+from app_utils import AppUtils
+from db_migrations import create_modified_triggers
+from db_orms import DBManager
+from initialise_data import FileInfo, get_observation_ids, insert_collection
+from slurm import SlurmChecker
+
+OBSERVATION_COUNT = 100000
+CHUNKS_PER_OBSERVATION = 10
+# one observation in 100 is left to process, and one in 1000 of those has a slurm job, half of them running
+TO_PROCESS_EVERY = 100
+SLURM_JOB_EVERY = 1000
+
+# generous bounds for a shared machine: the scans the indexes replace take seconds at this size
+MAX_SELECTION_SECONDS = 5
+MAX_LOOKUP_SECONDS = 1
+
+
+@pytest.fixture(scope="module")
+def db_manager(tmp_path_factory):
+	""" A database of OBSERVATION_COUNT observations with CHUNKS_PER_OBSERVATION chunks each, one in ten a calibrator """
+	db_manager = DBManager(tmp_path_factory.mktemp("indexes").joinpath("psrpype.sqlite3").as_posix())
+	db_manager.init_database()
+
+	with db_manager._engine.begin() as connection:
+		# the modified triggers would run a statement per row
+		for row in connection.execute(text("SELECT name FROM sqlite_master WHERE type = 'trigger'")).all():
+			connection.execute(text("DROP TRIGGER {}".format(row[0])))
+
+		connection.execute(text("INSERT INTO collections (id, collection_name, collection_path, pid, name_alias) VALUES (1, 'c', '/data/c', 'P000', 'c')"))
+		connection.execute(text("WITH RECURSIVE n(value) AS (SELECT 1 UNION ALL SELECT value + 1 FROM n WHERE value < :count) "
+								"INSERT INTO slurm_jobs (id, state) SELECT value, CASE WHEN value % 2 = 0 THEN 'FAILED' ELSE 'RUNNING' END FROM n"),
+						   dict(count=OBSERVATION_COUNT // SLURM_JOB_EVERY))
+		connection.execute(text(
+			"WITH RECURSIVE n(value) AS (SELECT 1 UNION ALL SELECT value + 1 FROM n WHERE value < :count) "
+			"INSERT INTO observations (id, slurm_id, obs_start_utc, obs_type, nchan, nsubint, nbin, npol, cfreq, bw, source, backend, telescope, decimated, processed) "
+			"SELECT value, CASE WHEN value % :slurm_every = 1 THEN value / :slurm_every + 1 END, printf('2020-01-01-00:00:%06d', value), "
+			"CASE WHEN value % 10 = 0 THEN 'PolnCal' ELSE 'Pulsar' END, 1024, 8, 1024, 4, 2368.0, 3328.0, printf('J%04d-0000', value % 500), "
+			"'Medusa', 'Parkes', 0, value % :to_process != 1 FROM n"),
+			dict(count=OBSERVATION_COUNT, slurm_every=SLURM_JOB_EVERY, to_process=TO_PROCESS_EVERY))
+		connection.execute(text(
+			"WITH RECURSIVE n(value) AS (SELECT 0 UNION ALL SELECT value + 1 FROM n WHERE value < :count - 1) "
+			"INSERT INTO observation_chunks (id, nchan, nsubint, nbin, npol, cfreq, bw, file_size, source, backend, telescope, start_mjd, "
+			"obs_start_utc, end_mjd, obs_type, original_file, sym_file, processed, collection_id, observation_id) "
+			"SELECT o.id * :per + n.value, o.nchan, o.nsubint, o.nbin, o.npol, o.cfreq, o.bw, 1, o.source, o.backend, o.telescope, 58849.0, "
+			"o.obs_start_utc, 58849.1, o.obs_type, printf('/data/c/%d_%d.rf', o.id, n.value), printf('/data/c/%d_%d.rf', o.id, n.value), "
+			"o.processed, 1, o.id FROM observations o, n"),
+			dict(count=CHUNKS_PER_OBSERVATION, per=CHUNKS_PER_OBSERVATION))
+		create_modified_triggers(connection)
+		connection.execute(text("ANALYZE"))
+
+	assert db_manager.get_session().execute(text("SELECT COUNT(*) FROM observation_chunks")).scalar() == OBSERVATION_COUNT * CHUNKS_PER_OBSERVATION
+	return db_manager
+
+
+@contextmanager
+def capture_statements(db_manager):
+	""" The statements, with their parameters, run inside it """
+	statements = []
+
+	def capture(conn, cursor, statement, parameters, context, executemany):
+		statements.append((statement, parameters))
+
+	event.listen(db_manager._engine, "before_cursor_execute", capture)
+	try:
+		yield statements
+	finally:
+		event.remove(db_manager._engine, "before_cursor_execute", capture)
+
+
+def get_plan(db_manager, statement, parameters):
+	with db_manager._engine.connect() as connection:
+		rows = connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters).all()
+	return "\n".join(row[-1] for row in rows)
+
+
+def test_process_data_selection(db_manager):
+	start = time.monotonic()
+	with capture_statements(db_manager) as statements:
+		observations = db_manager.with_chunks(AppUtils.get_pulsars_to_process(db_manager)).all()
+		chunk_count = sum(len(o.observation_chunks) for o in observations)
+	elapsed = time.monotonic() - start
+
+	# the unprocessed observations, all pulsars, but those in running slurm jobs
+	assert len(observations) == OBSERVATION_COUNT // TO_PROCESS_EVERY - OBSERVATION_COUNT // SLURM_JOB_EVERY // 2
+	assert chunk_count == len(observations) * CHUNKS_PER_OBSERVATION
+	assert elapsed < MAX_SELECTION_SECONDS
+
+	plans = [get_plan(db_manager, *s) for s in statements]
+	assert "USING INDEX ix_observations_type_processed_slurm" in plans[0]
+	chunk_plans = [p for (statement, parameters), p in zip(statements, plans) if "FROM observation_chunks" in statement]
+	assert len(chunk_plans) > 0
+	assert all("USING INDEX ix_observation_chunks_observation_id" in p for p in chunk_plans)
+
+
+def test_slurm_checker_lookup(db_manager, monkeypatch):
+	monkeypatch.setattr(DBManager, "_DBManager__instance", db_manager)
+
+	start = time.monotonic()
+	with capture_statements(db_manager) as statements:
+		slurm_checker = SlurmChecker()
+	elapsed = time.monotonic() - start
+
+	assert sorted(slurm_checker.job_ids) == list(range(1, OBSERVATION_COUNT // SLURM_JOB_EVERY + 1))
+	assert elapsed < MAX_LOOKUP_SECONDS
+	assert "USING COVERING INDEX ix_observations_type_processed_slurm" in get_plan(db_manager, *statements[0])
+
+
+def test_ingestion_lookup(db_manager):
+	# calibrator chunks, so that the pulsars the other tests select are left as they are: one joins
+	# the existing observation 120 and the others start new ones
+	file_infos, chunk_rows = {}, []
+	for i, (utc, source) in enumerate([("2020-01-01-00:00:000120", "J0120-0000")] + [("2021-01-01-00:00:{:06d}".format(i), "J0000-0000") for i in range(100)]):
+		original_file = "/data/d/{}_{}.cf".format(utc, i)
+		file_infos[original_file] = FileInfo(original_file, "Medusa", source, "Parkes", "PolnCal", 2368.0, 3328.0, 1024, 8, 1024, 4, 1.0, 59215.0, 59215.1)
+		chunk_rows.append(file_infos[original_file].chunk_row(original_file, original_file, utc))
+	collection_row = dict(collection_name="d", name_alias="d", pid="P000", collection_path="/data/d")
+
+	start = time.monotonic()
+	with capture_statements(db_manager) as statements:
+		observation_ids = get_observation_ids(db_manager.get_session())
+		insert_collection(db_manager, collection_row, chunk_rows, observation_ids, file_infos)
+	elapsed = time.monotonic() - start
+
+	assert len(observation_ids) == OBSERVATION_COUNT + 100
+	assert observation_ids[("2020-01-01-00:00:000120", 2368.0, "J0120-0000")] == 120
+	session = db_manager.get_session()
+	assert session.execute(text("SELECT COUNT(*) FROM observation_chunks WHERE observation_id = 120")).scalar() == CHUNKS_PER_OBSERVATION + 1
+	# which was processed, and has to be again
+	assert session.execute(text("SELECT processed FROM observations WHERE id = 120")).scalar() == 0
+	assert elapsed < MAX_SELECTION_SECONDS
+
+	# the scan of all observations and the read back of the new ones only read the natural key index,
+	# and the observations that gained chunks are found from the new chunks by primary key
+	plans = [get_plan(db_manager, *s) for s in statements if s[0].lstrip().startswith("SELECT") and "FROM observations" in s[0]]
+	assert len(plans) == 3
+	assert "SCAN observations USING COVERING INDEX ix_observations_start_cfreq_source" in plans[0]
+	assert "SEARCH observations USING COVERING INDEX ix_observations_start_cfreq_source (obs_start_utc=?)" in plans[1]
+	assert "SEARCH observations USING INTEGER PRIMARY KEY (rowid=?)" in plans[2]
+	assert "SEARCH observation_chunks USING INTEGER PRIMARY KEY (rowid>?)" in plans[2]
@@ -0,0 +1,87 @@
+import threading
+import time
+
+import pytest
+from sqlalchemy import create_engine, text
+
+import db_migrations
+from db_migrations import SCHEMA_VERSION, get_schema_version, set_schema_version, upgrade_database
+from db_orms import DBManager
+
+
+def get_engine(db_file):
+	return create_engine("sqlite+pysqlite:///{}".format(db_file), future=True, connect_args={'timeout': 10})
+
+
+def get_columns(engine, table):
+	with engine.connect() as connection:
+		return [row[1] for row in connection.execute(text("PRAGMA table_info({})".format(table)))]
+
+
+@pytest.fixture
+def old_database(tmp_path, monkeypatch):
+	""" A database at version 0 of a schema whose only migration adds a column, without checking for it first """
+	db_file = tmp_path.joinpath("old.sqlite3")
+	with get_engine(db_file).begin() as connection:
+		connection.execute(text("CREATE TABLE observations (id INTEGER PRIMARY KEY)"))
+
+	def add_column(connection):
+		connection.execute(text("ALTER TABLE observations ADD COLUMN modified INTEGER"))
+		time.sleep(0.2)
+
+	monkeypatch.setattr(db_migrations, "MIGRATIONS", [add_column])
+	monkeypatch.setattr(db_migrations, "SCHEMA_VERSION", 1)
+	return db_file
+
+
+def test_failed_migration_changes_nothing(old_database, monkeypatch):
+	def add_column_and_fail(connection):
+		connection.execute(text("ALTER TABLE observations ADD COLUMN modified INTEGER"))
+		raise RuntimeError("failed after the first step")
+
+	monkeypatch.setattr(db_migrations, "MIGRATIONS", [add_column_and_fail])
+	engine = get_engine(old_database)
+	with pytest.raises(RuntimeError):
+		upgrade_database(engine)
+
+	assert get_columns(engine, "observations") == ["id"]
+	with engine.connect() as connection:
+		assert get_schema_version(connection) == 0
+
+
+def test_concurrent_upgrades_run_the_migrations_once(old_database):
+	errors = []
+
+	def upgrade():
+		try:
+			upgrade_database(get_engine(old_database))
+		except Exception as e:
+			errors.append(e)
+
+	threads = [threading.Thread(target=upgrade) for i in range(4)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	assert errors == []
+	engine = get_engine(old_database)
+	assert get_columns(engine, "observations") == ["id", "modified"]
+	with engine.connect() as connection:
+		assert get_schema_version(connection) == 1
+
+
+def test_upgrade_skips_columns_that_exist(tmp_path):
+	# e.g. a database left by a migration that was not atomic, with the modified columns but at version 4
+	db_file = tmp_path.joinpath("psrpype.sqlite3")
+	DBManager(db_file.as_posix()).init_database()
+	engine = get_engine(db_file)
+	with engine.begin() as connection:
+		set_schema_version(connection, 4)
+		connection.execute(text("DROP TABLE chunk_headers"))
+
+	DBManager(db_file.as_posix())
+
+	with engine.connect() as connection:
+		assert get_schema_version(connection) == SCHEMA_VERSION
+		assert connection.execute(text("SELECT name FROM sqlite_master WHERE name = 'chunk_headers'")).scalar() == "chunk_headers"
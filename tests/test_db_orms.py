@@ -0,0 +1,148 @@
+import logging
+import subprocess
+import sys
+import time
+
+from app_utils import AppUtils
+from conftest import ingest
+from constants import (CALIBRATOR_STAGES, PULSAR_STAGES, STAGE_DONE, STAGE_FAILED,
+                       STAGE_PREPROCESS, STAGE_READY, STAGE_RUNNING, STAGE_WAITING)
+from db_orms import ChunkStage, DBManager, Observation, ObservationChunk, SlurmJob
+from log import Logger
+
+
+def load_observation(db_manager, utc):
+	""" Loads an observation with with_chunks in a new session, and touches all that is loaded with it. Returns the number of statements run. """
+	db_manager.close_session()
+	db_manager.count_queries()
+	start = db_manager.query_count
+
+	query = db_manager.get_session().query(Observation).filter(Observation.obs_start_utc == utc)
+	observation = db_manager.with_chunks(query).one()
+	for observation_chunk in observation.observation_chunks:
+		observation_chunk.collection.collection_name
+		[stage.state for stage in observation_chunk.stages]
+
+	return db_manager.query_count - start
+
+
+def test_with_chunks_query_count_does_not_grow_with_the_chunks(db_manager):
+	utcs = ingest(db_manager, "c", [1, 50])
+
+	assert load_observation(db_manager, utcs[0]) == load_observation(db_manager, utcs[1])
+	# the observations, their chunks, and the collections and stages of the chunks
+	assert load_observation(db_manager, utcs[1]) == 4
+
+
+def test_queries_are_only_counted_when_logged_at_debug_level(tmp_path):
+	db_manager = DBManager(tmp_path.joinpath("quiet.sqlite3").as_posix())
+	db_manager.init_database()
+	db_manager.get_session().query(Observation).all()
+	assert db_manager.query_count == 0
+
+	handler = logging.NullHandler(logging.DEBUG)
+	Logger.get_instance().addHandler(handler)
+	try:
+		db_manager = DBManager(tmp_path.joinpath("debug.sqlite3").as_posix())
+		db_manager.init_database()
+	finally:
+		Logger.get_instance().removeHandler(handler)
+	start = db_manager.query_count
+	db_manager.get_session().query(Observation).all()
+	assert db_manager.query_count == start + 1
+
+
+def test_stages_are_in_pipeline_order(db_manager):
+	ingest(db_manager, "c", [1])
+	ingest(db_manager, "cal", [1], source="J1939-6342", obs_type="PolnCal")
+	db_manager.close_session()
+	observations = db_manager.with_chunks(db_manager.get_session().query(Observation)).all()
+
+	stages = {o.obs_type: [stage.stage for stage in o.observation_chunks[0].stages] for o in observations}
+	assert stages == {"Pulsar": PULSAR_STAGES, "PolnCal": CALIBRATOR_STAGES}
+	# and not by name
+	assert PULSAR_STAGES != sorted(PULSAR_STAGES)
+
+
+def test_with_stages_to_run(db_manager):
+	# one observation per case, in the order of utcs
+	utcs = ingest(db_manager, "c", [2] * 5)
+	session = db_manager.get_session()
+	chunks = {utc: session.query(ObservationChunk).filter(ObservationChunk.obs_start_utc == utc).all() for utc in utcs}
+
+	def set_states(utc, states, attempts=1):
+		for observation_chunk in chunks[utc]:
+			for stage, state in zip(observation_chunk.stages, states):
+				stage.state = state
+				stage.attempts = attempts
+		db_manager.add_to_db([s for o in chunks[utc] for s in o.stages])
+
+	# utcs[0] is as ingested
+	set_states(utcs[1], [STAGE_DONE, STAGE_RUNNING, STAGE_WAITING, STAGE_WAITING])
+	set_states(utcs[2], [STAGE_DONE, STAGE_FAILED, STAGE_WAITING, STAGE_WAITING], attempts=3)
+	set_states(utcs[3], [STAGE_DONE] * 4)
+	# one chunk running and the other ready
+	set_states(utcs[4], [STAGE_DONE, STAGE_RUNNING, STAGE_WAITING, STAGE_WAITING])
+	chunks[utcs[4]][1].stages[1].state = STAGE_READY
+	db_manager.add_to_db(chunks[utcs[4]][1].stages[1])
+
+	def select(max_attempts=None):
+		query = db_manager.with_stages_to_run(session.query(Observation), max_attempts)
+		return sorted(o.obs_start_utc for o in query.all())
+
+	assert select() == [utcs[0], utcs[2], utcs[3], utcs[4]]
+	assert select(max_attempts=3) == [utcs[0], utcs[3], utcs[4]]
+	assert select(max_attempts=4) == [utcs[0], utcs[2], utcs[3], utcs[4]]
+
+
+def test_fail_stale_stages(db_manager):
+	# one observation per case, in the order of utcs
+	utcs = ingest(db_manager, "c", [1] * 5)
+	session = db_manager.get_session()
+	stages = {utc: session.query(ObservationChunk).filter(ObservationChunk.obs_start_utc == utc).one().get_stage(STAGE_PREPROCESS) for utc in utcs}
+	for stage in stages.values():
+		stage.start()
+
+	finished = subprocess.Popen([sys.executable, "-c", "pass"])
+	finished.wait()
+	hour_ago = time.time() - 3600
+
+	# on this host: by a process that is gone, and by this one; on another host: recently, an hour ago, and before pids were kept
+	stages[utcs[0]].pid = finished.pid
+	stages[utcs[2]].host = stages[utcs[3]].host = stages[utcs[4]].host = "elsewhere"
+	stages[utcs[3]].start_time = hour_ago
+	stages[utcs[4]].pid = None
+	db_manager.add_to_db(stages.values())
+
+	db_manager.db_config._stage_timeout = 1800
+	assert db_manager.fail_stale_stages() == 2
+
+	db_manager.close_session()
+	session = db_manager.get_session()
+	states = [session.get(ChunkStage, (stages[utc].chunk_id, STAGE_PREPROCESS)).state for utc in utcs]
+	assert states == [STAGE_FAILED, STAGE_RUNNING, STAGE_RUNNING, STAGE_FAILED, STAGE_RUNNING]
+
+	# and the observations of the failed stages are selected again
+	query = db_manager.with_stages_to_run(session.query(Observation))
+	assert sorted(o.obs_start_utc for o in query) == [utcs[0], utcs[3]]
+
+
+def test_get_pulsars_to_process(db_manager):
+	utcs = ingest(db_manager, "c", [1] * 5)
+	ingest(db_manager, "cal", [1], source="J1939-6342", obs_type="PolnCal")
+	session = db_manager.get_session()
+	observations = {o.obs_start_utc: o for o in session.query(Observation).filter(Observation.obs_type == "Pulsar")}
+
+	# in a job still queued, in a job that was cancelled, and failed twice
+	for job_id, utc, state in ((1, utcs[0], "PENDING"), (2, utcs[1], "CANCELLED by 1000")):
+		observations[utc].slurm_job = SlurmJob(id=job_id, state=state)
+	stage = observations[utcs[2]].observation_chunks[0].get_stage(STAGE_PREPROCESS)
+	stage.start()
+	stage.fail()
+	stage.attempts = 2
+	# and processed
+	observations[utcs[3]].processed = True
+	db_manager.add_to_db(list(observations.values()))
+
+	assert sorted(o.obs_start_utc for o in AppUtils.get_pulsars_to_process(db_manager)) == [utcs[1], utcs[2], utcs[4]]
+	assert sorted(o.obs_start_utc for o in AppUtils.get_pulsars_to_process(db_manager, max_attempts=2)) == [utcs[1], utcs[4]]
@@ -0,0 +1,49 @@
+import os
+from pathlib import Path
+
+from file_index import FileIndex
+
+
+def make_file(path):
+	path.parent.mkdir(parents=True, exist_ok=True)
+	path.write_bytes(b"archive")
+	return path
+
+
+def test_entries_are_found_through_symlinks(tmp_path):
+	archive = make_file(tmp_path.joinpath("data", "dap", "a.rf"))
+	tmp_path.joinpath("link_to_data").symlink_to(tmp_path.joinpath("data"))
+	tmp_path.joinpath("data", "dap", "b.rf").symlink_to(archive)
+
+	file_index = FileIndex(tmp_path.joinpath("index.sqlite3"))
+	file_index.add(archive)
+
+	assert file_index.is_known(tmp_path.joinpath("link_to_data", "dap", "a.rf"))
+	assert file_index.is_known(tmp_path.joinpath("data", "dap", "b.rf"))
+	assert file_index.is_known(os.path.relpath(archive))
+
+
+def test_entries_of_resolved_paths_are_found(tmp_path):
+	""" Indices written when entries were keyed on Path.resolve() """
+	archive = make_file(tmp_path.joinpath("data", "dap", "a.rf"))
+	tmp_path.joinpath("link_to_data").symlink_to(tmp_path.joinpath("data"))
+
+	file_index = FileIndex(tmp_path.joinpath("index.sqlite3"))
+	stat_result = os.stat(archive)
+	with file_index._connection:
+		file_index._connection.execute("INSERT INTO files (path, size, mtime_ns, inode) VALUES (?, ?, ?, ?)",
+									   (Path(archive).resolve().as_posix(), stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino))
+	file_index.close()
+
+	file_index = FileIndex(tmp_path.joinpath("index.sqlite3"))
+	assert file_index.is_known(tmp_path.joinpath("link_to_data", "dap", "a.rf"))
+
+
+def test_changed_files_are_not_known(tmp_path):
+	archive = make_file(tmp_path.joinpath("data", "a.rf"))
+	file_index = FileIndex(tmp_path.joinpath("index.sqlite3"))
+	file_index.add(archive)
+	file_index.close()
+
+	archive.write_bytes(b"another archive")
+	assert not FileIndex(tmp_path.joinpath("index.sqlite3")).is_known(archive)
@@ -0,0 +1,61 @@
+import numpy as np
+from astropy.time import Time
+
+import gen_utils
+from gen_utils import LEAP_SECOND_MJDS, LEAP_SECONDS_VALID_UNTIL_MJD, get_utc_string, get_utc_strings
+
+# from 1972, when UTC started using leap seconds, before the earliest archived data, to a few
+# years ahead (ERFA doubts UTC much further out)
+FIRST_MJD = 41317  # 1972-01-01
+LAST_MJD = 61771   # 2028-01-01
+
+
+def astropy_utc_strings(mjds):
+	return [t[:19].replace("T", "-") for t in Time(mjds, format='mjd', scale='utc').isot]
+
+
+def test_matches_astropy_over_the_mjd_range():
+	mjds = np.random.default_rng(1).uniform(FIRST_MJD, LAST_MJD, 100000)
+	assert get_utc_strings(mjds) == astropy_utc_strings(mjds)
+
+
+def test_matches_astropy_around_leap_seconds():
+	leap_days = LEAP_SECOND_MJDS[(LEAP_SECOND_MJDS >= FIRST_MJD) & (LEAP_SECOND_MJDS < LAST_MJD)]
+	assert len(leap_days) == 27
+
+	# the last seconds of the day before, the leap day and the day after, and the first ones of the next day
+	seconds = np.arange(-3, 3, 0.1)
+	mjds = np.concatenate([day + np.concatenate([1 + seconds / 86401, seconds / 86400]) for day in np.concatenate([leap_days - 1, leap_days, leap_days + 1])])
+
+	utcs = get_utc_strings(mjds)
+	assert utcs == astropy_utc_strings(mjds)
+	assert "2016-12-31-23:59:60" in utcs
+	assert "1972-06-30-23:59:60" in utcs
+
+
+def test_rounds_to_the_millisecond_across_day_boundaries():
+	# just under half a millisecond before midnight rounds down, and just over rounds up into the next day
+	days = np.array([FIRST_MJD, 58000, 59215, LAST_MJD - 1] + list(LEAP_SECOND_MJDS[LEAP_SECOND_MJDS >= FIRST_MJD]))
+	day_lengths = 86400 + np.isin(days, LEAP_SECOND_MJDS)
+	mjds = np.concatenate([days + 1 - offset / day_lengths for offset in (0.4e-3, 0.6e-3, 1.4e-3, 0.0e-3)])
+
+	utcs = get_utc_strings(mjds)
+	assert utcs == astropy_utc_strings(mjds)
+	assert get_utc_string(58000 + 1 - 0.4e-3 / 86400) == "2017-09-05-00:00:00"
+	assert get_utc_string(58000 + 1 - 0.6e-3 / 86400) == "2017-09-04-23:59:59"
+
+
+def test_takes_scalars_and_lists():
+	assert get_utc_string(58000.5) == "2017-09-04-12:00:00"
+	assert get_utc_strings([58000.5, 58001.25]) == ["2017-09-04-12:00:00", "2017-09-05-06:00:00"]
+
+
+def test_warns_once_past_the_leap_second_table(monkeypatch, caplog):
+	monkeypatch.setattr(gen_utils, "_leap_seconds_warned", False)
+
+	get_utc_strings([58000.5, LEAP_SECONDS_VALID_UNTIL_MJD - 0.5])
+	assert "leap second table" not in caplog.text
+
+	get_utc_strings([58000.5, LEAP_SECONDS_VALID_UNTIL_MJD + 0.5])
+	get_utc_string(LEAP_SECONDS_VALID_UNTIL_MJD + 10)
+	assert caplog.text.count("leap second table") == 1
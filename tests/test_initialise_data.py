@@ -0,0 +1,44 @@
+from sqlalchemy import event, func
+
+from conftest import ingest
+from db_orms import Observation
+
+# SQLITE_MAX_VARIABLE_NUMBER before SQLite 3.32
+OLD_SQLITE_MAX_VARIABLES = 999
+
+
+def test_insert_collection_stays_under_the_parameter_limit(db_manager):
+	parameter_counts = []
+
+	def count_parameters(conn, cursor, statement, parameters, context, executemany):
+		if not executemany:
+			parameter_counts.append(len(parameters))
+
+	event.listen(db_manager._engine, "before_cursor_execute", count_parameters)
+	try:
+		utcs = ingest(db_manager, "c", [1] * 2500)
+	finally:
+		event.remove(db_manager._engine, "before_cursor_execute", count_parameters)
+
+	assert max(parameter_counts) <= OLD_SQLITE_MAX_VARIABLES
+	assert db_manager.get_session().query(func.count(Observation.id)).scalar() == len(utcs)
+
+
+def test_observations_that_gain_chunks_are_processed_again(db_manager):
+	utcs = ingest(db_manager, "c", [2, 2])
+	session = db_manager.get_session()
+	for observation in session.query(Observation):
+		observation.processed = observation.decimated = True
+		observation.psradded_file = "/out/{}.psradded".format(observation.id)
+	db_manager.add_to_db(session.query(Observation).all())
+
+	# ingesting the same collection again adds nothing, and another one adds chunks to the first observation only
+	ingest(db_manager, "c", [2, 2])
+	ingest(db_manager, "d", [3])
+
+	db_manager.close_session()
+	observations = {o.obs_start_utc: o for o in db_manager.with_chunks(db_manager.get_session().query(Observation))}
+	assert len(observations[utcs[0]].observation_chunks) == 5
+	assert (observations[utcs[0]].processed, observations[utcs[0]].decimated, observations[utcs[0]].psradded_file) == (False, False, None)
+	assert (observations[utcs[1]].processed, observations[utcs[1]].decimated) == (True, True)
+	assert observations[utcs[1]].psradded_file is not None
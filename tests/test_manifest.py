@@ -0,0 +1,83 @@
+import json
+
+from conftest import ingest
+from constants import STAGE_CLEAN, STAGE_DONE, STAGE_PREPROCESS, STAGE_READY
+from db_orms import Observation
+from manifest import (SpoolWriter, get_chunk_rows, get_chunk_spool_path, load_chunk_rows, load_manifest, merge_spools,
+					  write_manifest)
+
+
+def load_observations(db_manager):
+	db_manager.close_session()
+	return db_manager.with_chunks(db_manager.get_session().query(Observation)).all()
+
+
+def spool_preprocessed(spool_path, observation):
+	""" Spools what a job that preprocessed the chunks of the observation writes """
+	spool_writer = SpoolWriter(spool_path)
+	for observation_chunk in observation.observation_chunks:
+		observation_chunk.preprocessed_file = "/out/{}.preprocessed".format(observation_chunk.id)
+		stage = observation_chunk.get_stage(STAGE_PREPROCESS)
+		stage.start()
+		stage.finish(observation_chunk.preprocessed_file)
+		spool_writer.add_to_db([observation_chunk, stage])
+	spool_writer.close()
+
+
+def test_merged_objects_are_refreshed_without_queries(db_manager, tmp_path):
+	ingest(db_manager, "c", [20, 20])
+	observations = load_observations(db_manager)
+
+	# as LocalExecutor does: a job per observation works from a manifest, and its spool is merged
+	spool_paths = []
+	for observation in observations:
+		job_observation, manifest = load_manifest(write_manifest(tmp_path, observation, tmp_path.joinpath("default.cfg"), False))
+		spool_preprocessed(manifest['spool'], job_observation)
+		spool_paths.append(manifest['spool'])
+	merge_spools(db_manager, spool_paths)
+
+	# then writes the manifest of the consolidation
+	db_manager.count_queries()
+	start = db_manager.query_count
+	manifest_paths = [write_manifest(tmp_path, observation, tmp_path.joinpath("default.cfg"), True) for observation in observations]
+	assert db_manager.query_count == start
+
+	for manifest_path in manifest_paths:
+		with open(manifest_path) as f:
+			manifest = json.load(f)
+		assert all(row['preprocessed_file'] == "/out/{}.preprocessed".format(row['id']) for row in manifest['chunks'])
+		assert all(row['state'] == STAGE_DONE for row in manifest['stages'] if row['stage'] == STAGE_PREPROCESS)
+
+	# and the DB has them too
+	for observation in load_observations(db_manager):
+		for observation_chunk in observation.observation_chunks:
+			assert observation_chunk.preprocessed_file == "/out/{}.preprocessed".format(observation_chunk.id)
+			assert observation_chunk.get_stage(STAGE_PREPROCESS).state == STAGE_DONE
+
+
+def test_merged_chunk_rows_are_current_without_queries(db_manager, tmp_path):
+	ingest(db_manager, "c", [20])
+	observation_chunks = load_observations(db_manager)[0].observation_chunks
+
+	# as StageScheduler does: a task per chunk stage works from get_chunk_rows, and their spools are merged together
+	spool_paths = []
+	for observation_chunk in observation_chunks:
+		spool_path = get_chunk_spool_path(tmp_path, observation_chunk.observation_id, observation_chunk.id).as_posix()
+		stage = load_chunk_rows(get_chunk_rows(observation_chunk)).get_stage(STAGE_PREPROCESS)
+		spool_writer = SpoolWriter(spool_path)
+		stage.start()
+		spool_writer.add_to_db([stage, stage.finish("/out/{}.preprocessed".format(observation_chunk.id))])
+		spool_writer.close()
+		spool_paths.append(spool_path)
+	merge_spools(db_manager, spool_paths)
+
+	# then submits the next stage of each chunk
+	db_manager.count_queries()
+	start = db_manager.query_count
+	rows = [get_chunk_rows(observation_chunk) for observation_chunk in observation_chunks]
+	assert db_manager.query_count == start
+
+	for chunk_rows in rows:
+		states = {row['stage']: row['state'] for row in chunk_rows['stages']}
+		assert states[STAGE_PREPROCESS] == STAGE_DONE
+		assert states[STAGE_CLEAN] == STAGE_READY
@@ -0,0 +1,45 @@
+from conftest import ingest
+from constants import STAGE_CLEAN, STAGE_FAILED, STAGE_PREPROCESS, STAGE_RUNNING, STAGE_WAITING
+from db_orms import DBManager, Observation, SlurmJob
+from manifest import SpoolWriter, load_manifest, write_manifest
+from slurm import SlurmChecker
+
+
+def submit(db_manager, spool_dir, observation, job_id):
+	""" Links a slurm job to the observation, as process_data does, and returns the observation of its manifest """
+	observation.slurm_job = SlurmJob(id=job_id, state="RUNNING")
+	db_manager.add_to_db([observation, observation.slurm_job])
+	job_observation, manifest = load_manifest(write_manifest(spool_dir, observation, spool_dir.joinpath("default.cfg"), False))
+	return job_observation, manifest['spool']
+
+
+def test_stages_left_running_by_jobs_that_ended_are_failed(db_manager, tmp_path, monkeypatch):
+	monkeypatch.setattr(DBManager, "_DBManager__instance", db_manager)
+	ingest(db_manager, "c", [2, 2])
+	observations = db_manager.with_chunks(db_manager.get_session().query(Observation).order_by(Observation.id)).all()
+
+	# both jobs preprocess their first chunk, and start on its next stage; the first job is then cancelled
+	for job_id, observation in zip((1, 2), observations):
+		job_observation, spool_path = submit(db_manager, tmp_path, observation, job_id)
+		observation_chunk = job_observation.observation_chunks[0]
+		spool_writer = SpoolWriter(spool_path)
+		preprocess = observation_chunk.get_stage(STAGE_PREPROCESS)
+		preprocess.start()
+		clean = preprocess.finish("/out/{}.preprocessed".format(observation_chunk.id))
+		clean.start()
+		spool_writer.add_to_db([preprocess, clean])
+		spool_writer.close()
+
+	slurm_checker = SlurmChecker(["1", "2"], tmp_path)
+	monkeypatch.setattr(slurm_checker, "get_job_dict", lambda job_ids: {"1": "CANCELLED by 1000", "2": "RUNNING"})
+	slurm_checker.check_and_update_jobs()
+
+	assert slurm_checker.job_ids == ["2"]
+	db_manager.close_session()
+	session = db_manager.get_session()
+	assert session.get(SlurmJob, 1).state == "CANCELLED by 1000"
+	cancelled, running = [db_manager.with_chunks(session.query(Observation).filter(Observation.id == o.id)).one() for o in observations]
+	assert cancelled.observation_chunks[0].get_stage(STAGE_CLEAN).state == STAGE_FAILED
+	assert cancelled.observation_chunks[0].get_stage(STAGE_CLEAN).attempts == 1
+	# the spool of a job that still runs is not merged yet
+	assert running.observation_chunks[0].get_stage(STAGE_CLEAN).state == STAGE_WAITING
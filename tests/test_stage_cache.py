@@ -0,0 +1,74 @@
+import os
+
+from stage_cache import (get_stage_key, get_stage_manifest_path, is_current, read_stage_key,
+                         write_stage_manifest)
+
+INPUT_KEY = {'file': "J0437-4715_0.rf", 'cfreq': 2368.0}
+
+
+def chain(parameters):
+	""" The keys of a chain of stages, each from the key of the one before, as Processor._stage_key makes them """
+	keys, input_key = [], INPUT_KEY
+	for stage, stage_parameters in parameters:
+		input_key = get_stage_key(input_key, stage, stage_parameters)
+		keys.append(input_key)
+	return keys
+
+
+def test_keys_change_from_the_changed_stage_onwards():
+	parameters = [("preprocess", {'dm': 2.64}), ("clean", {'tolerance': 1}), ("calibrate", {'databases': ["a"]}), ("reclean", {'tolerance': 1})]
+	keys = chain(parameters)
+
+	assert chain(parameters) == keys
+	assert len(set(keys)) == len(keys)
+
+	changed = chain(parameters[:2] + [("calibrate", {'databases': ["b"]})] + parameters[3:])
+	assert changed[:2] == keys[:2]
+	assert all(changed[i] != keys[i] for i in range(2, 4))
+
+	changed = chain([("preprocess", {'dm': 2.65})] + parameters[1:])
+	assert all(changed[i] != keys[i] for i in range(4))
+
+	assert get_stage_key(dict(INPUT_KEY, file="J0437-4715_1.rf"), "preprocess", {'dm': 2.64}) != keys[0]
+
+
+def test_is_current_with_a_recorded_key(tmp_path):
+	output_file = tmp_path.joinpath("cleaned.rf").as_posix()
+	open(output_file, 'w').close()
+	write_stage_manifest(output_file, "clean", "key", {})
+
+	assert read_stage_key(output_file) == "key"
+	assert is_current(output_file, "key")
+	assert not is_current(output_file, "other key")
+
+
+def test_legacy_outputs_are_current_if_newer_than_their_inputs(tmp_path):
+	input_file = tmp_path.joinpath("preprocessed.rf").as_posix()
+	output_file = tmp_path.joinpath("cleaned.rf").as_posix()
+	open(input_file, 'w').close()
+	open(output_file, 'w').close()
+
+	os.utime(input_file, ns=(1000000000, 1000000000))
+	os.utime(output_file, ns=(2000000000, 2000000000))
+	assert read_stage_key(output_file) is None
+	# whatever the key, as none was recorded
+	assert is_current(output_file, "key", [input_file])
+	# inputs that are gone do not count
+	assert is_current(output_file, "key", [input_file, tmp_path.joinpath("missing.rf").as_posix(), None])
+
+	os.utime(input_file, ns=(3000000000, 3000000000))
+	assert not is_current(output_file, "key", [input_file])
+
+
+def test_missing_outputs_are_not_current(tmp_path):
+	assert not is_current(None, "key")
+	assert not is_current(tmp_path.joinpath("cleaned.rf").as_posix(), "key")
+
+
+def test_unreadable_manifests_are_not_current(tmp_path):
+	output_file = tmp_path.joinpath("cleaned.rf").as_posix()
+	open(output_file, 'w').close()
+	get_stage_manifest_path(output_file).write_text("{")
+
+	assert read_stage_key(output_file) == ""
+	assert not is_current(output_file, "key")
@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+from gen_utils import get_utc_strings
+from times_index import TimesIndex, group_chunks
+
+TOLERANCE = 0.00010
+CFREQS = [1369.0, 2368.0]
+
+
+def mjd(minutes):
+	# as times.dat stores them, so that ties compare the same way before and after a round trip
+	return float("{:20.12f}".format(58000 + minutes / 1440.0))
+
+
+def baseline_utc_dirs(times, chunks):
+	"""
+	The utc_dir of each chunk, chunk by chunk as initialise_data did before group_chunks. times is
+	the (cfreq, end MJD, utc_dir) of each times.dat row, in file order, and is appended to.
+	"""
+	utc_dirs = {}
+	for i in sorted(range(len(chunks)), key=lambda i: (chunks[i][0], chunks[i][1])):
+		cfreq, start_mjd, end_mjd = chunks[i]
+		utc_start = get_utc_strings([start_mjd])[0]
+		utc_dir = utc_start
+
+		times_for_cfreq = [row for row in times if row[0] == cfreq]
+		if len(times_for_cfreq) > 0 and not any(row[2] == utc_start for row in times_for_cfreq):
+			# sorted() is stable, so of the rows that end last the earliest written comes first
+			closest = sorted(times_for_cfreq, key=lambda row: start_mjd - row[1])[0]
+			if start_mjd - closest[1] < TOLERANCE:
+				utc_dir = closest[2]
+
+		times.append((cfreq, end_mjd, utc_dir))
+		utc_dirs[i] = utc_dir
+
+	return [utc_dirs[i] for i in range(len(chunks))]
+
+
+def grouped_utc_dirs(times_index, chunks):
+	""" The utc_dir of each chunk, as initialise_data finds them now """
+	cfreqs, start_mjds, end_mjds = (np.array(column) for column in zip(*chunks))
+	utc_starts = get_utc_strings(start_mjds)
+	known_dirs = [times_index.has_utc_dir(cfreq, utc_start) for cfreq, utc_start in zip(cfreqs, utc_starts)]
+	initial_ends = np.array([times_index.latest_end(cfreq) for cfreq in CFREQS])
+
+	labels, heads = group_chunks(np.searchsorted(CFREQS, cfreqs), start_mjds, end_mjds, TOLERANCE, initial_ends, known_dirs)
+	utc_dirs = [times_index.find_utc_dir(cfreqs[head], start_mjds[head], utc_starts[head], TOLERANCE) for head in heads]
+	return [utc_dirs[label] for label in labels]
+
+
+def random_chunks(rng, count):
+	""" Chunks at both centre frequencies that overlap, touch and leave gaps, starting at distinct minutes """
+	minutes = np.sort(rng.choice(4 * count, size=count, replace=False))
+	lengths = rng.choice([0.5, 1, 2, 5, 20], size=count)
+	return [(float(rng.choice(CFREQS)), mjd(m), mjd(m + l)) for m, l in zip(minutes, lengths)]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_grouping_matches_the_baseline_rule(tmp_path, seed):
+	rng = np.random.default_rng(seed)
+	chunks = random_chunks(rng, 60)
+
+	# a first ingestion of some of the chunks, and a rescan of all of them
+	first = [chunks[i] for i in np.sort(rng.choice(len(chunks), size=30, replace=False))]
+	times = []
+	first_dirs = baseline_utc_dirs(times, first)
+
+	times_index = TimesIndex(tmp_path.joinpath("times.dat"))
+	assert grouped_utc_dirs(times_index, first) == first_dirs
+
+	utc_starts = get_utc_strings([start_mjd for cfreq, start_mjd, end_mjd in first])
+	utc_ends = get_utc_strings([end_mjd for cfreq, start_mjd, end_mjd in first])
+	for i in sorted(range(len(first)), key=lambda i: (first[i][0], first[i][1])):
+		times_index.add(first[i][0], first[i][1], utc_starts[i], first[i][2], utc_ends[i], first_dirs[i])
+	times_index.save()
+
+	assert grouped_utc_dirs(TimesIndex(tmp_path.joinpath("times.dat")), chunks) == baseline_utc_dirs(times, chunks)
+
+
+def test_chunks_after_a_forced_head_join_the_chunk_that_ends_last():
+	# the second chunk has its own utc_dir already, but ends before the first: the third joins the first
+	labels, heads = group_chunks([0, 0, 0], [mjd(0), mjd(5), mjd(9.99)], [mjd(10), mjd(6), mjd(20)], TOLERANCE,
+								 forced_heads=[False, True, False])
+	assert list(labels) == [0, 1, 0]
+	assert list(heads) == [0, 1]